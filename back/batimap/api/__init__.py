@@ -6,6 +6,7 @@ from . import (
     insee,
     insees,
     legend,
+    overpass,
     routes,
     status,
     tasks,
@@ -19,6 +20,7 @@ __all__ = [
     "insee",
     "insees",
     "legend",
+    "overpass",
     "routes",
     "status",
     "tasks",
@@ -9,11 +9,14 @@ from .routes import bp
 
 @bp.route("/bbox/cities", methods=["POST"])
 def api_bbox_cities() -> dict:
-    bboxes = (request.get_json() or {}).get("bboxes", [])
+    body = request.get_json() or {}
+    bboxes = body.get("bboxes", [])
     if not bboxes:
         abort(400, message="missing required bboxes")
-    cities = set()
-    for bbox in bboxes:
-        bbox_cities = set(db.get_cities_for_bbox(Bbox(*bbox)))
-        cities |= bbox_cities
-    return jsonify(sorted([CityDTO(x) for x in cities]))
+    try:
+        cities = db.get_city_dtos_for_bboxes(
+            [Bbox(*bbox) for bbox in bboxes], body.get("fields")
+        )
+    except ValueError as e:
+        abort(400, message=str(e))
+    return jsonify([CityDTO.from_row(x) for x in cities])
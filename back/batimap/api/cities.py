@@ -1,22 +1,37 @@
+from datetime import date, datetime
+
 from batimap.citydto import CityDTO
-from batimap.extensions import db
-from batimap.point import Point
+from batimap.extensions import data_version, db, task_registry
 from batimap.taskdto import TaskDTO
 from batimap.tasks.common import task_josm_data, task_josm_data_fast, task_update_insee
-from batimap.tasks.utils import find_task_id, list_tasks
 from flask import current_app, jsonify, request, url_for
+from flask_smorest import abort
 
 from .routes import bp
 
 
 @bp.route("/cities/<insee>", methods=["GET"])
+@data_version.cached_response(
+    lambda insee: data_version.department_of(insee), daily=True
+)
 def api_city(insee) -> dict:
-    return jsonify(CityDTO(db.get_city_for_insee(insee)))
+    fields = request.args.get("fields")
+    # cached for the day: josm_ready is computed as of its start, so it is never served after cadastre expiry
+    start_of_day = datetime.combine(date.today(), datetime.min.time())
+    try:
+        city = db.get_city_dto_for_insee(
+            insee, fields.split(",") if fields else None, start_of_day
+        )
+    except ValueError as e:
+        abort(400, message=str(e))
+    if not city:
+        abort(404, message=f"unknown city {insee}")
+    return jsonify(CityDTO.from_row(city))
 
 
 @bp.route("/cities/<insee>/tasks", methods=["GET"])
 def api_city_tasks(insee) -> dict:
-    city_tasks = [TaskDTO(t) for t in list_tasks() if t["args"] == [insee]]
+    city_tasks = [TaskDTO(t) for t in task_registry.tasks() if t["args"] == [insee]]
     return jsonify(city_tasks)
 
 
@@ -24,15 +39,13 @@ def api_city_tasks(insee) -> dict:
 def api_update_insee_list(insee):
     current_app.logger.debug(f"Receive an update request for {insee}")
 
-    task_id = find_task_id("batimap.tasks.common.task_update_insee", [insee])
+    # only create a new task if none already exists
+    (task_id, created) = task_registry.submit(task_update_insee, insee)
 
-    if task_id:
+    if not created:
         current_app.logger.info(
             f"Returning an already running update request for {insee}: {task_id}"
         )
-    else:
-        # only create a new task if none already exists
-        task_id = task_update_insee.delay(insee).id
 
     return (
         {"task_id": task_id},
@@ -51,15 +64,13 @@ def api_josm_data(insee):
     elif c.is_josm_ready():
         task_id = task_josm_data_fast.delay(insee).id
     else:
-        task_id = find_task_id("batimap.tasks.common.task_josm_data", [insee])
+        # only create a new task if none already exists
+        (task_id, created) = task_registry.submit(task_josm_data, insee)
 
-        if task_id:
+        if not created:
             current_app.logger.info(
                 f"Returning an already running josm request for {insee}: {task_id}"
             )
-        else:
-            # only create a new task if none already exists
-            task_id = task_josm_data.delay(insee).id
 
     return (
         {"task_id": task_id},
@@ -74,12 +85,20 @@ def api_obsolete_city():
     ignored_cities = request.args.get("ignored_cities", "").replace(" ", "").split(",")
     minratio = request.args.get("minratio", 0, float)
 
-    result = db.get_obsolete_city(ignored, ignored_cities, minratio)
+    result = db.get_obsolete_city(
+        ignored,
+        ignored_cities,
+        minratio,
+        current_app.config.get("CITY_RESERVATION_TTL", 600),
+    )
     if result:
         city = CityDTO(result.City)
-        (osm_id,) = db.get_osm_id(city.insee)
-        position = Point.from_pg(result.position)
+        priority = result.CityPriority
         return jsonify(
-            {"position": [position.x, position.y], "city": city, "osmid": osm_id}
+            {
+                "position": [priority.lat, priority.lon],
+                "city": city,
+                "osmid": priority.osm_id,
+            }
         )
     return "no obsolete city found", 404
@@ -1,15 +1,17 @@
-from batimap.extensions import db
+from batimap.extensions import data_version, db
 from flask import jsonify
 
 from .routes import bp
 
 
 @bp.route("/departments", methods=["GET"])
+@data_version.cached_response()
 def api_departments() -> dict:
     return jsonify(db.get_departments())
 
 
 @bp.route("/departments/<dept>", methods=["GET"])
+@data_version.cached_response(lambda dept: dept)
 def api_department(dept) -> dict:
     d = db.get_department(dept)
     s = dict(db.get_department_import_stats(dept))
@@ -18,9 +20,8 @@ def api_department(dept) -> dict:
 
 
 @bp.route("/departments/<dept>/details", methods=["GET"])
+@data_version.cached_response(lambda dept: dept)
 def api_department_details(dept) -> dict:
     stats = dict(db.get_department_import_stats(dept))
-    simplified = sorted(
-        [ids for city in db.get_department_simplified_buildings(dept) for ids in city]
-    )
+    simplified = db.get_department_simplified_buildings(dept)
     return jsonify({"simplified": simplified, "dates": stats})
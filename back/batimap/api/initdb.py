@@ -1,31 +1,44 @@
-from batimap.tasks.common import task_initdb
-from batimap.tasks.utils import find_task_id
-from celery import current_app
-from flask import request, url_for
+from batimap.extensions import data_version, db, task_registry
+from batimap.tasks.common import initdb_status, task_initdb
+from flask import current_app, jsonify, request, url_for
 
 from .routes import bp
 
 
 @bp.route("/initdb", methods=["POST"])
 def api_initdb():
-    items = (request.get_json() or {}).get("cities")
+    body = request.get_json() or {}
+    items = body.get("cities")
 
     if not items:
         return "missing items param", 400
 
     current_app.logger.debug(f"Receive an initdb request for {', '.join(items)}")
-    task_id = find_task_id("batimap.tasks.common.task_initdb", [items])
+    # requested by imposm-watcher once imposm changed these items OSM data (buildings or boundaries): responses
+    # depending on it are already outdated, not only once initdb completes
+    data_version.bump([data_version.department_of(x) for x in items])
+    # only create a new task if none already exists, steps already done are skipped unless forced
+    args = (items, True) if body.get("force") else (items,)
+    (task_id, created) = task_registry.submit(task_initdb, *args)
 
-    if task_id:
+    if not created:
         current_app.logger.info(
             f"Returning an already running initdb request for {', '.join(items)}: {task_id}"
         )
-    else:
-        # only create a new task if none already exists
-        task_id = task_initdb.delay(items).id
 
     return (
         {"task_id": task_id},
         202,
         {"Location": url_for("app_routes.api_tasks_status", task_id=task_id)},
     )
+
+
+@bp.route("/initdb", methods=["GET"])
+def api_initdb_status():
+    """
+    initdb steps done per department: completion date and whether it is still fresh (skipped by initdb)
+    """
+    departments = request.args.get("departments")
+    return jsonify(
+        initdb_status(departments.split(",") if departments else db.get_departments())
+    )
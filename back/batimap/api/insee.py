@@ -1,25 +1,60 @@
 import json
+import math
 
-from batimap.extensions import db
-from flask import jsonify
-from geojson import Feature, FeatureCollection
+from batimap.extensions import data_version, db
+from flask import current_app, request
+from flask_smorest import abort
 
 from .routes import bp
 
+MAX_ZOOM = 20
+
+
+def zoom_tolerance(zoom):
+    """
+    Half the size in degrees of a 256px tile pixel at the given zoom: simplifying below it is not visible
+    """
+    zoom = min(max(zoom, 0), MAX_ZOOM)
+    return 360 / (256 * 2 ** zoom) / 2
+
+
+def requested_zoom(args):
+    """
+    Map zoom requested by the given query args, either as is or as a tolerance in degrees rounded to the
+    nearest zoom level, so that at most MAX_ZOOM + 1 simplified variants of a city exist. None if unset.
+    """
+    zoom = args.get("zoom", type=int)
+    tolerance = args.get("tolerance", type=float)
+    if zoom is None and tolerance is not None:
+        if not 0 < tolerance < math.inf:
+            abort(400, message=f"invalid tolerance {tolerance}")
+        zoom = round(math.log2(zoom_tolerance(0) / tolerance))
+    return None if zoom is None else min(max(zoom, 0), MAX_ZOOM)
+
 
 @bp.route("/insee/<insee>", methods=["GET"])
+@data_version.cached_response(
+    lambda insee: data_version.department_of(insee),
+    compress=True,
+    query_args=lambda args: {"zoom": requested_zoom(args)},
+)
 def api_insee(insee):
-    city = db.get_city_for_insee(insee)
-    if city:
-        geo = db.get_city_geometry(insee)[0]
-        feature = Feature(
-            properties={
-                "name": f"{city.name} - {city.insee}",
-                "date": city.import_date,
-            },
-            geometry=json.loads(geo),
-        )
-        return jsonify(
-            FeatureCollection(feature)
-        )  # fixme: no need for FeatureCollection here
-    return f"no city {insee}", 404
+    """
+    Boundary of the given city, simplified for the given map zoom (or tolerance in degrees, see requested_zoom)
+    if any
+    """
+    zoom = requested_zoom(request.args)
+    tolerance = zoom_tolerance(zoom) if zoom is not None else None
+
+    result = db.get_city_geojson(insee, tolerance)
+    if not result:
+        return f"no city {insee}", 404
+    (name, date, geometry) = result
+    properties = json.dumps({"name": f"{name} - {insee}", "date": date})
+    # geometry is already GeoJSON text, embedded as is rather than parsed and dumped again
+    # fixme: no need for FeatureCollection here
+    return current_app.response_class(
+        '{"type": "FeatureCollection", "features": {"type": "Feature", '
+        f'"geometry": {geometry}, "properties": {properties}}}}}',
+        mimetype="application/json",
+    )
@@ -0,0 +1,14 @@
+from batimap.extensions import db, overpass
+from flask import jsonify
+
+from .routes import bp
+
+
+@bp.route("/overpass/stats", methods=["GET"])
+def api_overpass_stats():
+    return jsonify(overpass.stats())
+
+
+@bp.route("/overpass/cache", methods=["GET"])
+def api_overpass_cache():
+    return jsonify({**overpass.cache_stats(), "entries": db.count_overpass_summaries()})
@@ -1,4 +1,4 @@
-from batimap.extensions import batimap, db
+from batimap.extensions import batimap, data_version, db
 from flask import jsonify, request
 from flask_restful import inputs
 
@@ -6,6 +6,7 @@ from .routes import bp
 
 
 @bp.route("/status", methods=["GET"])
+@data_version.cached_response()
 def api_status() -> str:
     return jsonify(
         [{"date": x[0], "count": x[1]} for x in db.get_imports_count_per_year()]
@@ -35,5 +36,6 @@ def api_city_status(department, city) -> str:
 
 
 @bp.route("/status/by_date/<date>")
+@data_version.cached_response()
 def api_cities_for_date(date) -> str:
     return jsonify(db.get_cities_for_year(date))
@@ -1,27 +1,51 @@
 import json
 
+from batimap.extensions import task_registry
 from batimap.taskdto import TaskDTO
-from batimap.tasks.utils import list_tasks
+from batimap.taskregistry import task_result
 from celery.result import AsyncResult
-from flask import current_app, jsonify
+from flask import current_app, jsonify, Response, stream_with_context
 
 from .routes import bp
 
 
-@bp.route("/tasks/<uuid:task_id>", methods=["GET"])
-def api_tasks_status(task_id):
+def task_status(task_id):
     # task_id could be wrong, but we can not check it
-    task = AsyncResult(str(task_id))
+    task = AsyncResult(task_id)
     current_app.logger.debug(f"Check status of {task_id} => {task.status}")
-    try:
-        result = json.loads(task.result) if task.result else None
-    except Exception:
-        result = {"error": f"Task failed: {task.result}"}
-    response = {"state": task.state, "result": result}
+    return {"state": task.state, "result": task_result(task.result)}
+
+
+@bp.route("/tasks/<uuid:task_id>", methods=["GET"])
+def api_tasks_status(task_id):
+    return jsonify(task_status(str(task_id)))
+
+
+@bp.route("/tasks/<uuid:task_id>/stream", methods=["GET"])
+def api_tasks_stream(task_id):
+    """
+    Server-Sent Events stream of the task status, ended once the task is finished. Clients reconnect after
+    TASK_STREAM_TIMEOUT seconds.
+    """
+    task_id = str(task_id)
+    events = task_registry.events(
+        task_id,
+        lambda: task_status(task_id),
+        timeout=current_app.config.get("TASK_STREAM_TIMEOUT", 300),
+    )
+
+    def stream():
+        for event in events:
+            yield f"data: {json.dumps(event)}\n\n" if event else ": keepalive\n\n"
 
-    return jsonify(response)
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        # proxies must neither cache nor buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @bp.route("/tasks", methods=["GET"])
 def api_tasks():
-    return jsonify([TaskDTO(t) for t in list_tasks()])
+    return jsonify([TaskDTO(t) for t in task_registry.tasks()])
@@ -8,10 +8,14 @@ from batimap.extensions import (
     api_smorest,
     batimap,
     celery,
+    data_version,
     db,
+    download_cache,
+    listing_cache,
     odcadastre,
     overpass,
     sqlalchemy,
+    task_registry,
 )
 from batimap.taskdto import TaskDTO
 from flask import Flask
@@ -63,8 +67,13 @@ def create_app(db_uri=None, redis_uri=None):
 
     sqlalchemy.init_app(app)
     db.init_app(app, sqlalchemy)
-    batimap.init_app(db, overpass)
-    odcadastre.init_app(db)
+    download_cache.init_app(app)
+    data_version.init_app(app)
+    task_registry.init_app(app)
+    overpass.init_app(app)
+    listing_cache.init_app(app, download_cache)
+    batimap.init_app(db, overpass, listing_cache, data_version)
+    odcadastre.init_app(db, download_cache, data_version)
     api_smorest.init_app(app)
 
     from . import api, cli
@@ -95,7 +104,10 @@ def init_celery(app=None):
     celery.conf.task_routes = {
         "batimap.tasks.common.task_josm_data_fast": {"queue": "celery"},
         "batimap.tasks.common.task_update_insee": {"queue": "celery"},
+        "batimap.tasks.common.task_initdb_failed": {"queue": "celery"},
         "batimap.tasks.common.task_initdb": {"queue": "celery_slow"},
+        "batimap.tasks.common.task_initdb_department": {"queue": "celery_slow"},
+        "batimap.tasks.common.task_initdb_finalize": {"queue": "celery_slow"},
         "batimap.tasks.common.task_josm_data": {"queue": "celery_slow"},
     }
     celery.conf.update(app.config)
@@ -1,23 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import datetime
 import http.cookiejar
 import re
 import urllib.request
-import zlib
 from collections import Counter
 from contextlib import closing
+from functools import lru_cache, partial
 from pathlib import Path
 
 import requests
+from batimap import listings
 from batimap.db import City
-from bs4 import BeautifulSoup, SoupStrainer
 from flask import current_app
 
 
 class Batimap(object):
     MIN_BUILDINGS_COUNT = 50
+    # number of cities stats written per transaction
+    CITY_STATS_COMMIT_BATCH = 20
     IGNORED_SIMPLIFIED_TAGS = [
         "historic",
         "power",
@@ -40,10 +41,13 @@ class Batimap(object):
         "wayside_shrine",
     ]
     cadastre_src2date_regex = re.compile(r".*(cadastre)?.*(20\d{2}).*(?(1)|cadastre).*")
+    year_regex = re.compile(r"^(\d{4})$")
 
-    def init_app(self, db, overpass):
+    def init_app(self, db, overpass, listing_cache, data_version):
         self.db = db
         self.overpass = overpass
+        self.listing_cache = listing_cache
+        self.data_version = data_version
 
     def stats(
         self,
@@ -80,10 +84,58 @@ class Batimap(object):
             current_app.logger.info(
                 f"Using overpass for {len(unknown_insees)} unknown cities: {unknown_insees}"
             )
-            for idx, _ in enumerate(
-                self.stats(names_or_insees=unknown_insees, force=True)
+            cities = {c.insee: c for c in self.db.get_cities_for_insees(unknown_insees)}
+            missing = sorted(set(unknown_insees) - cities.keys())
+            if missing:
+                current_app.logger.warning(
+                    f"Villes inconnues absentes de la base: {missing}"
+                )
+            # cities which could not be dated
+            failed = []
+            (idx, total) = (0, len(cities))
+            # cities which did not change since their last overpass query need no full one
+            changes_tracked = self.db.has_building_stats()
+            for insee in sorted(cities.keys()):
+                summary = self.__cached_city_summary(cities[insee], changes_tracked)
+                if summary is not None:
+                    self.__apply_city_summary(cities.pop(insee), summary)
+                    idx += 1
+                    yield (idx, total)
+
+            osm_ids = self.db.get_osm_ids(list(cities.keys()))
+            # cities are queried by batches, pinning their areas by id
+            batch = [(insee, osm_ids[insee]) for insee in cities if insee in osm_ids]
+            for (insee, elements, osm_base) in self.overpass.get_cities_buildings(
+                batch,
+                current_app.config.get("OVERPASS_BATCH_SIZE", 10),
+                self.IGNORED_SIMPLIFIED_TAGS,
             ):
-                yield (idx + 1, len(unknown_insees))
+                if elements is None:
+                    current_app.logger.info(
+                        f"Requête groupée impossible pour l'INSEE {insee}, requête individuelle"
+                    )
+                    city = self.__query_city_date(cities[insee])
+                else:
+                    self.overpass.record_cache_access("misses")
+                    city = self.__set_city_date(
+                        cities[insee], elements, {"timestamp_osm_base": osm_base}
+                    )
+                if city is None:
+                    failed.append(insee)
+                idx += 1
+                yield (idx, total)
+
+            # cities without a known boundary are looked up by INSEE, one by one
+            for insee in sorted(cities.keys() - osm_ids.keys()):
+                if self.__query_city_date(cities[insee]) is None:
+                    failed.append(insee)
+                idx += 1
+                yield (idx, total)
+
+            if failed:
+                current_app.logger.warning(
+                    f"Impossible de dater {len(failed)} villes inconnues: {sorted(failed)}"
+                )
 
     def update_departments_raster_state(self, departments):
         url = "https://www.cadastre.gouv.fr/scpc/rechercherPlan.do"
@@ -107,64 +159,63 @@ class Batimap(object):
             current_app.logger.info(
                 f"Récupération des infos cadastrales pour le département {d}"
             )
-            if (
-                len(self.db.get_cities_for_department(d)) > 0
-                and self.db.get_raster_cities_count(d) == 0
-            ):
+            d = f"{d}"
+            dept = d.zfill(2)
+            cities = {c.insee: c for c in self.db.get_cities_for_department(dept)}
+            if len(cities) > 0 and not any(c.is_raster for c in cities.values()):
                 current_app.logger.info(
                     f"Le département {d} ne contient que des communes vectorisées, rien à vérifier"
                 )
+                yield idx + 1
                 continue
-            d = f"{d}"
+            osm_names = self.db.get_osm_city_names_for_department(dept)
             r2 = op.open(
                 f"https://www.cadastre.gouv.fr/scpc/listerCommune.do?CSRF_TOKEN={csrf_token}"
                 f"&codeDepartement={d.zfill(3)}&libelle=&keepVolatileSession=&offset=5000"
             )
-            cities = SoupStrainer("tbody", attrs={"class": "parcelles"})
-            fr = BeautifulSoup(
-                zlib.decompress(r2.read(), 16 + zlib.MAX_WBITS),
-                "lxml",
-                parse_only=cities,
+            rows = listings.parse_cadastre_listing(
+                listings.iter_chunks(r2),
+                gzipped=r2.headers.get("Content-Encoding") == "gzip",
+                encoding=r2.headers.get_content_charset(),
             )
-            current_app.logger.debug(f"Query result: {fr.prettify()}")
-            for next_city in fr.find_all("tbody"):
-                y = next_city.find(title="Ajouter au panier")
-                if not y:
-                    continue
-                current_app.logger.debug(f"Parsing next city: {next_city}")
-
-                # y.get('onclick') structure: "ajoutArticle('CL098','VECT','COMU');"
-                (_, code_commune, _, format_type, _, _, _) = y.get("onclick").split("'")
-
-                # e.strong.string structure: "COBONNE (26400) "
-                commune_cp = next_city.strong.string
-                nom_commune = commune_cp[:-9]
+            values = {}
+            for (code_commune, format_type, nom_commune, _) in rows:
+                current_app.logger.debug(
+                    f"Parsing next city: {code_commune} {format_type} {nom_commune}"
+                )
 
-                dept = d.zfill(2)
                 start = len(dept) - 5
                 insee = dept + code_commune[start:]
                 is_raster = format_type == "IMAG"
 
-                name = self.db.get_osm_city_name_for_insee(insee)
+                name = osm_names.get(insee)
                 if not name:
                     current_app.logger.error(
                         f"Cannot find city with insee {insee}, did you import OSM data for this department?"
                     )
                     continue
 
-                city = self.db.get_city_for_insee(insee)
-                if not city:
-                    city = City(insee=insee)
-                    self.db.session.add(city)
-                city.department = dept
-                city.name = name
-                city.name_cadastre = f"{code_commune}-{nom_commune}"
-                city.import_date = (
-                    "raster" if is_raster else city.import_date or "never"
-                )
-                city.is_raster = is_raster
+                if insee in values:
+                    import_date = values[insee]["import_date"]
+                else:
+                    import_date = cities[insee].import_date if insee in cities else None
+                values[insee] = {
+                    "insee": insee,
+                    "department": dept,
+                    "name": name,
+                    "name_cadastre": f"{code_commune}-{nom_commune}",
+                    "import_date": "raster" if is_raster else import_date or "never",
+                    "is_raster": is_raster,
+                }
             current_app.logger.debug("Inserting cities in database…")
-            self.db.session.commit()
+            (inserted, changed, unchanged) = self.db.commit_with_retries(
+                partial(self.__upsert_cities, cities, list(values.values()))
+            )
+            current_app.logger.info(
+                f"Infos cadastrales du département {d}: {inserted} communes ajoutées, "
+                f"{changed} modifiées, {unchanged} inchangées"
+            )
+            self.data_version.bump([dept])
             yield idx + 1
 
     def fetch_departments_osm_state(self, departments):
@@ -175,65 +226,83 @@ class Batimap(object):
             current_app.logger.info(
                 f"Récupération du statut OSM pour le département {d}"
             )
-            url = "https://cadastre.openstreetmap.fr"
-            dept = d.zfill(3)
-            r = requests.get(f"{url}/data/{dept}/")
-            bs = BeautifulSoup(r.content, "lxml")
             refresh_city_tiles = []
 
             cities = self.db.get_cities_for_department(d)
-            no_cadastre_cities = [c for c in cities]  # copy
-            cities_name_cadastre = [c.name_cadastre for c in cities]
-
-            for e in bs.select("tr"):
-                osm_data = e.select("td > a")
-                if len(osm_data):
-                    osm_data = osm_data[0].text
-                    if (
-                        not osm_data.endswith("simplifie.osm")
-                        or "-extrait-" in osm_data
-                    ):
-                        continue
-
-                    name_cadastre = "-".join(osm_data.split("-")[:-2])
-                    try:
-                        date_cadastre = datetime.datetime.strptime(
-                            e.select("td:nth-of-type(3)")[0].text.strip(),
-                            "%Y-%m-%d %H:%M",
-                        )
-                    except Exception:
-                        date_cadastre = datetime.datetime.strptime(
-                            e.select("td:nth-of-type(3)")[0].text.strip(),
-                            "%d-%b-%Y %H:%M",
-                        )
-
-                    try:
-                        name_index = cities_name_cadastre.index(name_cadastre)
-                    except ValueError:
-                        current_app.logger.warning(
-                            f"City {name_cadastre} could not be found?! Ignoring for now..."
-                        )
-                        continue
-
-                    c = cities[name_index]
-                    no_cadastre_cities.remove(c)
-                    if c.date_cadastre != date_cadastre:
-                        current_app.logger.info(
-                            f"Cadastre changed changed for {c} from {c.date_cadastre} to {date_cadastre}"
-                        )
-                        refresh_city_tiles.append(c.insee)
-                        c.date_cadastre = date_cadastre
+            cities_per_name_cadastre = {}
+            for c in cities:
+                cities_per_name_cadastre.setdefault(c.name_cadastre, c)
+            # cities that are not listed on the website anymore have no cadastre date
+            dates_cadastre = {}
+
+            for (
+                name_cadastre,
+                _,
+                osm_data,
+                date_cadastre,
+            ) in self.listing_cache.osm_listing(d.zfill(3)):
+                if not osm_data.endswith("simplifie.osm") or "-extrait-" in osm_data:
+                    continue
+                if not date_cadastre:
+                    current_app.logger.warning(
+                        f"Invalid cadastre date for {osm_data}?! Ignoring for now..."
+                    )
+                    continue
 
-            for c in no_cadastre_cities:
-                # removing date for cities that are not listed on the website anymore
-                c.date_cadastre = None
+                c = cities_per_name_cadastre.get(name_cadastre)
+                if not c:
+                    current_app.logger.warning(
+                        f"City {name_cadastre} could not be found?! Ignoring for now..."
+                    )
+                    continue
 
-            self.db.session.commit()
+                dates_cadastre[c.insee] = date_cadastre
+                if c.date_cadastre != date_cadastre:
+                    current_app.logger.info(
+                        f"Cadastre changed changed for {c} from {c.date_cadastre} to {date_cadastre}"
+                    )
+                    refresh_city_tiles.append(c.insee)
+
+            (_, changed, unchanged) = self.db.commit_with_retries(
+                partial(
+                    self.__upsert_cities,
+                    {c.insee: c for c in cities},
+                    [
+                        {"insee": c.insee, "date_cadastre": dates_cadastre.get(c.insee)}
+                        for c in cities
+                    ],
+                )
+            )
+            current_app.logger.info(
+                f"Statut OSM du département {d}: {changed} communes modifiées, {unchanged} inchangées"
+            )
+            self.data_version.bump([d])
 
             for insee in refresh_city_tiles:
                 self.clear_tiles(insee)
             yield idx + 1
 
+    def __upsert_cities(self, cities, values):
+        """
+        Writes cities values (dicts of City attributes) in a single batch, skipping unchanged cities.
+        cities are the current City objects, indexed per INSEE.
+
+        Returns (inserted, changed, unchanged) counts
+        """
+        inserted = [v for v in values if v["insee"] not in cities]
+        changed = [
+            v
+            for v in values
+            if v["insee"] in cities
+            and any(getattr(cities[v["insee"]], k) != x for (k, x) in v.items())
+        ]
+        self.db.upsert_cities(inserted + changed)
+        return (
+            len(inserted),
+            len(changed),
+            len(values) - len(inserted) - len(changed),
+        )
+
     def josm_data(self, insee):
         c = self.db.get_city_for_insee(insee)
         if not c:
@@ -269,16 +338,12 @@ class Batimap(object):
 
         url = "https://cadastre.openstreetmap.fr"
         dept = city.department.zfill(3)
-        r = requests.get(f"{url}/data/{dept}/")
-        bs = BeautifulSoup(r.content, "lxml")
-
         if not force:
             archive = f"{city.name_cadastre.upper()}-houses-simplifie.osm"
-            for e in bs.find_all("tr"):
-                if archive in [x.text for x in e.select("td:nth-of-type(2) a")]:
-                    date = e.select("td:nth-of-type(3)")[0].text.strip()
+            for row in self.listing_cache.osm_listing(dept):
+                if row.name == archive:
                     current_app.logger.info(
-                        f"{city.name_cadastre} was already generated at {date}, no need to regenerate it!"
+                        f"{city.name_cadastre} was already generated at {row.date}, no need to regenerate it!"
                     )
                     return
 
@@ -293,40 +358,44 @@ class Batimap(object):
             f"Querying cadastre for {city} ({city.name_cadastre}) - {data}"
         )
         # otherwise we invoke Cadastre generation
-        with closing(requests.post(url, data=data, stream=True)) as r:
-            (total_y, total) = (0, 0)
-            for line in r.iter_lines(decode_unicode=True):
-                match = self.__total_pdfs_regex.match(line)
-                if match:
-                    total_y = int(match.groups()[1])
-                    total = int(match.groups()[2])
-                match = self.__pdf_progression_regex.match(line)
-                if match:
-                    x = int(match.groups()[0])
-                    y = int(match.groups()[1])
-                    current = x * total_y + y
-                    msg = (
-                        f"{city} - {current}/{total} ({current * 100.0 / total:.2f}%)"
-                        if total > 0
-                        else f"{current}"
-                    )
-                    current_app.logger.info(msg)
-                    yield current * 100 / total
-
-                if "Termin" in line:
-                    current = total
-                    msg = (
-                        f"{city} - {current}/{total} ({current * 100.0 / total:.2f}%)"
-                        if total > 0
-                        else f"{current}"
-                    )
-                    current_app.logger.info(msg)
-                    yield 100
-                    return
-                elif "ERROR:" in line or "ERREUR:" in line:
-                    current_app.logger.error(line)
-                    # may happen when cadastre.gouv.fr is in maintenance mode
-                    raise Exception(line)
+        try:
+            with closing(requests.post(url, data=data, stream=True)) as r:
+                (total_y, total) = (0, 0)
+                for line in r.iter_lines(decode_unicode=True):
+                    match = self.__total_pdfs_regex.match(line)
+                    if match:
+                        total_y = int(match.groups()[1])
+                        total = int(match.groups()[2])
+                    match = self.__pdf_progression_regex.match(line)
+                    if match:
+                        x = int(match.groups()[0])
+                        y = int(match.groups()[1])
+                        current = x * total_y + y
+                        msg = (
+                            f"{city} - {current}/{total} ({current * 100.0 / total:.2f}%)"
+                            if total > 0
+                            else f"{current}"
+                        )
+                        current_app.logger.info(msg)
+                        yield current * 100 / total
+
+                    if "Termin" in line:
+                        current = total
+                        msg = (
+                            f"{city} - {current}/{total} ({current * 100.0 / total:.2f}%)"
+                            if total > 0
+                            else f"{current}"
+                        )
+                        current_app.logger.info(msg)
+                        yield 100
+                        return
+                    elif "ERROR:" in line or "ERREUR:" in line:
+                        current_app.logger.error(line)
+                        # may happen when cadastre.gouv.fr is in maintenance mode
+                        raise Exception(line)
+        finally:
+            # the listing changes once the generation is over (or was refused)
+            self.listing_cache.invalidate(dept)
 
         # we should never raise this statement. However it may happen when you
         # do the same request twice - the response is returning 200 OK while
@@ -343,44 +412,137 @@ class Batimap(object):
 
     def __compute_city_date(self, city):
         """
-        Compute the latest import date for given city via an overpass query
+        Compute the latest import date for given city via an overpass query, unless changes since the last one
+        could be merged into it.
+        The city was usually just imported: imposm may not have applied the import yet, so the last summary is
+        not trusted as is.
         """
+        summary = self.__cached_city_summary(city, False)
+        if summary is not None:
+            return self.__apply_city_summary(city, summary)
+        return self.__query_city_date(city) or city
+
+    def __query_city_date(self, city):
+        """
+        Compute the latest import date for given city out of all its buildings, see __set_city_date
+        """
+        self.overpass.record_cache_access("misses")
+        meta = {}
+        buildings = self.overpass.get_city_buildings(
+            city, self.IGNORED_SIMPLIFIED_TAGS, meta
+        )
+        return self.__set_city_date(city, buildings, meta)
+
+    def __cached_city_summary(self, city, changes_tracked):
+        """
+        Returns the buildings summary of given city from its last overpass query, only asking overpass for
+        buildings modified since its timestamp_osm_base if imposm changed the city, or if imposm changes are not
+        tracked (see Db.has_building_stats). None if a full overpass query is needed.
+        """
+        summary = self.db.get_overpass_summary(city.insee) if changes_tracked else None
+        if summary is not None:
+            self.overpass.record_cache_access("hits")
+            return summary
+
+        last = self.db.get_last_overpass_summary(city.insee)
+        elements = self.db.get_overpass_elements(city.insee) if last else None
+        if elements is None:
+            return None
+        meta = {}
+        changes = self.overpass.get_city_buildings_since(
+            city, last.osm_base, meta, self.IGNORED_SIMPLIFIED_TAGS
+        )
+        (summary, elements) = self.__summarize_buildings(city, changes, elements)
+        if summary is None:
+            return None
+        # deleted buildings are not reported by overpass, only the current buildings count
+        if summary["osm_buildings"] != meta.get("buildings"):
+            current_app.logger.info(
+                f"Buildings of {city} were deleted since {last.osm_base}, querying all of them"
+            )
+            return None
+
+        self.overpass.record_cache_access("refreshes")
+        if meta.get("timestamp_osm_base"):
+            self.db.save_overpass_summary(
+                city.insee, meta["timestamp_osm_base"], summary, elements
+            )
+        return summary
+
+    def __set_city_date(self, city, overpass_buildings, meta):
+        """
+        Compute the latest import date for given city out of its overpass buildings (BuildingElement),
+        the summary is kept for later refreshes if meta contains the Overpass timestamp_osm_base.
+        Returns the city, or None if its buildings could not be fetched
+        """
+        (summary, elements) = self.__summarize_buildings(city, overpass_buildings)
+        if summary is None:
+            return None
+        if meta.get("timestamp_osm_base"):
+            self.db.save_overpass_summary(
+                city.insee, meta["timestamp_osm_base"], summary, elements
+            )
+        return self.__apply_city_summary(city, summary)
+
+    def __summarize_buildings(self, city, overpass_buildings, previous=None):
+        """
+        Summarizes the overpass buildings of a city: buildings count, buildings per year and simplified buildings.
+        Returns (summary, elements), elements being the year of every building (see CityOverpassElements), or
+        (None, None) if buildings could not be fetched.
+        If previous elements are given, overpass buildings are the ones which changed since and are merged into them.
+        """
+        elements = dict(previous) if previous else {}
         try:
-            buildings = []
-            simplified_buildings = []
             # iterate on every building
-            overpass_buildings = self.overpass.get_city_buildings(city)
-            city.osm_buildings = len(overpass_buildings)
-            # we do not want to compute buildings import date for raster city,
-            # since for now we consider it cannot be imported
-            if city.is_raster:
-                simplified_buildings = []
-                sources_date = ["raster"] * city.osm_buildings
-            else:
-                for element in overpass_buildings:
-                    tags = element.get("tags")
-                    if element.get("type") == "node":
-                        # some buildings are mainly nodes, but we don't care much about them
-                        if len(
-                            [x for x in self.IGNORED_SIMPLIFIED_TAGS if tags.get(x)]
-                        ):
-                            continue
-                        if (
-                            tags.get("building")
-                            in self.IGNORED_SIMPLIFIED_BUILDING_VALUES
-                        ):
-                            continue
+            for element in overpass_buildings:
+                key = element.type[0] + str(element.id)
+                elements[key] = element.timestamp[:4]
+                if element.type == "node":
+                    # some buildings are mainly nodes, but we don't care much about them
+                    if len(
+                        [x for x in self.IGNORED_SIMPLIFIED_TAGS if element.tags.get(x)]
+                    ):
+                        elements[key] = None
+                        continue
+                    if (
+                        element.tags.get("building")
+                        in self.IGNORED_SIMPLIFIED_BUILDING_VALUES
+                    ):
+                        elements[key] = None
+                        continue
 
+                    # we do not want to compute buildings import date for raster city,
+                    # since for now we consider it cannot be imported
+                    if not city.is_raster:
                         current_app.logger.info(
                             f"{city} contient des bâtiments avec une géométrie simplifiée {element}, "
                             "import probablement jamais réalisé"
                         )
-                        simplified_buildings.append(element.get("id"))
+        except Exception as e:
+            current_app.logger.error(f"Failed to count buildings for {city}: {e}")
+            return (None, None)
+        summary = {
+            "osm_buildings": len(elements),
+            "dates": dict(Counter(y for y in elements.values() if y)),
+            "simplified": [
+                int(key[1:]) for (key, y) in elements.items() if key[0] == "n" and y
+            ],
+        }
+        return (summary, elements)
 
-                    buildings.append(element.get("timestamp")[:4])
-                has_simplified = len(simplified_buildings) > 0
+    def __apply_city_summary(self, city, summary):
+        """
+        Sets the import date and details of given city out of its buildings summary
+        """
+        try:
+            city.osm_buildings = summary["osm_buildings"]
+            if city.is_raster:
+                simplified_buildings = []
+                sources_date = ["raster"] * city.osm_buildings
+            else:
+                simplified_buildings = summary["simplified"]
                 (import_date, sources_date) = self.__date_for_buildings(
-                    city, buildings, has_simplified
+                    city, Counter(summary["dates"]), len(simplified_buildings) > 0
                 )
                 city.import_date = import_date
             city.import_details = {
@@ -388,24 +550,34 @@ class Batimap(object):
                 "dates": sources_date,
             }
             self.db.session.commit()
+            self.data_version.bump([city.department])
         except Exception as e:
             current_app.logger.error(f"Failed to count buildings for {city}: {e}")
         return city
 
-    def __date_for_buildings(self, city, dates, has_simplified_buildings):
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def __source_to_date(source):
         """
-        Computes the city import date, given a list of buildings date
+        Extracts the import date out of a building source (or date). There are only a few dozen distinct
+        sources per department, so the mapping is memoized
         """
-        sources_date = []
-        for b in dates:
-            source = (b or "unknown").lower()
-            date = re.sub(self.cadastre_src2date_regex, r"\2", source)
-            sources_date.append(date)
-        counter = Counter(sources_date)
-
-        date = max(counter, key=sources_date.count) if len(sources_date) else "never"
+        return re.sub(
+            Batimap.cadastre_src2date_regex, r"\2", (source or "unknown").lower()
+        )
+
+    def __date_for_buildings(self, city, sources, has_simplified_buildings):
+        """
+        Computes the city import date, given a histogram of buildings source (or date) -> buildings count
+        """
+        counter = Counter()
+        for source, count in sources.items():
+            counter[self.__source_to_date(source)] += count
+        buildings_count = sum(counter.values())
+
+        date = max(counter, key=counter.get) if buildings_count else "never"
         if date != "never" and date != "raster":
-            date_match = re.compile(r"^(\d{4})$").match(date)
+            date_match = self.year_regex.match(date)
             date = (
                 date_match.groups()[0]
                 if date_match and date_match.groups()
@@ -415,13 +587,13 @@ class Batimap(object):
             # it was never imported (sometime only 1 building on the boundary is wrongly computed)
             # Almost all cities have at least church/school/townhall manually mapped
             if (
-                len(dates) < self.MIN_BUILDINGS_COUNT
+                buildings_count < self.MIN_BUILDINGS_COUNT
                 and city.cadastre
                 and city.cadastre.od_buildings
-                > max(self.MIN_BUILDINGS_COUNT, 1.5 * len(dates))
+                > max(self.MIN_BUILDINGS_COUNT, 1.5 * buildings_count)
             ):
                 current_app.logger.info(
-                    f"City {city}: too few buildings found ({len(dates)}), assuming it was never imported!"
+                    f"City {city}: too few buildings found ({buildings_count}), assuming it was never imported!"
                 )
                 date = "never"
             elif has_simplified_buildings:
@@ -438,55 +610,52 @@ class Batimap(object):
             current_app.logger.debug(
                 f"Calcul des statistiques du bâti pour l'INSEE {insee_in}…"
             )
-            result = self.db.get_building_dates_per_city_for_insee(insee_in)
+            result = self.db.get_building_stats_per_city_for_insee(
+                insee_in,
+                self.IGNORED_SIMPLIFIED_BUILDING_VALUES,
+                self.IGNORED_SIMPLIFIED_TAGS,
+            )
             current_app.logger.debug(
                 f"Calcul des statistiques du bâti pour l'INSEE {insee_in}: {result}"
             )
 
+            # histogram of buildings source -> count and simplified buildings for each city
             buildings_per_insee = {}
+            simplified_per_insee = {}
             insee_name = {}
-            for (insee, name, source, count, is_raster) in result:
+            for (insee, name, source, count, is_raster, simplified) in result:
                 insee_name[insee] = name
                 if not buildings_per_insee.get(insee):
-                    buildings_per_insee[insee] = []
-                buildings_per_insee[insee] += [
-                    "raster" if is_raster else source
-                ] * count
+                    buildings_per_insee[insee] = Counter()
+                buildings_per_insee[insee]["raster" if is_raster else source] += count
+                if simplified:
+                    simplified_per_insee.setdefault(insee, set()).update(simplified)
 
-            # 2. fetch all simplified buildings in current insee
-            current_app.logger.debug(
-                f"Récupération du bâti simplifié pour l'INSEE {insee_in}…"
-            )
-            city_with_simplified_building = (
-                self.db.get_point_buildings_per_city_for_insee(
-                    insee_in,
-                    self.IGNORED_SIMPLIFIED_BUILDING_VALUES,
-                    self.IGNORED_SIMPLIFIED_TAGS,
-                )
-            )
-
-            simplified_cities = list(set([x[0] for x in city_with_simplified_building]))
-            if len(simplified_cities) > 0:
+            if len(simplified_per_insee) > 0:
                 current_app.logger.info(
-                    f"Les villes {simplified_cities} contiennent des bâtiments avec une géométrie simplifiée, "
-                    "import à vérifier"
+                    f"Les villes {list(simplified_per_insee)} contiennent des bâtiments avec une géométrie "
+                    "simplifiée, import à vérifier"
                 )
 
-            # 3. finally compute city import date and update database
+            # 2. finally compute city import date and update database
             current_app.logger.debug(
                 f"Mise à jour des statistiques pour l'INSEE {insee_in}…"
             )
+            cities = {
+                c.insee: c
+                for c in self.db.get_cities_for_insees(list(buildings_per_insee))
+            }
+            updates = {}
             for insee, buildings in buildings_per_insee.items():
-                city = self.db.get_city_for_insee(insee)
-                city.name = insee_name[insee]
+                city = cities[insee]
+                update = updates[insee] = {"name": insee_name[insee]}
+                buildings_count = sum(buildings.values())
                 if set(buildings) != set(["raster"]):
                     # compute city import date based on all its buildings date
+                    simplified = sorted(simplified_per_insee.get(insee, []))
                     (import_date, counts) = self.__date_for_buildings(
-                        city, buildings, insee in simplified_cities
+                        city, buildings, len(simplified) > 0
                     )
-                    simplified = [
-                        x[1] for x in city_with_simplified_building if x[0] == insee
-                    ]
                     # do not erase date if what we found here is a bad date (unknown)
                     if city.import_date != import_date and (
                         city.import_date in City.bad_dates()
@@ -499,11 +668,26 @@ class Batimap(object):
                         )
                         current_app.logger.info(
                             f"Mise à jour pour l'INSEE {insee}: {city.import_date} -> "
-                            f"{import_date} ({len(buildings)} bâtis{simplified_msg})"
+                            f"{import_date} ({buildings_count} bâtis{simplified_msg})"
                         )
-                        city.import_date = import_date
-                    city.import_details = {"dates": counts, "simplified": simplified}
-                city.osm_buildings = len(buildings)
-
-            self.db.session.commit()
+                        update["import_date"] = import_date
+                    update["import_details"] = {
+                        "dates": counts,
+                        "simplified": simplified,
+                    }
+                update["osm_buildings"] = buildings_count
+
+            def apply_updates(batch):
+                for insee in batch:
+                    for (key, value) in updates[insee].items():
+                        setattr(cities[insee], key, value)
+
+            # cities are committed by small batches: triggers lock summaries rows shared with other
+            # departments processed concurrently until the commit
+            updated = list(updates)
+            batch_size = self.CITY_STATS_COMMIT_BATCH
+            for start in range(0, len(updated), batch_size):
+                end = start + batch_size
+                self.db.commit_with_retries(partial(apply_updates, updated[start:end]))
+            self.data_version.bump([c.department for c in cities.values()])
             yield idx + 1
@@ -17,6 +17,16 @@ class CityDTO:
         self.od_buildings = city.cadastre.od_buildings if city.cadastre else None
         self.josm_ready = city.is_josm_ready()
 
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a DTO out of a row of CityDTO fields (see Db.get_city_dto_for_insee), without loading the city.
+        Only the selected fields are serialized.
+        """
+        dto = cls.__new__(cls)
+        dto.__dict__.update(row._asdict())
+        return dto
+
     @property
     def __geo_interface__(self):
         return self.__dict__
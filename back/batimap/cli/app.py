@@ -1,8 +1,9 @@
 from pathlib import Path
 
 import click
+from batimap.db import InitdbCheckpoint
 from batimap.extensions import batimap, db, odcadastre
-from batimap.tasks.common import task_initdb
+from batimap.tasks.common import initdb_status, task_initdb
 from flask import Blueprint
 
 bp = Blueprint("app_cli", __name__, cli_group=None)
@@ -10,14 +11,34 @@ bp = Blueprint("app_cli", __name__, cli_group=None)
 
 @bp.cli.command("initdb")
 @click.argument("insees", nargs=-1)
-def initdb_command(insees):
+@click.option("--force", is_flag=True, help="Do not skip steps already done")
+def initdb_command(insees, force):
     """
     Fetch OSM and Cadastre data for given departments/cities INSEE.
     """
-    task_initdb(insees or db.get_departments())
+    task_initdb(insees or db.get_departments(), force)
     click.echo("done")
 
 
+@bp.cli.command("initdb-status")
+@click.argument("departments", nargs=-1)
+def initdb_status_command(departments):
+    """
+    Show the initdb steps done on given (or all) departments.
+    """
+    status = initdb_status(departments or db.get_departments())
+    for (department, phases) in sorted(status.items()):
+        done = [
+            phase
+            for phase in InitdbCheckpoint.PHASES
+            if phases.get(phase, {}).get("fresh")
+        ]
+        pending = [phase for phase in InitdbCheckpoint.PHASES if phase not in done]
+        click.echo(
+            f"{department}: done={','.join(done) or '-'} pending={','.join(pending) or '-'}"
+        )
+
+
 @bp.cli.command("stats")
 @click.argument("items", nargs=-1)
 @click.option("--fast", is_flag=True)
@@ -78,3 +99,96 @@ def cadastre_command(cities, all):
     else:
         for insee in clear:
             batimap.clear_tiles(insee)
+
+
+@bp.cli.command("buildingstats")
+@click.argument("departments", nargs=-1)
+@click.option("--check", is_flag=True)
+def building_stats_command(departments, check):
+    """
+    Rebuild buildings stats maintained from imposm diffs for given departments (all by default).
+    With --check, compare them to stats computed from OSM buildings instead.
+    """
+    if check:
+        errors = 0
+        for department in departments or db.get_departments():
+            mismatches = db.check_building_stats(
+                department,
+                batimap.IGNORED_SIMPLIFIED_BUILDING_VALUES,
+                batimap.IGNORED_SIMPLIFIED_TAGS,
+            )
+            for mismatch in mismatches:
+                click.echo(mismatch)
+            errors += len(mismatches)
+        click.echo(f"{errors} mismatches found")
+        if errors:
+            raise click.exceptions.Exit(1)
+        return
+
+    if departments and not db.has_building_stats():
+        click.echo(
+            "Buildings stats are not maintained yet, run a full rebuild (without departments) first!"
+        )
+        raise click.exceptions.Exit(1)
+
+    db.install_building_stats(
+        batimap.IGNORED_SIMPLIFIED_BUILDING_VALUES, batimap.IGNORED_SIMPLIFIED_TAGS
+    )
+    if departments:
+        for department in departments:
+            click.echo(f"Rebuilding buildings stats for department {department}")
+            db.rebuild_building_stats(department)
+    else:
+        click.echo("Rebuilding buildings stats for all cities")
+        db.rebuild_building_stats()
+    click.echo("done")
+
+
+@bp.cli.command("citypriority")
+@click.option(
+    "--if-missing", is_flag=True, help="Only if its triggers are not installed"
+)
+def city_priority_command(if_missing):
+    """
+    Install the triggers maintaining the import priority of cities, and rebuild it.
+    """
+    if if_missing and db.has_city_priority():
+        click.echo("City priority is already maintained")
+        return
+    click.echo("Rebuilding city priority")
+    db.install_city_priority()
+    click.echo("done")
+
+
+@bp.cli.command("importstats")
+@click.option(
+    "--if-missing", is_flag=True, help="Only if its triggers are not installed"
+)
+def import_stats_command(if_missing):
+    """
+    Install the triggers maintaining import stats per department and map cell, and rebuild them.
+    """
+    if if_missing and db.has_import_stats():
+        click.echo("Import stats are already maintained")
+        return
+    click.echo("Rebuilding import stats")
+    db.install_import_stats()
+    click.echo("done")
+
+
+@bp.cli.command("simplifiedbuildings")
+@click.option("--if-missing", is_flag=True, help="Only if its trigger is not installed")
+def simplified_buildings_command(if_missing):
+    """
+    Migrate import details to JSONB if needed, then install the trigger indexing simplified buildings
+    of cities, and rebuild the index.
+    """
+    if db.has_json_import_details():
+        click.echo("Migrating import details to JSONB")
+        db.migrate_import_details()
+    if if_missing and db.has_city_simplified_buildings():
+        click.echo("Simplified buildings are already indexed")
+        return
+    click.echo("Rebuilding simplified buildings index")
+    db.install_city_simplified_buildings()
+    click.echo("done")
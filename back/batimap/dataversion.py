@@ -0,0 +1,175 @@
+import gzip
+import hashlib
+import json
+from datetime import date
+from functools import wraps
+
+import redis
+from flask import current_app, make_response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class DataVersion(object):
+    """
+    Redis counters of the data versions, bumped whenever cities data is committed: a global one and one per
+    department. Read endpoints decorated with cached_response are answered with strong ETags derived from
+    the version they depend on, replying 304 Not Modified when the client already has the response and
+    serving it from a Redis response cache otherwise.
+    """
+
+    key_prefix = "batimap:version:"
+
+    def init_app(self, app):
+        self.redis = redis.Redis.from_url(app.config["CELERY_BROKER_URL"])
+        # responses are keyed by version so they never get stale, the TTL only bounds the cache size
+        self.ttl = app.config.get("RESPONSE_CACHE_TTL", 24 * 3600)
+
+    @staticmethod
+    def department_of(insee):
+        return insee[:3] if insee.startswith("97") else insee[:2]
+
+    def bump(self, departments=None):
+        """
+        Records a change of the given departments data, or of all departments if None
+        """
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.incr(self.key_prefix + "all")
+                if departments is None:
+                    pipe.incr(self.key_prefix + "epoch")
+                for department in set(d for d in departments or [] if d):
+                    pipe.incr(
+                        self.key_prefix + "department:" + str(department).zfill(2)
+                    )
+                pipe.execute()
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Could not bump data version: {e}")
+
+    def version(self, department=None):
+        """
+        Returns the version of the given department data, or of all data if None.
+        None if versions are unavailable.
+        """
+        try:
+            if department is None:
+                return (self.redis.get(self.key_prefix + "all") or b"0").decode()
+            (epoch, counter) = self.redis.mget(
+                self.key_prefix + "epoch",
+                self.key_prefix + "department:" + department.zfill(2),
+            )
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Data version unavailable: {e}")
+            return None
+        return f"{int(epoch or 0)}.{int(counter or 0)}"
+
+    def cached_response(
+        self, department=None, compress=False, daily=False, query_args=None
+    ):
+        """
+        Decorator of read endpoints whose response only depends on the data version. department is a
+        function of the view arguments returning the department the response depends on, all data if unset.
+        If compress is set, responses are served gzip or brotli encoded when accepted by the client, encoded
+        bodies being cached too.
+        If daily is set, responses also depend on the current day (eg. data freshness computed as of its
+        start), hence are only cached until its end.
+        query_args is a function of the request query args returning the normalized ones the response depends
+        on: requests with equivalent query strings then share their cached response. It may abort invalid
+        requests. The whole query string is used by default.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                version = self.version(department(**kwargs) if department else None)
+                if version is None:
+                    return view(*args, **kwargs)
+
+                if daily:
+                    version += f"@{date.today().isoformat()}"
+                path = (
+                    f"{request.path}?{sorted(query_args(request.args).items())}"
+                    if query_args
+                    else request.full_path
+                )
+                key = hashlib.sha1(f"{path}\n{version}".encode()).hexdigest()
+                encoding = self.__accepted_encoding() if compress else None
+                # each encoding is a distinct representation, with its own strong ETag
+                etag = f"{key}-{encoding}" if encoding else key
+                if request.if_none_match.contains(etag):
+                    response = make_response("", 304)
+                else:
+                    response = self.__cached_response(
+                        self.key_prefix + "response:" + key,
+                        encoding,
+                        lambda: make_response(view(*args, **kwargs)),
+                    )
+                    if response.status_code != 200:
+                        return response
+                    if encoding:
+                        response.headers["Content-Encoding"] = encoding
+                if compress:
+                    response.vary.add("Accept-Encoding")
+                response.set_etag(etag)
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def __cached_response(self, key, encoding, make):
+        field = f"body:{encoding}" if encoding else "body"
+        cached = self.__get(key) or {}
+        if field.encode() in cached:
+            body = cached[field.encode()]
+        else:
+            if b"body" in cached:
+                raw = cached[b"body"]
+            else:
+                response = make()
+                if response.status_code != 200:
+                    return response
+                raw = response.get_data()
+                # the length depends on the encoding, it is computed again when served
+                cached[b"headers"] = json.dumps(
+                    [(k, v) for (k, v) in response.headers if k != "Content-Length"]
+                ).encode()
+            body = self.__encode(raw, encoding)
+            self.__set(key, {"body": raw, "headers": cached[b"headers"], field: body})
+
+        return current_app.response_class(body, headers=json.loads(cached[b"headers"]))
+
+    @staticmethod
+    def __accepted_encoding():
+        if brotli and request.accept_encodings["br"]:
+            return "br"
+        if request.accept_encodings["gzip"]:
+            return "gzip"
+        return None
+
+    @staticmethod
+    def __encode(body, encoding):
+        if encoding == "br":
+            return brotli.compress(body)
+        if encoding == "gzip":
+            return gzip.compress(body, mtime=0)
+        return body
+
+    def __get(self, key):
+        try:
+            return self.redis.hgetall(key)
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Response cache unavailable: {e}")
+            return None
+
+    def __set(self, key, entry):
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.hset(key, mapping=entry)
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Response cache unavailable: {e}")
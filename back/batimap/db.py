@@ -1,23 +1,34 @@
+import math
+import random
+import time
 from datetime import datetime, timedelta
-from typing import Any, List
+from types import SimpleNamespace
+from typing import Any, Dict, List
 
-from dateutil import parser
 from flask import current_app
 from geoalchemy2 import Geometry
 from sqlalchemy import (
+    and_,
     BigInteger,
+    bindparam,
     Boolean,
+    case,
     Column,
+    Float,
     func,
+    Index,
     Integer,
     JSON,
     not_,
+    or_,
     String,
+    text,
     TIMESTAMP,
 )
-from sqlalchemy.dialects.postgresql import HSTORE
+from sqlalchemy.dialects.postgresql import ARRAY, HSTORE, insert, JSONB
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import joinedload, relationship
 
 from .bbox import Bbox
 
@@ -52,6 +63,9 @@ class Boundary(Base):  # type: ignore
 class City(Base):  # type: ignore
     __tablename__ = "city_stats"
 
+    # cadastre data is not considered ready for JOSM anymore after that delay
+    CADASTRE_FRESHNESS = timedelta(days=30)
+
     insee = Column(String, primary_key=True)
     department = Column(String)
     name = Column(String)
@@ -59,7 +73,7 @@ class City(Base):  # type: ignore
     is_raster = Column(Boolean)
     import_date = Column(String, name="date")  # type: ignore
     date_cadastre = Column(TIMESTAMP)
-    import_details = Column(JSON, name="details")  # type: ignore
+    import_details = Column(JSONB, name="details")  # type: ignore
     osm_buildings = Column(Integer)
 
     cadastre = relationship(
@@ -95,7 +109,7 @@ class City(Base):  # type: ignore
     def is_josm_ready(self):
         return (
             self.date_cadastre is not None
-            and (datetime.now() - parser.parse(str(self.date_cadastre))).days < 30
+            and datetime.now() - self.date_cadastre < self.CADASTRE_FRESHNESS
         )
 
     @staticmethod
@@ -122,7 +136,184 @@ class Cadastre(Base):  # type: ignore
         return f"{self.insee}({self.od_buildings} buildings)"
 
 
+class CityBuildingStats(Base):  # type: ignore
+    """
+    Number of buildings per city and dated source, maintained from osm_buildings and osm_admin changes
+    """
+
+    __tablename__ = "city_building_stats"
+
+    insee = Column(String, primary_key=True)
+    dated_source = Column(String, primary_key=True)
+    buildings = Column(Integer)
+
+
+class CityPointBuilding(Base):  # type: ignore
+    """
+    Simplified (point) buildings per city, maintained from osm_buildings and osm_admin changes
+    """
+
+    __tablename__ = "city_point_buildings"
+
+    insee = Column(String, primary_key=True)
+    osm_id = Column(BigInteger, primary_key=True)
+
+
+class CitySimplifiedBuilding(Base):  # type: ignore
+    """
+    Simplified buildings listed in the import details of each city, maintained on city_stats changes
+    """
+
+    __tablename__ = "city_simplified_buildings"
+
+    insee = Column(String, primary_key=True)
+    osm_id = Column(BigInteger, primary_key=True)
+    department = Column(String)
+
+    __table_args__ = (
+        Index("city_simplified_buildings_department", department, osm_id),
+    )
+
+
+class CityChange(Base):  # type: ignore
+    """
+    Last time (UTC) imposm changed buildings or boundaries of a city, maintained with city_building_stats
+    """
+
+    __tablename__ = "city_changes"
+
+    insee = Column(String, primary_key=True)
+    changed_at = Column(TIMESTAMP)
+
+
+class CityOverpassSummary(Base):  # type: ignore
+    """
+    Buildings summary of a city computed from Overpass data as of osm_base (UTC).
+    It remains valid until imposm applies a change to that city, then only buildings modified since
+    osm_base need to be merged into it.
+    """
+
+    __tablename__ = "city_overpass_summaries"
+
+    insee = Column(String, primary_key=True)
+    osm_base = Column(TIMESTAMP)
+    summary = Column(JSON)
+
+
+class CityOverpassElements(Base):  # type: ignore
+    """
+    Year of every building ("n1", "w2"...) of a city as of its CityOverpassSummary, None for ignored nodes.
+    It is only read to merge buildings modified since into the summary, so it is kept apart from it.
+    """
+
+    __tablename__ = "city_overpass_elements"
+
+    insee = Column(String, primary_key=True)
+    elements = Column(JSON)
+
+
+class CityPriority(Base):  # type: ignore
+    """
+    Import priority of every city having a boundary and cadastre data, maintained by triggers on
+    city_stats, cadastre_stats and osm_admin so that picking the next city to import is an index lookup.
+    Cities are ordered by bucket (never, unfinished, unknown, dated, raster, no date), import date,
+    cadastre rank (fresh, outdated, never fetched) then randomly among equals.
+    """
+
+    __tablename__ = "city_priority"
+
+    BUCKETS = ["never", "unfinished", "unknown", None, "raster"]
+
+    insee = Column(String, primary_key=True)
+    bucket = Column(Integer)
+    import_date = Column(String)
+    cadastre_rank = Column(Integer)
+    cadastre_fresh_until = Column(TIMESTAMP)
+    ratio = Column(Float)
+    lon = Column(Float)
+    lat = Column(Float)
+    osm_id = Column(BigInteger)
+    random_key = Column(Float)
+    reserved_until = Column(TIMESTAMP)
+
+    __table_args__ = (
+        Index("city_priority_order", bucket, import_date, cadastre_rank, random_key),
+    )
+
+
+class CityImportStatus(Base):  # type: ignore
+    """
+    Department, import date ('' if unknown) and centroid of every city as counted in import stats summaries
+    """
+
+    __tablename__ = "city_import_status"
+
+    insee = Column(String, primary_key=True)
+    department = Column(String)
+    import_date = Column(String, name="date")  # type: ignore
+    lon = Column(Float)
+    lat = Column(Float)
+
+
+class DepartmentImportStats(Base):  # type: ignore
+    """
+    Number of cities per department and import date ('' if unknown), maintained on city_stats changes
+    """
+
+    __tablename__ = "department_import_stats"
+
+    department = Column(String, primary_key=True)
+    import_date = Column(String, name="date", primary_key=True)  # type: ignore
+    cities = Column(Integer)
+
+
+class TileImportStats(Base):  # type: ignore
+    """
+    Number of cities per import date whose centroid lies in a cell of a lon/lat grid pyramid, maintained
+    on city_stats and osm_admin changes. Level 0 cells are 1/CELLS_PER_DEGREE degree wide, each level
+    doubles their size.
+    """
+
+    __tablename__ = "tile_import_stats"
+
+    CELLS_PER_DEGREE = 16
+    LEVELS = 8
+
+    level = Column(Integer, primary_key=True)
+    x = Column(Integer, primary_key=True)
+    y = Column(Integer, primary_key=True)
+    import_date = Column(String, name="date", primary_key=True)  # type: ignore
+    cities = Column(Integer)
+
+
+class InitdbCheckpoint(Base):  # type: ignore
+    """
+    Completion of an initdb step on a whole department, along with the freshness stamp of the step input
+    data at that time. Re-running initdb skips the steps whose checkpoint is still fresh.
+    """
+
+    __tablename__ = "initdb_checkpoints"
+
+    PHASES = ["cadastre", "raster", "osm", "buildings", "unknowns"]
+
+    department = Column(String, primary_key=True)
+    phase = Column(String, primary_key=True)
+    completed_at = Column(TIMESTAMP)
+    input_stamp = Column(String)
+
+    def is_fresh(self, input_stamp, max_age: timedelta):
+        return (
+            datetime.now() - self.completed_at < max_age
+            and self.input_stamp == input_stamp
+        )
+
+
 class Db(object):
+    # viewports larger than that (in degrees from their center) are counted from tile_import_stats
+    LEGEND_EXACT_MAX_DISTANCE = 0.5
+    # maximum number of tile_import_stats cells summed for a viewport
+    LEGEND_MAX_CELLS = 256
+
     def __init__(self):
         self.is_initialized = False
 
@@ -161,6 +352,17 @@ class Db(object):
     def __flat(req):
         return [x[0] for x in req]
 
+    def __sql_array(self, values):
+        """
+        Returns the text[] SQL literal of given values, for functions bodies which cannot take bound parameters.
+        Values are quoted by PostgreSQL itself.
+        """
+        literal = self.session.execute(
+            text("SELECT quote_literal(CAST(:values AS text[]))"),
+            {"values": list(values)},
+        ).scalar()
+        return f"{literal}::text[]"
+
     @__isInitialized
     def get_osm_city_name_for_insee(self, insee) -> str:
         # there might be no result for this query, but this is OK
@@ -168,6 +370,17 @@ class Db(object):
         city = self.__filter_city(self.session.query(Boundary.name), insee).first()
         return city[0] if city else None
 
+    @__isInitialized
+    def get_osm_city_names_for_department(self, department) -> Dict[str, str]:
+        # same as get_osm_city_name_for_insee, for all cities of the department at once
+        return dict(
+            self.__filter_city(self.session.query(Boundary.insee, Boundary.name))
+            .filter(Boundary.insee.startswith(department.zfill(2)))
+            .order_by(Boundary.insee, Boundary.admin_level)
+            .distinct(Boundary.insee)
+            .all()
+        )
+
     @__isInitialized
     def get_cities(self) -> List[City]:
         return self.session.query(City).order_by(City.insee).all()
@@ -185,6 +398,63 @@ class Db(object):
     def get_city_for_insee(self, insee) -> City:
         return self.session.query(City).filter(City.insee == insee).first()
 
+    @__isInitialized
+    def get_cities_for_insees(self, insees) -> List[City]:
+        # cadastre is eagerly loaded since it is needed to compute import date
+        return (
+            self.session.query(City)
+            .options(joinedload(City.cadastre))
+            .filter(City.insee.in_(insees))
+            .order_by(City.insee)
+            .all()
+        )
+
+    @__isInitialized
+    def upsert_cities(self, values: List[dict]):
+        """
+        Inserts or updates given cities in a single INSERT ... ON CONFLICT statement.
+        values are dicts of City attributes, which must all have the same keys.
+        """
+        if not values:
+            return
+        columns = {key: City.__mapper__.columns[key].name for key in values[0]}
+        statement = insert(City.__table__).values(
+            [{columns[key]: value for (key, value) in v.items()} for v in values]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[City.__table__.c.insee],
+            set_={
+                name: statement.excluded[name]
+                for name in columns.values()
+                if name != "insee"
+            },
+        )
+        self.session.execute(statement)
+
+    @__isInitialized
+    def commit_with_retries(self, apply, attempts=5):
+        """
+        Calls apply then commits its changes, returning its result. Concurrent initdb departments update
+        shared summaries rows (through triggers) in different orders: when PostgreSQL aborts the
+        transaction to break a deadlock, it is rolled back and applied again.
+        """
+        for attempt in range(attempts):
+            try:
+                result = apply()
+                self.session.commit()
+                return result
+            except OperationalError as e:
+                self.session.rollback()
+                if (
+                    getattr(e.orig, "pgcode", None) != "40P01"
+                    or attempt == attempts - 1
+                ):
+                    raise
+                current_app.logger.warning(
+                    f"Deadlock detected, retrying (attempt {attempt + 1}/{attempts}): {e.orig}"
+                )
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
     @__isInitialized
     def get_cadastre_for_insee(self, insee) -> City:
         return self.session.query(Cadastre).filter(Cadastre.insee == insee).first()
@@ -207,6 +477,21 @@ class Db(object):
             .first()
         )
 
+    @__isInitialized
+    def get_osm_ids(self, insees) -> Dict[str, List[int]]:
+        """
+        Returns imposm ids (negative for relations) of the city boundaries of the given INSEEs, per INSEE
+        """
+        result: Dict[str, List[int]] = {}
+        for (insee, osm_id) in (
+            self.session.query(Boundary.insee, Boundary.osm_id)
+            .filter(Boundary.insee.in_(insees))
+            .filter(Boundary.admin_level.in_([8, 9]))
+            .order_by(Boundary.insee, Boundary.osm_id)
+        ):
+            result.setdefault(insee, []).append(osm_id)
+        return result
+
     @__isInitialized
     def get_insee_bbox(self, insee):
         # first() is required because of multipolygons (76218 - Doudeauville for instance)
@@ -220,26 +505,77 @@ class Db(object):
 
     @__isInitialized
     def get_imports_count_per_year(self):
+        if not self.has_import_stats():
+            return (
+                self.session.query(City.import_date, func.count(City.import_date))
+                .group_by(City.import_date)
+                .order_by(City.import_date)
+                .all()
+            )
+        # cities without import date are not counted
+        date = func.nullif(DepartmentImportStats.import_date, "")
         return (
-            self.session.query(City.import_date, func.count(City.import_date))
-            .group_by(City.import_date)
-            .order_by(City.import_date)
+            self.session.query(
+                date,
+                case(
+                    [(date.is_(None), 0)],
+                    else_=func.sum(DepartmentImportStats.cities),
+                ),
+            )
+            .group_by(DepartmentImportStats.import_date)
+            .having(func.sum(DepartmentImportStats.cities) > 0)
+            .order_by(date)
             .all()
         )
 
     @__isInitialized
     def get_imports_count_for_bbox(self, bbox: Bbox):
-        return (
-            self.__filter_city(
-                self.session.query(City.import_date, func.count(".*").label("count"))
-            )
-            .filter(Boundary.insee == City.insee)
-            .filter(
-                Boundary.geometry.ST_DWithin(  # type: ignore
-                    self.__build_srid(bbox), bbox.max_distance()
+        """
+        Counts cities per import date around given bbox. Large viewports are approximated by the cities
+        whose centroid lies in the cells of the coarsest tile_import_stats level covering the bbox with at
+        most LEGEND_MAX_CELLS cells, so that the cost does not depend on the number of cities.
+        Cities are always counted exactly while tile_import_stats is not maintained, see has_import_stats.
+        """
+        if (
+            bbox.max_distance() <= self.LEGEND_EXACT_MAX_DISTANCE
+            or not self.has_import_stats()
+        ):
+            return (
+                self.__filter_city(
+                    self.session.query(
+                        City.import_date, func.count(".*").label("count")
+                    )
                 )
+                .filter(Boundary.insee == City.insee)
+                .filter(
+                    Boundary.geometry.ST_DWithin(  # type: ignore
+                        self.__build_srid(bbox), bbox.max_distance()
+                    )
+                )
+                .group_by(City.import_date)
+                .all()
+            )
+
+        for level in range(TileImportStats.LEVELS):
+            cells = [
+                math.floor(c * TileImportStats.CELLS_PER_DEGREE / 2 ** level)
+                for c in self.__normalize(bbox)
+            ]
+            if (cells[2] - cells[0] + 1) * (
+                cells[3] - cells[1] + 1
+            ) <= self.LEGEND_MAX_CELLS:
+                break
+
+        return (
+            self.session.query(
+                func.nullif(TileImportStats.import_date, ""),
+                func.sum(TileImportStats.cities).label("count"),
             )
-            .group_by(City.import_date)
+            .filter(TileImportStats.level == level)
+            .filter(TileImportStats.x.between(cells[0], cells[2]))
+            .filter(TileImportStats.y.between(cells[1], cells[3]))
+            .group_by(TileImportStats.import_date)
+            .having(func.sum(TileImportStats.cities) > 0)
             .all()
         )
 
@@ -252,21 +588,93 @@ class Db(object):
             .all()
         )
 
+    def __insees_for_bboxes(self, bboxes: List[Bbox]):
+        """
+        Query of the INSEEs of the cities intersecting any of the given bboxes
+        """
+        envelopes = (
+            func.unnest(
+                *[
+                    bindparam(name, list(values), type_=ARRAY(Float))
+                    for (name, values) in zip(
+                        ["xmins", "ymins", "xmaxs", "ymaxs"],
+                        zip(*[self.__normalize(bbox) for bbox in bboxes]),
+                    )
+                ]
+            )
+            .table_valued("xmin", "ymin", "xmax", "ymax")
+            .render_derived(name="envelopes")
+        )
+        envelope = func.ST_MakeEnvelope(
+            envelopes.c.xmin, envelopes.c.ymin, envelopes.c.xmax, envelopes.c.ymax, 4326
+        )
+        return (
+            self.__filter_city(self.session.query(Boundary.insee))
+            .join(envelopes, Boundary.geometry.op("&&")(envelope))
+            .filter(func.ST_Intersects(Boundary.geometry, envelope))
+        )
+
+    def __city_dtos(self, fields=None, at=None):
+        """
+        Query of the CityDTO fields of cities (all by default), along with their cadastre buildings count.
+        josm_ready tells whether cadastre data is still fresh at given datetime, now by default.
+        """
+        columns = {
+            "insee": City.insee,
+            "name": City.name,
+            "date": City.import_date,
+            "details": City.import_details,
+            "osm_buildings": City.osm_buildings,
+            "od_buildings": Cadastre.od_buildings,
+            "josm_ready": func.coalesce(
+                City.date_cadastre > (at or datetime.now()) - City.CADASTRE_FRESHNESS,
+                False,
+            ),
+        }
+        unknown = set(fields or []) - columns.keys()
+        if unknown:
+            raise ValueError(f"Unknown city fields: {', '.join(sorted(unknown))}")
+        query = self.session.query(
+            *[
+                column.label(name)
+                for (name, column) in columns.items()
+                if not fields or name in fields
+            ]
+        ).select_from(City)
+        if not fields or "od_buildings" in fields:
+            query = query.outerjoin(Cadastre, Cadastre.insee == City.insee)
+        return query.order_by(City.insee)
+
+    @__isInitialized
+    def get_city_dto_for_insee(self, insee, fields=None, at=None):
+        """
+        Returns the CityDTO fields of given city as a row, see __city_dtos
+        """
+        return self.__city_dtos(fields, at).filter(City.insee == insee).first()
+
     @__isInitialized
-    def get_cities_for_bbox(self, bbox: Bbox):
-        # we should fetch all cities within the view but if the bbox is too
-        # small, at least take consider a 110km radius zone instead
-        distance = min(bbox.max_distance(), 1.0)
+    def get_city_dtos_for_bboxes(self, bboxes: List[Bbox], fields=None):
+        """
+        Returns the CityDTO fields of the cities intersecting any of the given bboxes, with a single query
+        """
+        if not bboxes:
+            return []
         return (
-            self.__filter_city(self.session.query(City))
-            .filter(Boundary.insee == City.insee)
-            .filter(
-                func.ST_DWithin(Boundary.geometry, self.__build_srid(bbox), distance)
-            )
-            .order_by(func.ST_Distance(self.__build_srid(bbox), Boundary.geometry))
+            self.__city_dtos(fields)
+            .filter(City.insee.in_(self.__insees_for_bboxes(bboxes)))
             .all()
         )
 
+    @staticmethod
+    def __normalize(bbox: Bbox):
+        # tiles bboxes are given from their north west to their south east corner
+        return [
+            min(bbox.xmin, bbox.xmax),
+            min(bbox.ymin, bbox.ymax),
+            max(bbox.xmin, bbox.xmax),
+            max(bbox.ymin, bbox.ymax),
+        ]
+
     @__isInitialized
     def get_departments(self):
         # admin_level 6 are departments, however some are handled differently by OSM and cadastre.
@@ -292,21 +700,29 @@ class Db(object):
 
     @__isInitialized
     def get_department_import_stats(self, insee):
+        if not self.has_import_stats():
+            return (
+                self.session.query(City.import_date, func.count("*"))
+                .filter(City.department == str(insee))
+                .group_by(City.import_date)
+                .order_by(City.import_date)
+                .all()
+            )
+        date = func.nullif(DepartmentImportStats.import_date, "")
         return (
-            self.session.query(City.import_date, func.count("*"))
-            .filter(City.department == str(insee))
-            .group_by(City.import_date)
-            .order_by(City.import_date)
+            self.session.query(date, DepartmentImportStats.cities)
+            .filter(DepartmentImportStats.department == str(insee))
+            .filter(DepartmentImportStats.cities > 0)
+            .order_by(date)
             .all()
         )
 
     @__isInitialized
-    def get_department_simplified_buildings(self, insee):
+    def get_department_simplified_buildings(self, insee) -> List[int]:
         return self.__flat(
-            self.session.query(City.import_details["simplified"])
-            .filter(City.department == str(insee))
-            .filter(func.json_array_length(City.import_details["simplified"]) != 0)
-            .order_by(City.insee)
+            self.session.query(CitySimplifiedBuilding.osm_id)
+            .filter(CitySimplifiedBuilding.department == str(insee))
+            .order_by(CitySimplifiedBuilding.osm_id)
             .all()
         )
 
@@ -323,10 +739,22 @@ class Db(object):
         )
 
     @__isInitialized
-    def get_city_geometry(self, insee):
+    def get_city_geojson(self, insee, tolerance=None):
+        """
+        Returns the name, import date and boundary of the given city, the latter as GeoJSON text simplified
+        to the given tolerance (in degrees) if set, coordinates being rounded accordingly
+        """
+        geometry = Boundary.geometry
+        digits = 9
+        if tolerance:
+            geometry = func.ST_SimplifyPreserveTopology(geometry, tolerance)
+            digits = min(digits, max(0, math.ceil(-math.log10(tolerance)) + 1))
         return (
             self.__filter_city(
-                self.session.query(Boundary.geometry.ST_AsGeoJSON()), insee
+                self.session.query(
+                    City.name, City.import_date, func.ST_AsGeoJSON(geometry, digits)
+                ),
+                insee,
             )
             .filter(Boundary.insee == City.insee)
             .first()
@@ -343,18 +771,76 @@ class Db(object):
         )
 
     @__isInitialized
-    def get_obsolete_city(self, ignored, ignored_cities, minratio):
+    def get_obsolete_city(self, ignored, ignored_cities, minratio, reservation=None):
         """
         Find the city that has the most urging need of import (never > unknown > old import > raster).
         Also privileges ready-to-work cities (cadastre data available) upon the others.
         However we do NOT want this to be a fixed-order list (to avoid multiple users working on the
-        same city), so we finally randomize final list of matching cities.
+        same city), so we finally pick randomly among equally urging cities.
+
+        If reservation is given, the returned city is deliberately set aside for that many seconds so
+        that concurrent users get another one: this is the only write of this method.
+        Returns a (City, CityPriority) row.
         """
-        past_month = datetime.now() - timedelta(days=30)
+        if not self.has_city_priority():
+            current_app.logger.warning(
+                "city_priority is not maintained, run `flask citypriority`: computing obsolete city from cities"
+            )
+            return self.__get_obsolete_city_from_cities(
+                ignored, ignored_cities, minratio
+            )
+
+        now = datetime.now()
+        query = (
+            self.session.query(CityPriority)
+            .filter(CityPriority.ratio >= minratio)
+            .filter(CityPriority.insee.notin_(ignored_cities))
+        )
+        available = or_(
+            CityPriority.reserved_until.is_(None), CityPriority.reserved_until < now
+        )
+        undated = CityPriority.bucket == len(CityPriority.BUCKETS)
+        # ignored dates then cities without date come last,
+        # reserved cities are only returned if nothing else is left in their group
+        for filtered in [
+            query.filter(CityPriority.import_date.notin_(ignored)).filter(
+                not_(undated)
+            ),
+            query.filter(CityPriority.import_date.in_(ignored)).filter(not_(undated)),
+            query.filter(undated),
+        ]:
+            priority = self.__pick_city_priority(
+                filtered.filter(available), now, reservation
+            ) or self.__pick_city_priority(filtered, now, reservation)
+            if priority:
+                break
+        else:
+            return None
+
+        if reservation:
+            priority.reserved_until = now + timedelta(seconds=reservation)
+            self.session.commit()
         return (
-            self.session.query(
-                City,
-                Boundary.geometry.ST_Centroid().ST_AsText().label("position"),
+            self.session.query(City, CityPriority)
+            .filter(City.insee == CityPriority.insee)
+            .filter(CityPriority.insee == priority.insee)
+            .first()
+        )
+
+    def __get_obsolete_city_from_cities(self, ignored, ignored_cities, minratio):
+        """
+        Same as get_obsolete_city without city_priority (nor reservation), while its triggers are missing.
+        The returned CityPriority is not stored, it only holds the city position and osm id.
+        """
+        centroid = func.ST_Centroid(Boundary.geometry)
+        row = (
+            self.__filter_city(
+                self.session.query(
+                    City,
+                    func.ST_X(centroid).label("lon"),
+                    func.ST_Y(centroid).label("lat"),
+                    (-1 * Boundary.osm_id).label("osm_id"),
+                )
             )
             .filter(Boundary.insee == City.insee)
             .filter(Cadastre.insee == City.insee)
@@ -372,11 +858,64 @@ class Db(object):
             .order_by(City.import_date != "unknown")
             .order_by(City.import_date == "raster")
             .order_by(City.import_date)
-            .order_by(City.date_cadastre < str(past_month))
+            .order_by(City.date_cadastre < datetime.now() - City.CADASTRE_FRESHNESS)
             .order_by(func.random())
-            .limit(1)
             .first()
         )
+        if not row:
+            return None
+        return SimpleNamespace(
+            City=row.City,
+            CityPriority=CityPriority(
+                insee=row.City.insee, lon=row.lon, lat=row.lat, osm_id=row.osm_id
+            ),
+        )
+
+    @staticmethod
+    def __pick_city_priority(candidates, now, lock):
+        """
+        Picks randomly one of the most urging candidates, locking it if lock is set.
+        Fresh cadastre ranks are expired here rather than written back.
+        """
+        cadastre_rank = case(
+            (
+                and_(
+                    CityPriority.cadastre_rank == 0,
+                    CityPriority.cadastre_fresh_until < now,
+                ),
+                1,
+            ),
+            else_=CityPriority.cadastre_rank,
+        )
+        top = (
+            candidates.with_entities(
+                CityPriority.bucket,
+                CityPriority.import_date,
+                cadastre_rank.label("cadastre_rank"),
+            )
+            .order_by(
+                CityPriority.bucket,
+                CityPriority.import_date,
+                cadastre_rank,
+            )
+            .first()
+        )
+        if not top:
+            return None
+
+        group = (
+            candidates.filter(CityPriority.bucket == top.bucket)
+            .filter(CityPriority.import_date == top.import_date)
+            .filter(cadastre_rank == top.cadastre_rank)
+            .order_by(CityPriority.random_key)
+        )
+        if lock:
+            group = group.with_for_update(skip_locked=True)
+        key = random.random()
+        return (
+            group.filter(CityPriority.random_key >= key).first()
+            or group.filter(CityPriority.random_key < key).first()
+        )
 
     @__isInitialized
     def get_raster_cities_count(self, department):
@@ -388,11 +927,64 @@ class Db(object):
         )
 
     @__isInitialized
-    def get_building_dates_per_city_for_insee(self, insee):
+    def get_building_stats_per_city_for_insee(
+        self, insee, ignored_buildings, ignored_tags
+    ):
         """
         INSEE might represent either a department or a city.
 
-        Returns multiple tuples (insee, name, date, number_of_buildings, is_raster)
+        Uses the maintained city_building_stats table if its triggers are installed, otherwise
+        computes stats from osm_buildings.
+        Returns multiple tuples (insee, name, date, number_of_buildings, is_raster, simplified_osm_ids)
+        """
+        if self.has_building_stats():
+            return self.get_precomputed_building_stats_per_city_for_insee(insee)
+        return self.compute_building_stats_per_city_for_insee(
+            insee, ignored_buildings, ignored_tags
+        )
+
+    @__isInitialized
+    def get_precomputed_building_stats_per_city_for_insee(self, insee):
+        """
+        Same as compute_building_stats_per_city_for_insee, but reading maintained city_building_stats table.
+        Simplified osm ids of a city are repeated for each of its dated sources.
+        """
+        PointBuildings = (
+            self.session.query(
+                CityPointBuilding.insee,
+                func.array_agg(CityPointBuilding.osm_id).label("osm_ids"),
+            )
+            .filter(CityPointBuilding.insee.startswith(insee.zfill(2)))
+            .group_by(CityPointBuilding.insee)
+            .subquery("PointBuildings")
+        )
+
+        return (
+            self.session.query(
+                City.insee,
+                City.name,
+                CityBuildingStats.dated_source,
+                CityBuildingStats.buildings,
+                City.is_raster,
+                case((City.is_raster.is_(False), PointBuildings.c.osm_ids), else_=None),
+            )
+            .select_from(City)
+            .join(CityBuildingStats, CityBuildingStats.insee == City.insee)
+            .outerjoin(PointBuildings, PointBuildings.c.insee == City.insee)
+            .filter(CityBuildingStats.insee.startswith(insee.zfill(2)))
+            .all()
+        )
+
+    @__isInitialized
+    def compute_building_stats_per_city_for_insee(
+        self, insee, ignored_buildings, ignored_tags
+    ):
+        """
+        INSEE might represent either a department or a city.
+
+        Buildings are scanned once to both count them per dated source and find the simplified (point)
+        ones of vectorized cities.
+        Returns multiple tuples (insee, name, date, number_of_buildings, is_raster, simplified_osm_ids)
         """
         # only retrieve one geometry per INSEE from Boundary to avoid counting building multiple times
         GeoCities = (
@@ -407,6 +999,13 @@ class Db(object):
             .subquery("GeoCities")
         )
 
+        is_simplified = and_(
+            City.is_raster.is_(False),
+            Building.geometry.ST_GeometryType() == "ST_Point",
+            Building.building.notin_(ignored_buildings),
+            not_(Building.tags.has_any(ignored_tags)),
+        )
+
         return (
             self.session.query(
                 City.insee,
@@ -416,6 +1015,7 @@ class Db(object):
                 ),
                 func.count("*"),
                 City.is_raster,
+                func.array_agg(Building.osm_id).filter(is_simplified),
             )
             .filter(City.insee == GeoCities.c.insee)
             .filter(GeoCities.c.geometry.ST_Intersects(Building.geometry))
@@ -424,27 +1024,686 @@ class Db(object):
         )
 
     @__isInitialized
-    def get_point_buildings_per_city_for_insee(
-        self, insee, ignored_buildings, ignored_tags
-    ):
-        GeoCities = (
-            self.__filter_city(
-                self.session.query(
-                    Boundary.insee, Boundary.name, City.is_raster, Boundary.geometry
+    def has_building_stats(self) -> bool:
+        """
+        city_building_stats is only up to date if its triggers exist: they are lost when imposm deploys
+        a new import, in that case stats must be rebuilt
+        """
+        return (
+            self.session.execute(
+                text(
+                    """
+                    SELECT count(*) FROM pg_trigger
+                    WHERE (tgname = 'batimap_building_stats' AND tgrelid = to_regclass('osm_buildings'))
+                       OR (tgname = 'batimap_admin_building_stats' AND tgrelid = to_regclass('osm_admin'))
+                    """
+                )
+            ).scalar()
+            == 2
+        )
+
+    @__isInitialized
+    def get_initdb_checkpoints(self, departments=None) -> List[InitdbCheckpoint]:
+        query = self.session.query(InitdbCheckpoint)
+        if departments is not None:
+            query = query.filter(InitdbCheckpoint.department.in_(departments))
+        return query.order_by(InitdbCheckpoint.department).all()
+
+    @__isInitialized
+    def get_initdb_input_stamp(self, department, phase):
+        """
+        Returns the freshness stamp of the input data of the given OSM initdb step on a department: the last
+        OSM change applied by imposm to its cities. Other steps inputs are remote, see InitdbCheckpoints.
+        """
+        if phase not in ["buildings", "unknowns"]:
+            return None
+        last_change = (
+            self.session.query(func.max(CityChange.changed_at))
+            .join(City, City.insee == CityChange.insee)
+            .filter(City.department == department)
+            .scalar()
+        )
+        return last_change.isoformat() if last_change else None
+
+    @__isInitialized
+    def save_initdb_checkpoint(self, department, phase, input_stamp):
+        self.session.merge(
+            InitdbCheckpoint(
+                department=department,
+                phase=phase,
+                completed_at=datetime.now(),
+                input_stamp=input_stamp,
+            )
+        )
+        self.session.commit()
+
+    @__isInitialized
+    def has_json_import_details(self) -> bool:
+        """
+        Import details used to be stored as plain JSON, which has to be parsed again on every access
+        """
+        return (
+            self.session.execute(
+                text(
+                    """
+                    SELECT data_type FROM information_schema.columns
+                    WHERE table_name = 'city_stats' AND column_name = 'details'
+                    """
                 )
+            ).scalar()
+            == "json"
+        )
+
+    @__isInitialized
+    def migrate_import_details(self):
+        """
+        Rewrites city_stats under an ACCESS EXCLUSIVE lock: only meant to be run once, before serving
+        """
+        current_app.logger.info("Migration des détails d'import en JSONB")
+        self.session.execute(
+            text(
+                "ALTER TABLE city_stats ALTER COLUMN details TYPE jsonb USING details::jsonb"
             )
-            .filter(City.insee == Boundary.insee)
-            .filter(City.insee.startswith(insee.zfill(2)))
-            .filter(City.is_raster.is_(False))
-            .subquery(name="GeoCities")
         )
+        self.session.commit()
 
+    @__isInitialized
+    def has_city_simplified_buildings(self) -> bool:
         return (
-            self.session.query(GeoCities.c.insee, Building.osm_id)
-            .filter(Building.building.notin_(ignored_buildings))
-            .filter(not_(Building.tags.has_any(ignored_tags)))
-            .filter(Building.geometry.ST_GeometryType() == "ST_Point")
-            .filter(GeoCities.c.geometry.ST_Intersects(Building.geometry))
-            .order_by(GeoCities.c.insee)
-            .all()
+            self.session.execute(
+                text(
+                    """
+                    SELECT count(*) FROM pg_trigger
+                    WHERE tgname = 'batimap_simplified_buildings' AND tgrelid = to_regclass('city_stats')
+                    """
+                )
+            ).scalar()
+            == 1
         )
+
+    @__isInitialized
+    def install_city_simplified_buildings(self):
+        """
+        Create the function and trigger maintaining city_simplified_buildings, then rebuild it.
+        It is emptied with DELETE rather than TRUNCATE, so that it is still served while rebuilt.
+        """
+        # row is given as {insee}, {department} and {details}, jsonb_array_elements_text only accepts arrays
+        simplified = """
+            INSERT INTO city_simplified_buildings (insee, department, osm_id)
+            SELECT {insee}, {department}, osm_id::bigint
+            FROM {source} jsonb_array_elements_text(
+                CASE WHEN jsonb_typeof({details}->'simplified') = 'array'
+                THEN {details}->'simplified' ELSE '[]' END
+            ) osm_id
+            ON CONFLICT DO NOTHING
+        """
+        statements = [
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_simplified_buildings_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    DELETE FROM city_simplified_buildings WHERE insee = OLD.insee;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    {simplified.format(
+                        insee="NEW.insee", department="NEW.department", source="", details="NEW.details"
+                    ).strip()};
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS batimap_simplified_buildings ON city_stats",
+            """
+            CREATE TRIGGER batimap_simplified_buildings
+            AFTER INSERT OR UPDATE OF insee, department, details OR DELETE ON city_stats
+            FOR EACH ROW EXECUTE FUNCTION batimap_simplified_buildings_trigger()
+            """,
+            "DELETE FROM city_simplified_buildings",
+            simplified.format(
+                insee="c.insee",
+                department="c.department",
+                source="city_stats c,",
+                details="c.details",
+            ),
+        ]
+        for statement in statements:
+            self.session.execute(text(statement))
+        self.session.commit()
+
+    @__isInitialized
+    def has_import_stats(self) -> bool:
+        """
+        Import stats summaries are only up to date if their triggers exist: the osm_admin one is lost when
+        imposm deploys a new import. Stats are then computed from cities until `flask importstats` reinstalls them.
+        """
+        return (
+            self.session.execute(
+                text(
+                    """
+                    SELECT count(*) FROM pg_trigger
+                    WHERE tgname = 'batimap_import_stats' AND tgrelid IN (
+                        to_regclass('city_stats'), to_regclass('osm_admin')
+                    )
+                    """
+                )
+            ).scalar()
+            == 2
+        )
+
+    @__isInitialized
+    def install_import_stats(self):
+        """
+        Create the functions and triggers maintaining city_import_status, department_import_stats and
+        tile_import_stats, then rebuild them.
+        Summaries are emptied with DELETE rather than TRUNCATE, so that they are still served while rebuilt.
+        """
+        levels = TileImportStats.LEVELS
+        cells_per_degree = TileImportStats.CELLS_PER_DEGREE
+        # INSERT or SELECT INTO target is given as {into}
+        city_status = """
+            SELECT c.insee, coalesce(c.department, ''), coalesce(c.date, ''),
+                ST_X(ST_Centroid(b.geometry)), ST_Y(ST_Centroid(b.geometry))
+            {into}
+            FROM city_stats c
+            LEFT JOIN LATERAL (
+                SELECT geometry FROM osm_admin
+                WHERE insee = c.insee AND admin_level >= 8
+                ORDER BY admin_level LIMIT 1
+            ) b ON true
+        """
+        statements = [
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_apply_import_status(
+                p_department text, p_date text, p_lon double precision, p_lat double precision, p_delta integer
+            ) RETURNS void AS $$
+                INSERT INTO department_import_stats AS s (department, date, cities)
+                VALUES (p_department, p_date, p_delta)
+                ON CONFLICT (department, date) DO UPDATE SET cities = s.cities + p_delta;
+                INSERT INTO tile_import_stats AS s (level, x, y, date, cities)
+                SELECT
+                    level,
+                    floor(p_lon * {cells_per_degree} / 2 ^ level),
+                    floor(p_lat * {cells_per_degree} / 2 ^ level),
+                    p_date,
+                    p_delta
+                FROM generate_series(0, {levels - 1}) level
+                WHERE p_lon IS NOT NULL
+                ON CONFLICT (level, x, y, date) DO UPDATE SET cities = s.cities + p_delta;
+            $$ LANGUAGE SQL
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_refresh_city_import_status(p_insee text) RETURNS void AS $$
+            DECLARE
+                previous_status city_import_status;
+                new_status city_import_status;
+                previous_found boolean;
+            BEGIN
+                -- serializes concurrent refreshes of the same city
+                PERFORM pg_advisory_xact_lock(hashtext('batimap_import_status'), hashtext(p_insee));
+                SELECT * INTO previous_status FROM city_import_status WHERE insee = p_insee;
+                previous_found := FOUND;
+                {city_status.format(into="INTO new_status").strip()}
+                WHERE c.insee = p_insee;
+                IF previous_found AND previous_status IS NOT DISTINCT FROM new_status THEN
+                    RETURN;
+                END IF;
+                IF previous_found THEN
+                    PERFORM batimap_apply_import_status(
+                        previous_status.department, previous_status.date,
+                        previous_status.lon, previous_status.lat, -1
+                    );
+                    DELETE FROM city_import_status WHERE insee = p_insee;
+                END IF;
+                IF new_status.insee IS NOT NULL THEN
+                    PERFORM batimap_apply_import_status(
+                        new_status.department, new_status.date, new_status.lon, new_status.lat, 1
+                    );
+                    INSERT INTO city_import_status SELECT new_status.*;
+                END IF;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION batimap_import_stats_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM batimap_refresh_city_import_status(OLD.insee);
+                END IF;
+                IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.insee IS DISTINCT FROM OLD.insee) THEN
+                    PERFORM batimap_refresh_city_import_status(NEW.insee);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS batimap_import_stats ON city_stats",
+            """
+            CREATE TRIGGER batimap_import_stats
+            AFTER INSERT OR UPDATE OF insee, department, date OR DELETE ON city_stats
+            FOR EACH ROW EXECUTE FUNCTION batimap_import_stats_trigger()
+            """,
+            "DROP TRIGGER IF EXISTS batimap_import_stats ON osm_admin",
+            """
+            CREATE TRIGGER batimap_import_stats
+            AFTER INSERT OR UPDATE OR DELETE ON osm_admin
+            FOR EACH ROW EXECUTE FUNCTION batimap_import_stats_trigger()
+            """,
+            "DELETE FROM city_import_status",
+            "DELETE FROM department_import_stats",
+            "DELETE FROM tile_import_stats",
+            "INSERT INTO city_import_status (insee, department, date, lon, lat)"
+            + city_status.format(into=""),
+            """
+            INSERT INTO department_import_stats (department, date, cities)
+            SELECT department, date, count(*) FROM city_import_status GROUP BY department, date
+            """,
+            f"""
+            INSERT INTO tile_import_stats (level, x, y, date, cities)
+            SELECT level, x, y, date, count(*) FROM (
+                SELECT
+                    level,
+                    floor(lon * {cells_per_degree} / 2 ^ level) AS x,
+                    floor(lat * {cells_per_degree} / 2 ^ level) AS y,
+                    date
+                FROM city_import_status, generate_series(0, {levels - 1}) level
+                WHERE lon IS NOT NULL
+            ) cells
+            GROUP BY level, x, y, date
+            """,
+        ]
+        for statement in statements:
+            self.session.execute(text(statement))
+        self.session.commit()
+
+    @__isInitialized
+    def has_city_priority(self) -> bool:
+        """
+        city_priority is only up to date if its triggers exist: the osm_admin one is lost when imposm
+        deploys a new import
+        """
+        return (
+            self.session.execute(
+                text(
+                    """
+                    SELECT count(*) FROM pg_trigger
+                    WHERE tgname = 'batimap_city_priority' AND tgrelid IN (
+                        to_regclass('city_stats'), to_regclass('cadastre_stats'), to_regclass('osm_admin')
+                    )
+                    """
+                )
+            ).scalar()
+            == 3
+        )
+
+    @__isInitialized
+    def install_city_priority(self):
+        """
+        Create the functions and triggers maintaining city_priority, then rebuild it
+        """
+        buckets = " ".join(
+            f"WHEN '{date}' THEN {idx}"
+            for (idx, date) in enumerate(CityPriority.BUCKETS)
+            if date
+        )
+        freshness = f"interval '{City.CADASTRE_FRESHNESS.days} days'"
+        # refreshed cities are selected by insee {match}
+        refresh = f"""
+                DELETE FROM city_priority p WHERE p.insee {{match}} AND NOT EXISTS (
+                    SELECT 1 FROM city_stats c
+                    JOIN cadastre_stats cs ON cs.insee = c.insee
+                    JOIN osm_admin b ON b.insee = c.insee AND b.admin_level >= 8
+                    WHERE c.insee = p.insee
+                );
+                INSERT INTO city_priority AS p (
+                    insee, bucket, import_date, cadastre_rank, cadastre_fresh_until, ratio, lon, lat, osm_id,
+                    random_key
+                )
+                SELECT DISTINCT ON (c.insee)
+                    c.insee,
+                    CASE WHEN c.date IS NULL THEN {len(CityPriority.BUCKETS)}
+                        ELSE CASE c.date {buckets} ELSE {CityPriority.BUCKETS.index(None)} END
+                    END,
+                    coalesce(c.date, ''),
+                    CASE WHEN c.date_cadastre IS NULL THEN 2
+                        WHEN c.date_cadastre + {freshness} > LOCALTIMESTAMP THEN 0
+                        ELSE 1
+                    END,
+                    c.date_cadastre + {freshness},
+                    abs(1 - cs.od_buildings * 1.0 / greatest(1, c.osm_buildings)),
+                    ST_X(ST_Centroid(b.geometry)),
+                    ST_Y(ST_Centroid(b.geometry)),
+                    -b.osm_id,
+                    random()
+                FROM city_stats c
+                JOIN cadastre_stats cs ON cs.insee = c.insee
+                JOIN osm_admin b ON b.insee = c.insee AND b.admin_level >= 8
+                WHERE c.insee {{match}}
+                ORDER BY c.insee, b.admin_level
+                ON CONFLICT (insee) DO UPDATE SET
+                    bucket = EXCLUDED.bucket,
+                    import_date = EXCLUDED.import_date,
+                    cadastre_rank = EXCLUDED.cadastre_rank,
+                    cadastre_fresh_until = EXCLUDED.cadastre_fresh_until,
+                    ratio = EXCLUDED.ratio,
+                    lon = EXCLUDED.lon,
+                    lat = EXCLUDED.lat,
+                    osm_id = EXCLUDED.osm_id
+        """
+        statements = [
+            # LIKE pattern matching cannot use indexes: only meant for bulk rebuilds
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_refresh_city_priority(p_insee_pattern text)
+            RETURNS void AS $$
+            {refresh.format(match="LIKE p_insee_pattern").strip()}
+            $$ LANGUAGE SQL
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_refresh_city_priority_insee(p_insee text)
+            RETURNS void AS $$
+            {refresh.format(match="= p_insee").strip()}
+            $$ LANGUAGE SQL
+            """,
+            """
+            CREATE OR REPLACE FUNCTION batimap_city_priority_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM batimap_refresh_city_priority_insee(OLD.insee);
+                END IF;
+                IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.insee IS DISTINCT FROM OLD.insee) THEN
+                    PERFORM batimap_refresh_city_priority_insee(NEW.insee);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS batimap_city_priority ON city_stats",
+            """
+            CREATE TRIGGER batimap_city_priority
+            AFTER INSERT OR UPDATE OF insee, date, date_cadastre, osm_buildings OR DELETE ON city_stats
+            FOR EACH ROW EXECUTE FUNCTION batimap_city_priority_trigger()
+            """,
+            "DROP TRIGGER IF EXISTS batimap_city_priority ON cadastre_stats",
+            """
+            CREATE TRIGGER batimap_city_priority
+            AFTER INSERT OR UPDATE OF insee, od_buildings OR DELETE ON cadastre_stats
+            FOR EACH ROW EXECUTE FUNCTION batimap_city_priority_trigger()
+            """,
+            "DROP TRIGGER IF EXISTS batimap_city_priority ON osm_admin",
+            """
+            CREATE TRIGGER batimap_city_priority
+            AFTER INSERT OR UPDATE OR DELETE ON osm_admin
+            FOR EACH ROW EXECUTE FUNCTION batimap_city_priority_trigger()
+            """,
+            "SELECT batimap_refresh_city_priority('%')",
+        ]
+        for statement in statements:
+            self.session.execute(text(statement))
+        self.session.commit()
+
+    @__isInitialized
+    def install_building_stats(self, ignored_buildings, ignored_tags):
+        """
+        Create the functions and triggers maintaining city_building_stats and city_point_buildings
+        whenever osm_buildings or osm_admin rows change (ie. on each imposm diff).
+        """
+        # refreshed cities are selected by insee {match}
+        refresh = """
+                DELETE FROM city_building_stats WHERE insee {match};
+                DELETE FROM city_point_buildings WHERE insee {match};
+                WITH geo_cities AS (
+                    SELECT DISTINCT ON (insee) insee, geometry FROM osm_admin
+                    WHERE admin_level >= 8 AND insee <> '' AND insee {match}
+                    ORDER BY insee, admin_level
+                ), buildings AS (
+                    SELECT
+                        c.insee,
+                        b.osm_id,
+                        concat(b.source, b.source_date) AS dated_source,
+                        batimap_is_simplified_building(b.geometry, b.building, b.tags) AS is_simplified
+                    FROM geo_cities c JOIN osm_buildings b ON ST_Intersects(c.geometry, b.geometry)
+                ), counts AS (
+                    INSERT INTO city_building_stats (insee, dated_source, buildings)
+                    SELECT insee, dated_source, count(*) FROM buildings GROUP BY insee, dated_source
+                )
+                INSERT INTO city_point_buildings (insee, osm_id)
+                SELECT DISTINCT insee, osm_id FROM buildings WHERE is_simplified;
+        """
+        statements = [
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_is_simplified_building(
+                p_geometry geometry, p_building text, p_tags hstore
+            ) RETURNS boolean AS $$
+                SELECT ST_GeometryType(p_geometry) = 'ST_Point'
+                    AND p_building <> ALL({self.__sql_array(ignored_buildings)})
+                    AND NOT p_tags ?| {self.__sql_array(ignored_tags)}
+            $$ LANGUAGE SQL IMMUTABLE
+            """,
+            # only one geometry per INSEE is used to avoid counting buildings multiple times
+            """
+            CREATE OR REPLACE FUNCTION batimap_cities_for_geometry(p_geometry geometry)
+            RETURNS SETOF text AS $$
+                SELECT g.insee FROM (
+                    SELECT DISTINCT ON (insee) insee, geometry FROM osm_admin
+                    WHERE admin_level >= 8 AND insee IN (
+                        SELECT insee FROM osm_admin
+                        WHERE admin_level >= 8 AND insee <> '' AND geometry && p_geometry
+                    )
+                    ORDER BY insee, admin_level
+                ) g
+                WHERE ST_Intersects(g.geometry, p_geometry)
+            $$ LANGUAGE SQL STABLE
+            """,
+            # LIKE pattern matching cannot use indexes: only meant for bulk rebuilds
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_refresh_city_building_stats(p_insee_pattern text)
+            RETURNS void AS $$
+            {refresh.format(match="LIKE p_insee_pattern").strip()}
+            $$ LANGUAGE SQL
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION batimap_refresh_city_building_stats_insee(p_insee text)
+            RETURNS void AS $$
+            {refresh.format(match="= p_insee").strip()}
+            $$ LANGUAGE SQL
+            """,
+            """
+            CREATE OR REPLACE FUNCTION batimap_mark_city_changed(p_insee text) RETURNS void AS $$
+                INSERT INTO city_changes (insee, changed_at) VALUES (p_insee, now() AT TIME ZONE 'UTC')
+                ON CONFLICT (insee) DO UPDATE SET changed_at = EXCLUDED.changed_at
+            $$ LANGUAGE SQL
+            """,
+            """
+            CREATE OR REPLACE FUNCTION batimap_apply_building_stats(
+                p_geometry geometry, p_osm_id bigint, p_dated_source text, p_is_simplified boolean, p_delta integer
+            ) RETURNS void AS $$
+            DECLARE
+                city text;
+            BEGIN
+                FOR city IN SELECT batimap_cities_for_geometry(p_geometry) LOOP
+                    PERFORM batimap_mark_city_changed(city);
+                    INSERT INTO city_building_stats AS s (insee, dated_source, buildings)
+                    VALUES (city, p_dated_source, p_delta)
+                    ON CONFLICT (insee, dated_source) DO UPDATE SET buildings = s.buildings + p_delta;
+                    DELETE FROM city_building_stats
+                    WHERE insee = city AND dated_source = p_dated_source AND buildings <= 0;
+
+                    IF p_is_simplified IS TRUE AND p_delta > 0 THEN
+                        INSERT INTO city_point_buildings (insee, osm_id) VALUES (city, p_osm_id)
+                        ON CONFLICT DO NOTHING;
+                    ELSIF p_is_simplified IS TRUE THEN
+                        DELETE FROM city_point_buildings WHERE insee = city AND osm_id = p_osm_id;
+                    END IF;
+                END LOOP;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION batimap_building_stats_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    PERFORM batimap_apply_building_stats(
+                        OLD.geometry,
+                        OLD.osm_id,
+                        concat(OLD.source, OLD.source_date),
+                        batimap_is_simplified_building(OLD.geometry, OLD.building, OLD.tags),
+                        -1
+                    );
+                END IF;
+                IF TG_OP IN ('UPDATE', 'INSERT') THEN
+                    PERFORM batimap_apply_building_stats(
+                        NEW.geometry,
+                        NEW.osm_id,
+                        concat(NEW.source, NEW.source_date),
+                        batimap_is_simplified_building(NEW.geometry, NEW.building, NEW.tags),
+                        1
+                    );
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE OR REPLACE FUNCTION batimap_admin_building_stats_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.admin_level >= 8 AND OLD.insee <> '' THEN
+                    PERFORM batimap_refresh_city_building_stats_insee(OLD.insee);
+                    PERFORM batimap_mark_city_changed(OLD.insee);
+                END IF;
+                IF TG_OP IN ('UPDATE', 'INSERT') AND NEW.admin_level >= 8 AND NEW.insee <> '' THEN
+                    PERFORM batimap_refresh_city_building_stats_insee(NEW.insee);
+                    PERFORM batimap_mark_city_changed(NEW.insee);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """,
+            "DROP TRIGGER IF EXISTS batimap_building_stats ON osm_buildings",
+            """
+            CREATE TRIGGER batimap_building_stats
+            AFTER INSERT OR UPDATE OR DELETE ON osm_buildings
+            FOR EACH ROW EXECUTE FUNCTION batimap_building_stats_trigger()
+            """,
+            "DROP TRIGGER IF EXISTS batimap_admin_building_stats ON osm_admin",
+            """
+            CREATE TRIGGER batimap_admin_building_stats
+            AFTER INSERT OR UPDATE OR DELETE ON osm_admin
+            FOR EACH ROW EXECUTE FUNCTION batimap_admin_building_stats_trigger()
+            """,
+            # changes were not tracked while triggers were missing: summaries may only be refreshed
+            """
+            INSERT INTO city_changes (insee, changed_at)
+            SELECT insee, now() AT TIME ZONE 'UTC' FROM city_overpass_summaries
+            ON CONFLICT (insee) DO UPDATE SET changed_at = EXCLUDED.changed_at
+            """,
+        ]
+        for statement in statements:
+            self.session.execute(text(statement))
+        self.session.commit()
+
+    @__isInitialized
+    def get_overpass_summary(self, insee):
+        """
+        Returns the Overpass summary of the city if imposm did not change it since, None otherwise.
+        Changes are only tracked while building stats triggers exist, callers must check has_building_stats.
+        """
+        cached = (
+            self.session.query(CityOverpassSummary)
+            .outerjoin(CityChange, CityChange.insee == CityOverpassSummary.insee)
+            .filter(CityOverpassSummary.insee == insee)
+            .filter(
+                or_(
+                    CityChange.changed_at.is_(None),
+                    CityChange.changed_at < CityOverpassSummary.osm_base,
+                )
+            )
+            .first()
+        )
+        return cached.summary if cached else None
+
+    @__isInitialized
+    def get_last_overpass_summary(self, insee):
+        """
+        Returns the last Overpass summary of the city (CityOverpassSummary), even if it changed since
+        """
+        return self.session.query(CityOverpassSummary).get(insee)
+
+    @__isInitialized
+    def get_overpass_elements(self, insee):
+        """
+        Returns the buildings years of the last Overpass summary of the city, see CityOverpassElements
+        """
+        row = self.session.query(CityOverpassElements).get(insee)
+        return row.elements if row else None
+
+    @__isInitialized
+    def save_overpass_summary(self, insee, osm_base, summary, elements):
+        self.session.merge(
+            CityOverpassSummary(insee=insee, osm_base=osm_base, summary=summary)
+        )
+        self.session.merge(CityOverpassElements(insee=insee, elements=elements))
+
+    @__isInitialized
+    def count_overpass_summaries(self) -> int:
+        return self.session.query(CityOverpassSummary).count()
+
+    @__isInitialized
+    def rebuild_building_stats(self, insee=None):
+        """
+        Recompute city_building_stats and city_point_buildings from scratch for given INSEE prefix
+        (department or city), or all cities.
+        """
+        if insee:
+            self.session.execute(
+                text("SELECT batimap_refresh_city_building_stats(:pattern)"),
+                {"pattern": f"{insee.zfill(2)}%"},
+            )
+        else:
+            self.session.query(CityBuildingStats).delete()
+            self.session.query(CityPointBuilding).delete()
+            self.session.execute(
+                text("SELECT batimap_refresh_city_building_stats('%')")
+            )
+        self.session.commit()
+
+    @__isInitialized
+    def check_building_stats(self, insee, ignored_buildings, ignored_tags):
+        """
+        Compare maintained stats with stats computed from osm_buildings for given INSEE.
+
+        Returns a list of mismatch descriptions, empty if stats are consistent.
+        """
+
+        def index(rows):
+            counts = {}
+            simplified = {}
+            for (city, _, source, count, _, osm_ids) in rows:
+                counts[(city, source)] = count
+                simplified.setdefault(city, set()).update(osm_ids or [])
+            return (counts, simplified)
+
+        (expected_counts, expected_simplified) = index(
+            self.compute_building_stats_per_city_for_insee(
+                insee, ignored_buildings, ignored_tags
+            )
+        )
+        (counts, simplified) = index(
+            self.get_precomputed_building_stats_per_city_for_insee(insee)
+        )
+
+        mismatches = []
+        for key in sorted(set(expected_counts) | set(counts)):
+            if expected_counts.get(key) != counts.get(key):
+                mismatches.append(
+                    f"{key[0]} source '{key[1]}': expected {expected_counts.get(key)} buildings, "
+                    f"got {counts.get(key)}"
+                )
+        for city in sorted(set(expected_simplified) | set(simplified)):
+            expected = expected_simplified.get(city, set())
+            actual = simplified.get(city, set())
+            if expected != actual:
+                mismatches.append(
+                    f"{city} simplified buildings: missing {sorted(expected - actual)}, "
+                    f"unexpected {sorted(actual - expected)}"
+                )
+        return mismatches
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from pathlib import Path
+
+import requests
+from flask import current_app
+
+# key: content address of the cached body, derived from its URL and validators
+# fileobj: binary file object of the body, as sent by the server (not decoded)
+# headers: ETag, Last-Modified, Content-Type and Content-Encoding response headers
+Download = namedtuple("Download", ["key", "fileobj", "headers"])
+
+
+class CachingReader(object):
+    """
+    Binary file object reading a response body, while copying what is read to the given file
+    """
+
+    def __init__(self, raw, file):
+        self.raw = raw
+        self.file = file
+
+    def read(self, size=-1):
+        chunk = self.raw.read() if size is None or size < 0 else self.raw.read(size)
+        self.file.write(chunk)
+        return chunk
+
+
+class DownloadCache(object):
+    """
+    Local cache of downloaded files, revalidated with ETag/Last-Modified on every access.
+
+    Bodies are stored under a key derived from their URL and validators, written atomically while they are
+    read, and evicted in least recently used order once DOWNLOAD_CACHE_MAX_SIZE bytes are exceeded.
+    The cached copy is served when the server cannot be reached, times out or fails.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    STORED_HEADERS = ["ETag", "Last-Modified", "Content-Type", "Content-Encoding"]
+    # connect and read timeouts, in seconds
+    TIMEOUT = (10, 60)
+
+    def init_app(self, app):
+        self.directory = Path(app.config.get("DOWNLOAD_CACHE_DIR", "cache/downloads"))
+        self.max_size = app.config.get("DOWNLOAD_CACHE_MAX_SIZE", 10 * 1024 ** 3)
+
+    @contextmanager
+    def open(self, url, since=None):
+        """
+        Yields a Download of the given URL, served from the cache when the server did not change it.
+        Downloaded bodies are stored while the caller reads them.
+        If since (a naive local datetime) is set and the file was not modified since, yields None instead.
+        Raises requests.RequestException if the file could neither be fetched nor found in the cache.
+        """
+        (blobs, urls) = (self.directory / "blobs", self.directory / "urls")
+        blobs.mkdir(parents=True, exist_ok=True)
+        urls.mkdir(parents=True, exist_ok=True)
+
+        meta_path = urls / self.__hash(url)
+        meta = self.__read_meta(meta_path)
+        while True:
+            with self.__get(url, meta, since) as r:
+                if r is not None and r.status_code == 304 and not meta:
+                    yield None
+                    return
+                if r is not None and r.status_code != 304:
+                    with self.__storing(url, meta_path, meta, r) as download:
+                        yield None if self.__unmodified(
+                            download.headers, since
+                        ) else download
+                    return
+
+            if self.__unmodified(meta["headers"], since):
+                yield None
+                return
+            try:
+                f = (blobs / meta["key"]).open("rb")
+            except FileNotFoundError:
+                # evicted by another process since its meta was read
+                current_app.logger.info(
+                    f"{url} was evicted from download cache, fetching it again"
+                )
+                meta = None
+                continue
+            with f:
+                # mtime is the last access time used for eviction
+                os.utime(f.fileno())
+                yield Download(meta["key"], f, meta["headers"])
+            return
+
+    @contextmanager
+    def __get(self, url, meta, since):
+        """
+        Yields the response to a conditional request of the given URL, or None if the cached copy (described
+        by meta) must be used because the server is not available
+        """
+        headers = {}
+        if meta and meta["headers"].get("ETag"):
+            headers["If-None-Match"] = meta["headers"]["ETag"]
+        if meta and meta["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        elif not meta and since:
+            headers["If-Modified-Since"] = format_datetime(
+                since.astimezone(timezone.utc), usegmt=True
+            )
+
+        try:
+            r = requests.get(url, headers=headers, stream=True, timeout=self.TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not meta:
+                raise
+            current_app.logger.warning(f"{url} unreachable ({e}), using cached copy")
+            yield None
+            return
+
+        with r:
+            if r.status_code >= 500 and meta:
+                current_app.logger.warning(
+                    f"{url} failed with status {r.status_code}, using cached copy"
+                )
+                yield None
+                return
+            if r.status_code != 304:
+                r.raise_for_status()
+            yield r
+
+    @contextmanager
+    def __storing(self, url, meta_path, previous, r):
+        """
+        Yields a Download of the response body, stored while the caller reads it so that it is parsed while
+        being downloaded. The body is only cached once completely read, which is done if the caller did not.
+        """
+        headers = {h: r.headers[h] for h in self.STORED_HEADERS if h in r.headers}
+        key = self.__hash(
+            "\n".join([url, headers.get("ETag", ""), headers.get("Last-Modified", "")])
+        )
+
+        # keep the body as sent by the server, callers decompress it while reading
+        r.raw.decode_content = False
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            try:
+                reader = CachingReader(r.raw, f)
+                yield Download(key, reader, headers)
+                while reader.read(self.CHUNK_SIZE):
+                    pass
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, self.directory / "blobs" / key)
+
+        meta = {"url": url, "key": key, "headers": headers}
+        self.__write_atomically(meta_path, [json.dumps(meta).encode()])
+        if previous and previous["key"] != key:
+            # previous version is not referenced anymore
+            self.__unlink(self.directory / "blobs" / previous["key"])
+        self.__evict()
+
+    def __write_atomically(self, path, chunks):
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, path)
+
+    def __evict(self):
+        blobs = []
+        for entry in os.scandir(self.directory / "blobs"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for (_, size, _) in blobs)
+        evicted = False
+        # never evict the most recent blob, which has just been written
+        for (_, size, path) in sorted(blobs)[:-1]:
+            if total <= self.max_size:
+                break
+            current_app.logger.debug(f"Evicting {path} from download cache")
+            self.__unlink(path)
+            total -= size
+            evicted = True
+
+        if evicted:
+            # metas of evicted bodies are useless
+            for entry in os.scandir(self.directory / "urls"):
+                if self.__read_meta(Path(entry.path)) is None:
+                    self.__unlink(entry.path)
+
+    @staticmethod
+    def __unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def __read_meta(self, meta_path):
+        try:
+            meta = json.loads(meta_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        # body may have been evicted since
+        return meta if (self.directory / "blobs" / meta["key"]).exists() else None
+
+    @staticmethod
+    def __unmodified(headers, since):
+        """
+        Whether the file, having given stored headers, was not modified since given naive local datetime
+        """
+        last_modified = headers.get("Last-Modified")
+        return bool(
+            since
+            and last_modified
+            and parsedate_to_datetime(last_modified) <= since.astimezone(timezone.utc)
+        )
+
+    @staticmethod
+    def __hash(value):
+        return hashlib.sha256(value.encode()).hexdigest()
@@ -1,11 +1,15 @@
+from batimap.dataversion import DataVersion
 from batimap.db import Db
+from batimap.downloadcache import DownloadCache
+from batimap.listingcache import ListingCache
 from batimap.odcadastre import ODCadastre
 from batimap.overpass import Overpass
+from batimap.taskregistry import TaskRegistry
 from celery import Celery
 from flask_smorest import Api
 from flask_sqlalchemy import SQLAlchemy
 
-from batimap.batimap import Batimap
+from batimap.batimap import Batimap  # isort: skip
 
 sqlalchemy = SQLAlchemy()
 db = Db()
@@ -13,5 +17,9 @@ db = Db()
 api_smorest = Api()
 overpass = Overpass()
 batimap = Batimap()
+download_cache = DownloadCache()
+data_version = DataVersion()
+listing_cache = ListingCache()
 celery = Celery()
 odcadastre = ODCadastre()
+task_registry = TaskRegistry()
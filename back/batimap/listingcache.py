@@ -0,0 +1,106 @@
+import json
+import time
+from datetime import datetime
+
+import redis
+import requests
+from batimap import listings
+from flask import current_app
+
+
+class ListingCache(object):
+    """
+    Redis cache of the generated files listings of cadastre.openstreetmap.fr, shared by all workers.
+
+    Listings are downloaded through the DownloadCache, and their parsed rows are stored along with the key of
+    the download they come from. Entries are served as is for LISTING_CACHE_TTL seconds, then revalidated:
+    rows are only parsed again if the download changed.
+    """
+
+    url = "https://cadastre.openstreetmap.fr"
+    key_prefix = "batimap:listing:osm:"
+    # entries are kept much longer than the TTL so that stale entries can be revalidated
+    entries_ttl = 24 * 3600
+
+    def init_app(self, app, download_cache):
+        self.download_cache = download_cache
+        self.redis = redis.Redis.from_url(app.config["CELERY_BROKER_URL"])
+        self.ttl = app.config.get("LISTING_CACHE_TTL", 60)
+
+    def osm_listing(self, dept):
+        """
+        Returns the listing rows of the given (zero-filled) department
+        """
+        key = self.key_prefix + dept
+        entry = self.__get(key)
+        if entry and time.time() - entry["fetched_at"] < self.ttl:
+            current_app.logger.debug(f"Listing of department {dept} served from cache")
+            return self.__rows(entry)
+
+        try:
+            with self.download_cache.open(f"{self.url}/data/{dept}/") as download:
+                if entry and entry["download"] == download.key:
+                    current_app.logger.debug(
+                        f"Listing of department {dept} is unchanged"
+                    )
+                    rows = self.__rows(entry)
+                else:
+                    rows = list(
+                        listings.parse_osm_listing(
+                            listings.iter_chunks(download.fileobj),
+                            gzipped=download.headers.get("Content-Encoding") == "gzip",
+                            encoding=listings.content_charset(
+                                download.headers.get("Content-Type")
+                            ),
+                        )
+                    )
+        except requests.RequestException as e:
+            current_app.logger.warning(
+                f"Listing fetch failed for department {dept} ({e})"
+            )
+            return self.__rows(entry) if entry else []
+
+        self.__set(
+            key,
+            {
+                "download": download.key,
+                "fetched_at": time.time(),
+                "rows": [
+                    [code, format_type, name, date.isoformat() if date else None]
+                    for (code, format_type, name, date) in rows
+                ],
+            },
+        )
+        return rows
+
+    def invalidate(self, dept):
+        """
+        Drops the cached listing of the given (zero-filled) department, eg. once a new generation was requested
+        """
+        try:
+            self.redis.delete(self.key_prefix + dept)
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Could not invalidate listing of {dept}: {e}")
+
+    def __get(self, key):
+        try:
+            value = self.redis.get(key)
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Listing cache unavailable: {e}")
+            return None
+        return json.loads(value) if value else None
+
+    def __set(self, key, entry):
+        try:
+            self.redis.set(key, json.dumps(entry), ex=self.entries_ttl)
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Listing cache unavailable: {e}")
+
+    @staticmethod
+    def __rows(entry):
+        return [
+            listings.ListingRow(
+                code, format_type, name, datetime.fromisoformat(date) if date else None
+            )
+            for (code, format_type, name, date) in entry["rows"]
+        ]
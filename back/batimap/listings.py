@@ -0,0 +1,109 @@
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from email.message import Message
+
+from lxml import etree
+
+CHUNK_SIZE = 64 * 1024
+
+# code: cadastre city code (eg. "CL098") or cadastre name (eg. "CL098-COBONNE")
+# format: cadastre format ("VECT" or "IMAG") or generated file kind (eg. "houses-simplifie.osm")
+# name: city name (eg. "COBONNE") or generated file name (eg. "CL098-COBONNE-houses-simplifie.osm")
+# date: generation date of the file, if any
+ListingRow = namedtuple("ListingRow", ["code", "format", "name", "date"])
+
+
+def content_charset(content_type):
+    """
+    Returns the charset of a Content-Type header value, if any
+    """
+    if not content_type:
+        return None
+    message = Message()
+    message["Content-Type"] = content_type
+    return message.get_content_charset()
+
+
+def iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Reads a file-like object (eg. an urllib response) chunk by chunk
+    """
+    return iter(lambda: fileobj.read(chunk_size), b"")
+
+
+def parse_cadastre_listing(chunks, gzipped=False, encoding=None):
+    """
+    Parses the cities listing of a department on cadastre.gouv.fr (listerCommune.do), for instance:
+    ListingRow(code="CL098", format="VECT", name="COBONNE", date=None)
+    """
+    for tbody in _iter_elements(chunks, "tbody", gzipped, encoding):
+        if "parcelles" not in (tbody.get("class") or "").split():
+            continue
+        cart = tbody.find('.//*[@title="Ajouter au panier"]')
+        strong = tbody.find(".//strong")
+        if cart is None or strong is None:
+            continue
+
+        # onclick structure: "ajoutArticle('CL098','VECT','COMU');"
+        (_, code, _, format_type, _, _, _) = cart.get("onclick").split("'")
+
+        # strong structure: "COBONNE (26400) "
+        yield ListingRow(code, format_type, strong.text[:-9], None)
+
+
+def parse_osm_listing(chunks, gzipped=False, encoding=None):
+    """
+    Parses the generated files listing of a department on cadastre.openstreetmap.fr, for instance:
+    ListingRow(code="CL098-COBONNE", format="houses-simplifie.osm", name="CL098-COBONNE-houses-simplifie.osm",
+    date=datetime(2021, 5, 1, 12, 0))
+    """
+    for tr in _iter_elements(chunks, "tr", gzipped, encoding):
+        link = tr.find("td/a")
+        if link is None or not link.text:
+            continue
+        cells = tr.findall("td")
+        date = (
+            _parse_listing_date("".join(cells[2].itertext()).strip())
+            if len(cells) > 2
+            else None
+        )
+        parts = link.text.split("-")
+        yield ListingRow("-".join(parts[:-2]), "-".join(parts[-2:]), link.text, date)
+
+
+def _parse_listing_date(text):
+    for date_format in ("%Y-%m-%d %H:%M", "%d-%b-%Y %H:%M"):
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def _iter_elements(chunks, tag, gzipped, encoding):
+    """
+    Incrementally parses HTML chunks, yielding every complete element with the given tag.
+    Elements are freed once yielded, so memory is bounded by the size of a single element.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    parser = etree.HTMLPullParser(events=("end",), tag=tag, encoding=encoding)
+    for chunk in chunks:
+        parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+        yield from _read_events(parser)
+    if decompressor:
+        parser.feed(decompressor.flush())
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # empty document, nothing to yield
+        return
+    yield from _read_events(parser)
+
+
+def _read_events(parser):
+    for (_, element) in parser.read_events():
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
@@ -3,63 +3,104 @@
 
 import gzip
 from collections import Counter
-from datetime import datetime
-from typing import Optional
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from typing import Optional, Tuple
 
 import ijson
 import requests
 from batimap.db import Cadastre
 from flask import current_app
 
+try:
+    ijson_backend = ijson.get_backend("yajl2_c")
+except ImportError:
+    ijson_backend = ijson
+
 
 class ODCadastre(object):
-    def init_app(self, db):
+    CHUNK_SIZE = 1024 * 1024
+
+    def init_app(self, db, download_cache, data_version):
         self.db = db
+        self.download_cache = download_cache
+        self.data_version = data_version
 
-    def query_od(self, dept, city=None) -> Optional[Counter]:
+    @staticmethod
+    def od_url(dept, city=None):
         url = "https://cadastre.data.gouv.fr/data/etalab-cadastre/latest/geojson/"
         if city:
             url += f"communes/{dept}/{city}/cadastre-{city}-batiments.json.gz"
         else:
             url += f"departements/{dept}/cadastre-{dept}-batiments.json.gz"
+        return url
 
-        cadastre = self.db.get_cadastre_for_insee(city or dept)
-        if cadastre:
-            last_modified = requests.head(url).headers["Last-Modified"]
-            if last_modified:
-                last_modified_date = datetime.strptime(
-                    last_modified, "%a, %d %b %Y %H:%M:%S %Z"
-                )
-                if last_modified_date < cadastre.last_fetch:
-                    current_app.logger.debug(
-                        f"cadastre fetched version {cadastre.last_fetch} is newer that latest available "
-                        f"version {last_modified_date} for {city or dept}, using cache instead {cadastre}"
-                    )
-                    return Counter([city] * cadastre.od_buildings) if city else None
-
-        r = requests.get(url)
-
-        if r.status_code != 200:
+    def department_stamp(self, dept) -> Optional[str]:
+        """
+        Returns the version of the etalab file of the given department (its ETag, or else its Last-Modified
+        date), None if it could not be fetched
+        """
+        try:
+            r = requests.head(
+                self.od_url(dept),
+                allow_redirects=True,
+                timeout=self.download_cache.TIMEOUT,
+            )
+            r.raise_for_status()
+        except requests.RequestException as e:
             current_app.logger.warn(
-                f"cadastre fetch failed (url={url}, status={r.status_code})"
+                f"cadastre version unavailable (dept={dept}, error={e})"
             )
             return None
+        return r.headers.get("ETag") or r.headers.get("Last-Modified")
 
-        data = gzip.decompress(r.content)
-
-        # there is one feature per building, properties.commune containing its city INSEE
-        buildings_per_insee = Counter(
-            list(ijson.items(data, "features.item.properties.commune"))
+    def query_od(self, dept, city=None) -> Optional[Counter]:
+        cadastre = self.db.get_cadastre_for_insee(city or dept)
+        (modified, counts) = self.fetch_od(
+            self.od_url(dept, city), cadastre.last_fetch if cadastre else None
         )
+        if not modified:
+            current_app.logger.debug(
+                f"cadastre fetched version {cadastre.last_fetch} is up to date for {city or dept}, "
+                f"using cache instead {cadastre}"
+            )
+            return Counter([city] * cadastre.od_buildings) if city else None
+        return counts
+
+    def fetch_od(self, url, last_fetch=None) -> Tuple[bool, Optional[Counter]]:
+        """
+        Downloads and counts buildings of the given etalab file, unless it was not modified since last_fetch.
+        Does not use the database, so that it can run outside of the main thread.
 
-        return buildings_per_insee
+        Returns (modified, counts) where counts is None if the file could not be fetched
+        """
+        try:
+            with self.download_cache.open(url, since=last_fetch) as download:
+                if not download:
+                    return (False, None)
+                return (True, self.count_buildings(download.fileobj))
+        except requests.RequestException as e:
+            current_app.logger.warn(f"cadastre fetch failed (url={url}, error={e})")
+            return (True, None)
+
+    @classmethod
+    def count_buildings(cls, fileobj) -> Counter:
+        """
+        Counts buildings per INSEE of a gzipped etalab GeoJSON stream. The file is never fully loaded:
+        memory usage only depends on the chunk size and the number of cities.
+        """
+        with gzip.GzipFile(fileobj=fileobj) as data:
+            # there is one feature per building, properties.commune containing its city INSEE
+            return Counter(
+                ijson_backend.items(
+                    data, "features.item.properties.commune", buf_size=cls.CHUNK_SIZE
+                )
+            )
 
     def query_department_od(self, dept) -> Optional[Counter]:
         return self.query_od(dept)
 
     def query_city_od(self, insee) -> Optional[Counter]:
-        dept = insee[:3] if insee.startswith("97") else insee[:2]
-        return self.query_od(dept, insee)
+        return self.query_od(self.data_version.department_of(insee), insee)
 
     def compute_count(self, insee) -> Optional[Cadastre]:
         if len(insee) <= 3:
@@ -68,14 +109,58 @@ class ODCadastre(object):
             result = self.city_count(insee)
 
         self.db.session.commit()
+        self.data_version.bump([self.data_version.department_of(insee)])
         return result
 
+    def compute_counts(self, departments):
+        """
+        Fetches cadastre counts of the given departments concurrently (CADASTRE_FETCH_WORKERS downloads at once),
+        yielding each department once its counts are stored. Downloads and parsing happen in worker threads,
+        the database is only used from the calling thread.
+        """
+        app = current_app._get_current_object()
+        executor = ThreadPoolExecutor(
+            max_workers=app.config.get("CADASTRE_FETCH_WORKERS", 4)
+        )
+        futures = {}
+        try:
+            for dept in departments:
+                if not self.db.get_department(dept):
+                    yield dept
+                    continue
+                cadastre_dept = self.db.get_cadastre_for_insee(dept)
+                future = executor.submit(
+                    self.__fetch_od_in_context,
+                    app,
+                    self.od_url(dept),
+                    cadastre_dept.last_fetch if cadastre_dept else None,
+                )
+                futures[future] = dept
+
+            for future in as_completed(futures):
+                dept = futures[future]
+                (modified, counts) = future.result()
+                if not modified:
+                    current_app.logger.debug(f"cadastre is up to date for {dept}")
+                self.save_department_counts(dept, counts)
+                self.db.session.commit()
+                self.data_version.bump([dept])
+                yield dept
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def __fetch_od_in_context(self, app, url, last_fetch):
+        with app.app_context():
+            return self.fetch_od(url, last_fetch)
+
     def department_count(self, dept) -> Optional[Cadastre]:
         if not self.db.get_department(dept):
             return None
 
+        return self.save_department_counts(dept, self.query_department_od(dept))
+
+    def save_department_counts(self, dept, counts) -> Optional[Cadastre]:
         cadastre_dept = self.db.get_cadastre_for_insee(dept)
-        counts = self.query_department_od(dept)
 
         if counts:
             items = [
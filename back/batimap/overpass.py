@@ -1,10 +1,34 @@
+import re
 import time
+from collections import namedtuple
+from datetime import datetime
 
+import ijson
 import overpass
+import redis
+import requests
+import urllib3
 from flask import current_app
 
+try:
+    ijson_backend = ijson.get_backend("yajl2_c")
+except ImportError:
+    ijson_backend = ijson
+
+# type: OSM type of the building ("node", "way" or "relation"), or "city" for markers of batched requests
+# tags: building tag and requested tags, only when set
+BuildingElement = namedtuple("BuildingElement", ["type", "id", "timestamp", "tags"])
+
 
 class Overpass(object):
+    """
+    Sends Overpass queries to the public instance which currently performs best.
+
+    Latency (EWMA) and errors of each instance are shared by all workers through Redis. An instance failing
+    several times in a row is set aside (circuit breaker) for an increasing delay, and queries are only
+    dispatched to instances having a free slot according to their /api/status.
+    """
+
     # from https://wiki.openstreetmap.org/wiki/Overpass_API#Public_Overpass_API_instances
     instances_endpoints = [
         "https://overpass-api.de/api/interpreter",
@@ -13,53 +37,467 @@ class Overpass(object):
         "http://overpass.openstreetmap.fr/api/interpreter",
     ]
 
+    key_prefix = "batimap:overpass:"
+    # weight of the latest request in the latency average
+    LATENCY_ALPHA = 0.3
+    # consecutive failures before an endpoint is set aside, then for how long (doubled on each new failure)
+    BREAKER_THRESHOLD = 3
+    BREAKER_COOLDOWN = 60
+    BREAKER_MAX_COOLDOWN = 30 * 60
+    # longest wait for a free slot before dispatching anyway
+    MAX_SLOT_WAIT = 60
+    # wait before retrying a failing endpoint, or one without slot estimate (doubled on each new failure)
+    RETRY_BACKOFF = 5
+    MAX_RETRY_BACKOFF = 30
+    # errors of a query which may succeed on a smaller batch or on another endpoint (syntax errors excepted):
+    # reported by Overpass, raised while sending the request, or while reading its result (invalid JSON)
+    QUERY_ERRORS = (
+        overpass.errors.OverpassError,
+        requests.RequestException,
+        urllib3.exceptions.HTTPError,
+        ijson.JSONError,
+        ValueError,
+    )
+
+    __slots_regex = re.compile(r"^(\d+) slots? available now", re.M)
+    __slot_wait_regex = re.compile(
+        r"^Slot available after: .*, in (-?\d+) seconds?\.$", re.M
+    )
+    __rate_limit_regex = re.compile(r"^Rate limit: (\d+)$", re.M)
+
     def __init__(self):
-        self.__apis = []
-        self.__request = 0
-        for uri in self.instances_endpoints:
-            self.__apis.append(overpass.API(endpoint=uri, timeout=300))
-
-    def request_with_retries(self, request, output_format="json"):
-        apis = len(self.__apis)
-        for retry in range(9, 0, -1):
+        self.redis = None
+        self.timeout = 300
+
+    def init_app(self, app):
+        self.redis = redis.Redis.from_url(
+            app.config["CELERY_BROKER_URL"], decode_responses=True
+        )
+        self.timeout = app.config.get("OVERPASS_TIMEOUT", 300)
+
+    def request_with_retries(self, request, output_format="json", retries=9):
+        """
+        Returns the result of the request, retried on other endpoints if needed.
+        Raises the last error (one of QUERY_ERRORS) once retries are exhausted.
+        """
+        return self.__dispatch(
+            request,
+            retries,
+            self.__read_json if output_format == "json" else lambda r: r.text,
+        )
+
+    def iter_elements(self, request, retries=9, meta=None):
+        """
+        Streams the elements of a JSON request result as BuildingElement, without loading the whole response.
+        Since reading the result may fail (and be retried on another endpoint) until its very end, elements are
+        only yielded once all of them were read.
+        If given, meta dict is filled with the timestamp_osm_base of the result.
+        """
+
+        def read(r):
+            r.raw.decode_content = True
+            result_meta = {}
+            elements = list(self.__iter_json_elements(r.raw, result_meta))
+            if meta is not None:
+                meta.update(result_meta)
+            return elements
+
+        yield from self.__dispatch(request, retries, read, stream=True)
+
+    def __dispatch(self, request, retries, read, stream=False):
+        """
+        Sends the request to the best endpoint and returns its response read by the read function, retrying on
+        other endpoints when sending or reading it fails
+        """
+        current_app.logger.debug(f"Overpass request:\n{request}")
+        last_error = None
+        failed = set()
+        backoff = 0
+        for retry in range(retries, 0, -1):
+            endpoint = self.__pick_endpoint(failed, backoff)
+            current_app.logger.info(f"Executing Overpass on server {endpoint}")
+            start = time.time()
             try:
-                api = self.__apis[self.__request % apis]
+                with self.__post(endpoint, request, stream) as r:
+                    result = read(r)
+                # the endpoint is only healthy if its whole result could be read, which is its latency
+                self.__record_success(endpoint, time.time() - start)
+                return result
+            except overpass.errors.OverpassSyntaxError:
+                # our fault, not the endpoint's one
+                raise
+            except self.QUERY_ERRORS as e:
+                self.__record_failure(endpoint, e)
+                failed.add(endpoint)
                 current_app.logger.warning(
-                    f"Executing Overpass on server {api.endpoint} with request:\n{request}"
+                    f"{type(e).__name__} occurred on {endpoint}. Will retry again {retry - 1} times"
                 )
-                self.__request += 1
-                return api.Get(request, responseformat=output_format, build=False)
-            except (
-                overpass.errors.MultipleRequestsError,
-                overpass.errors.ServerLoadError,
-            ) as e:
-                current_app.logger.warning(
-                    f"{type(e).__name__} occurred. Will retry again {retry} times in a few seconds"
+                last_error = e
+                backoff = min(
+                    max(2 * backoff, self.RETRY_BACKOFF), self.MAX_RETRY_BACKOFF
                 )
-                if retry == 0:
-                    raise e
-                else:
-                    # Sleep for n * 5 seconds before a new attempt
-                    time.sleep(5 * round((10 - retry) / 3))
-            except Exception as e:
-                if retry == 0:
-                    raise e
+
+        raise last_error
+
+    @staticmethod
+    def __read_json(r):
+        response = r.json()
+        # results are partial if the query failed while running (timeout, out of memory...)
+        remark = response.get("remark")
+        if remark and remark.startswith("runtime error"):
+            raise overpass.errors.ServerRuntimeError(remark)
+        return response
+
+    @classmethod
+    def __iter_json_elements(cls, fileobj, meta=None):
+        builder = None
+        for (prefix, event, value) in ijson_backend.parse(fileobj):
+            if builder:
+                builder.event(event, value)
+                if prefix == "elements.item" and event == "end_map":
+                    yield cls.__element(builder.value)
+                    builder = None
+            elif prefix == "elements.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == "osm3s.timestamp_osm_base" and meta is not None:
+                meta["timestamp_osm_base"] = datetime.strptime(
+                    value, "%Y-%m-%dT%H:%M:%SZ"
+                )
+            elif prefix == "remark" and value.startswith("runtime error"):
+                # results are partial if the query failed while running (timeout, out of memory...)
+                raise overpass.errors.ServerRuntimeError(value)
+
+    @staticmethod
+    def __element(value):
+        tags = value.get("tags", {})
+        if value["type"] != "building":
+            # not a building, eg. a city marker
+            return BuildingElement(value["type"], value.get("id"), None, tags)
+        return BuildingElement(
+            tags.pop("osm_type"),
+            value["id"],
+            tags.pop("timestamp"),
+            {k: v for (k, v) in tags.items() if v},
+        )
+
+    CACHE_ACCESSES = ["hits", "refreshes", "misses"]
+
+    def record_cache_access(self, access):
+        """
+        Counts cities summaries served from cache ("hits"), refreshed with their latest changes only
+        ("refreshes") or requiring a full Overpass query ("misses")
+        """
+        if not self.redis:
+            return
+        try:
+            self.redis.incr(self.key_prefix + "cache:" + access)
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Overpass stats unavailable: {e}")
+
+    def cache_stats(self):
+        try:
+            counts = self.redis.mget(
+                *[self.key_prefix + "cache:" + a for a in self.CACHE_ACCESSES]
+            )
+        except (AttributeError, redis.RedisError):
+            counts = [None] * len(self.CACHE_ACCESSES)
+        return {a: int(c or 0) for (a, c) in zip(self.CACHE_ACCESSES, counts)}
+
+    def stats(self):
+        """
+        Returns the scheduling state of every endpoint, best one first
+        """
+        now = time.time()
+        stats = self.__load_stats()
+        result = []
+        for endpoint in self.instances_endpoints:
+            s = stats[endpoint]
+            requests_count = int(s.get("requests", 0))
+            errors = int(s.get("errors", 0))
+            open_until = float(s.get("open_until", 0))
+            result.append(
+                {
+                    "endpoint": endpoint,
+                    "latency": float(s["latency"]) if "latency" in s else None,
+                    "requests": requests_count,
+                    "errors": errors,
+                    "error_rate": round(errors / requests_count, 3)
+                    if requests_count
+                    else None,
+                    "consecutive_failures": int(s.get("consecutive_failures", 0)),
+                    "circuit": "open" if open_until > now else "closed",
+                    "open_until": open_until if open_until > now else None,
+                    "last_error": s.get("last_error"),
+                    "score": self.__score(s),
+                }
+            )
+        return sorted(result, key=lambda x: (x["circuit"] == "open", x["score"]))
+
+    def __pick_endpoint(self, failed, backoff=0):
+        """
+        Returns the best endpoint having its circuit closed and a free slot, waiting for one if needed.
+        Endpoints which already failed for the current query are only used when no other one is left.
+        Once the query failed, endpoints which failed or have no slot estimate are only used after backoff
+        seconds, so that retries do not loop hot.
+        """
+        now = time.time()
+        stats = self.__load_stats()
+        closed = [
+            e
+            for e in self.instances_endpoints
+            if float(stats[e].get("open_until", 0)) <= now
+        ]
+        closed = [e for e in closed if e not in failed] or closed
+        if not closed:
+            # every endpoint is failing: try the one which will recover first
+            closed = [
+                min(
+                    self.instances_endpoints,
+                    key=lambda e: float(stats[e].get("open_until", 0)),
+                )
+            ]
+
+        candidates = sorted(closed, key=lambda e: self.__score(stats[e]))
+        waits = {}
+        for endpoint in candidates:
+            wait = self.__slot_wait(endpoint)
+            if wait is None or endpoint in failed:
+                wait = max(wait or 0, backoff)
+            if wait <= 0:
+                return endpoint
+            waits[endpoint] = wait
+
+        endpoint = min(candidates, key=lambda e: waits[e])
+        wait = min(waits[endpoint], self.MAX_SLOT_WAIT)
+        current_app.logger.info(
+            f"Waiting {wait}s before querying Overpass on {endpoint}"
+        )
+        time.sleep(wait)
+        return endpoint
+
+    def __slot_wait(self, endpoint):
+        """
+        Returns how many seconds to wait before the endpoint accepts a query according to its /api/status,
+        None if it is unknown
+        """
+        try:
+            r = requests.get(endpoint.replace("/interpreter", "/status"), timeout=5)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            # not every instance exposes its status, do not hold that against it
+            current_app.logger.debug(f"Could not get status of {endpoint}: {e}")
+            return None
+
+        rate_limit = self.__rate_limit_regex.search(r.text)
+        if (rate_limit and rate_limit.group(1) == "0") or self.__slots_regex.search(
+            r.text
+        ):
+            return 0
+        waits = [int(x) for x in self.__slot_wait_regex.findall(r.text)]
+        return max(min(waits), 0) if waits else None
+
+    def __post(self, endpoint, request, stream=False):
+        try:
+            r = requests.post(
+                endpoint,
+                data={"data": request},
+                timeout=self.timeout,
+                stream=stream,
+                headers={"Accept-Charset": "utf-8;q=0.7,*;q=0.7"},
+            )
+        except requests.exceptions.Timeout:
+            raise overpass.errors.TimeoutError(self.timeout)
+
+        if r.status_code == 400:
+            raise overpass.errors.OverpassSyntaxError(request)
+        elif r.status_code == 429:
+            raise overpass.errors.MultipleRequestsError()
+        elif r.status_code == 504:
+            raise overpass.errors.ServerLoadError(self.timeout)
+        elif r.status_code != 200:
+            raise overpass.errors.UnknownOverpassError(
+                f"The request returned status code {r.status_code}"
+            )
+        r.encoding = "utf-8"
+        return r
+
+    def __score(self, stats):
+        """
+        Expected cost of a query on an endpoint: its latency, penalized by its error rate.
+        Unknown endpoints get a good score so that they are tried.
+        """
+        latency = float(stats.get("latency", 1))
+        requests_count = int(stats.get("requests", 0))
+        error_rate = (
+            int(stats.get("errors", 0)) / requests_count if requests_count else 0
+        )
+        return latency * (1 + 4 * error_rate)
+
+    def __load_stats(self):
+        stats = {e: {} for e in self.instances_endpoints}
+        if not self.redis:
+            return stats
+        try:
+            with self.redis.pipeline() as pipe:
+                for e in self.instances_endpoints:
+                    pipe.hgetall(self.key_prefix + e)
+                for (e, s) in zip(self.instances_endpoints, pipe.execute()):
+                    stats[e] = s
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Overpass stats unavailable: {e}")
+        return stats
+
+    def __record_success(self, endpoint, duration):
+        s = self.__load_stats()[endpoint]
+        latency = (
+            self.LATENCY_ALPHA * duration
+            + (1 - self.LATENCY_ALPHA) * float(s["latency"])
+            if "latency" in s
+            else duration
+        )
+        self.__update(
+            endpoint,
+            {"latency": latency, "consecutive_failures": 0, "open_until": 0},
+            {"requests": 1},
+        )
+
+    def __record_failure(self, endpoint, error):
+        s = self.__load_stats()[endpoint]
+        failures = int(s.get("consecutive_failures", 0)) + 1
+        values = {"consecutive_failures": failures, "last_error": type(error).__name__}
+        if failures >= self.BREAKER_THRESHOLD:
+            cooldown = min(
+                self.BREAKER_COOLDOWN * 2 ** (failures - self.BREAKER_THRESHOLD),
+                self.BREAKER_MAX_COOLDOWN,
+            )
+            current_app.logger.warning(
+                f"{endpoint} failed {failures} times in a row, setting it aside for {cooldown}s"
+            )
+            values["open_until"] = time.time() + cooldown
+        self.__update(endpoint, values, {"requests": 1, "errors": 1})
+
+    def __update(self, endpoint, values, increments):
+        if not self.redis:
+            return
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.hset(self.key_prefix + endpoint, mapping=values)
+                for (field, increment) in increments.items():
+                    pipe.hincrby(self.key_prefix + endpoint, field, increment)
+                pipe.execute()
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Overpass stats unavailable: {e}")
+
+    @staticmethod
+    def area_id(osm_id):
+        """
+        Returns the Overpass area id of an imposm boundary id (negative for relations)
+        """
+        return 3600000000 - osm_id if osm_id < 0 else 2400000000 + osm_id
+
+    def get_cities_buildings(self, cities, batch_size=10, node_tags=[]):
+        """
+        Same as get_city_buildings for many cities at once, cities being (insee, boundaries imposm ids) tuples.
+        Yields (insee, elements, timestamp_osm_base) for every city, elements being None if its buildings could
+        not be fetched (even alone in its batch).
+        """
+        for i in range(0, len(cities), batch_size):
+            batch = cities[i:][:batch_size]
+            yield from self.__get_batch_buildings(batch, node_tags)
+
+    def __get_batch_buildings(self, cities, node_tags):
+        # each city buildings are preceded by a "city" marker element, used to split the result
+        request = "[out:json];" + "".join(
+            f"""
+            make city insee="{insee}";
+            out;
+            area(id:{",".join(str(self.area_id(x)) for x in osm_ids)})->.a;"""
+            + self.__buildings_query(node_tags)
+            for (insee, osm_ids) in cities
+        )
+        per_insee = {}
+        meta = {}
+        try:
+            # the whole batch is read before yielding anything, since an error may be reported at the very end
+            for element in self.iter_elements(request, retries=2, meta=meta):
+                if element.type == "city":
+                    buildings = per_insee[element.tags["insee"]] = []
                 else:
-                    current_app.logger.warning(
-                        f"Unhandled exception occurred: {e}, trying next endpoint"
-                    )
-        return None
+                    buildings.append(element)
+        except overpass.errors.OverpassSyntaxError:
+            raise
+        except self.QUERY_ERRORS as e:
+            if len(cities) == 1:
+                current_app.logger.warning(
+                    f"Could not fetch buildings of {cities[0][0]}: {type(e).__name__}"
+                )
+                yield (cities[0][0], None, None)
+                return
+            half = len(cities) // 2
+            current_app.logger.info(
+                f"{type(e).__name__} for a batch of {len(cities)} cities, splitting it"
+            )
+            yield from self.__get_batch_buildings(cities[:half], node_tags)
+            yield from self.__get_batch_buildings(cities[half:], node_tags)
+            return
+
+        for (insee, _) in cities:
+            yield (insee, per_insee.get(insee), meta.get("timestamp_osm_base"))
+
+    @staticmethod
+    def __buildings_query(node_tags, newer=""):
+        """
+        Outputs buildings of area .a with only the fields needed to compute their import date: type, id,
+        timestamp, building tag and for nodes, the given tags. newer is an optional extra filter.
+        """
+        fields = '::id=id(), osm_type=type(), timestamp=timestamp(), "building"=t["building"]'
+        node_fields = "".join(f', "{tag}"=t["{tag}"]' for tag in node_tags)
+        return f"""
+            node['building'](area.a){newer};
+            convert building {fields}{node_fields};
+            out;
+            (
+              way['building'](area.a){newer};
+              relation['building'](area.a){newer};
+            );
+            convert building {fields};
+            out;"""
+
+    @staticmethod
+    def __city_area(city):
+        return f"area[boundary='administrative'][admin_level~'8|9']['ref:INSEE'='{city.insee}']->.a;"
+
+    def get_city_buildings(self, city, node_tags=[], meta=None):
+        """
+        Streams the buildings of given city, see iter_elements
+        """
+        request = (
+            "[out:json];" + self.__city_area(city) + self.__buildings_query(node_tags)
+        )
+        return self.iter_elements(request, meta=meta)
 
-    def get_city_buildings(self, city):
+    def get_city_buildings_since(self, city, since, meta, node_tags=[]):
         """
-        Compute the latest import date for given city
+        Streams the buildings of given city created or modified since given UTC datetime.
+        Deleted buildings are not reported: the current buildings count of the city is stored in
+        meta["buildings"] instead, before any building is yielded.
         """
-        request = f"""[out:json];
-            area[boundary='administrative'][admin_level~'8|9']['ref:INSEE'='{city.insee}']->.a;
+        newer = f'(newer:"{since:%Y-%m-%dT%H:%M:%SZ}")'
+        request = (
+            "[out:json];"
+            + self.__city_area(city)
+            + """
             (
               node['building'](area.a);
               way['building'](area.a);
               relation['building'](area.a);
             );
-            out tags qt meta;"""
-        return self.request_with_retries(request).get("elements")
+            out count;"""
+            + self.__buildings_query(node_tags, newer)
+        )
+        for element in self.iter_elements(request, meta=meta):
+            if element.type == "count":
+                meta["buildings"] = int(element.tags["total"])
+            else:
+                yield element
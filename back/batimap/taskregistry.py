@@ -0,0 +1,258 @@
+import hashlib
+import json
+import time
+
+import redis
+from celery.signals import before_task_publish, task_postrun, task_prerun, task_revoked
+from celery.states import FAILURE, IGNORED, READY_STATES
+from celery.utils import uuid
+from flask import current_app
+
+
+def task_result(value):
+    """
+    Decodes a task result or progress, as stored JSON encoded by tasks
+    """
+    try:
+        return json.loads(value) if value else None
+    except Exception:
+        return {"error": f"Task failed: {value}"}
+
+
+class TaskRegistry(object):
+    """
+    Redis registry of the pending and running Celery tasks, maintained by Celery signals so that tasks
+    can be listed and looked up without broadcasting inspect requests to workers.
+
+    Tasks submitted through submit are deduplicated by (name, args): the first submission atomically
+    claims the dedup key and every other one gets its task id until the task finishes.
+
+    Progress and final state of tasks are also published on Redis pub/sub, to be streamed to clients.
+    """
+
+    key_prefix = "batimap:task:"
+    # releases the dedup key only if it still belongs to the given task
+    release_script = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+    # claims the dedup key and registers the task at once, unless the key belongs to a registered task:
+    # returns the task id and whether it was claimed
+    claim_script = """
+        local existing = redis.call('get', KEYS[1])
+        if existing and redis.call('exists', ARGV[1] .. existing) == 1 then
+            return {existing, 0}
+        end
+        local entry = ARGV[1] .. ARGV[2]
+        redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        redis.call('hset', entry, 'name', ARGV[4], 'args', ARGV[5], 'dedup', KEYS[1])
+        redis.call('expire', entry, ARGV[3])
+        redis.call('zadd', ARGV[1] .. 'all', 'NX', ARGV[6], ARGV[2])
+        return {ARGV[2], 1}
+    """
+
+    def init_app(self, app):
+        self.redis = redis.Redis.from_url(
+            app.config["CELERY_BROKER_URL"], decode_responses=True
+        )
+        # entries of tasks lost by a dead worker expire after that delay
+        self.ttl = app.config.get("TASK_REGISTRY_TTL", 24 * 3600)
+        self.release = self.redis.register_script(self.release_script)
+        self.claim = self.redis.register_script(self.claim_script)
+        # signals are also received outside of any app context
+        self.logger = app.logger
+
+        before_task_publish.connect(self.__on_publish, weak=False)
+        task_prerun.connect(self.__on_prerun, weak=False)
+        task_postrun.connect(self.__on_postrun, weak=False)
+        task_revoked.connect(self.__on_revoked, weak=False)
+
+    def __dedup_key(self, name, args):
+        digest = hashlib.sha1(f"{name}\n{json.dumps(list(args))}".encode()).hexdigest()
+        return self.key_prefix + "dedup:" + digest
+
+    def submit(self, task, *args):
+        """
+        Enqueues the given task unless the same task with the same args is already pending or running.
+        Returns (task id, whether it was created).
+        """
+        key = self.__dedup_key(task.name, args)
+        (task_id, created) = self.claim(
+            keys=[key],
+            args=[
+                self.key_prefix,
+                uuid(),
+                self.ttl,
+                task.name,
+                json.dumps(list(args)),
+                time.time(),
+            ],
+        )
+        if not created:
+            current_app.logger.info(
+                f"found a task with same context (name={task.name}, args={list(args)})!"
+            )
+            return (task_id, False)
+
+        try:
+            task.apply_async(args, task_id=task_id)
+        except Exception:
+            self.__remove(task_id)
+            raise
+        return (task_id, True)
+
+    def tasks(self):
+        """
+        Returns the pending and running tasks, oldest first, as dicts (id, name, args, time_start)
+        """
+        ids = self.redis.zrange(self.key_prefix + "all", 0, -1)
+        with self.redis.pipeline() as pipe:
+            for task_id in ids:
+                pipe.hgetall(self.key_prefix + task_id)
+            entries = pipe.execute()
+
+        result = []
+        for (task_id, entry) in zip(ids, entries):
+            if not entry:
+                # expired entry of a lost task
+                self.redis.zrem(self.key_prefix + "all", task_id)
+                continue
+            result.append(
+                {
+                    "id": task_id,
+                    "name": entry["name"],
+                    "args": json.loads(entry["args"]),
+                    "time_start": float(entry["time_start"])
+                    if entry.get("time_start")
+                    else None,
+                }
+            )
+        return result
+
+    def publish(self, task_id, state, result):
+        try:
+            self.redis.publish(
+                self.key_prefix + task_id + ":events",
+                json.dumps({"state": state, "result": result}),
+            )
+        except redis.RedisError as e:
+            self.logger.warning(f"Could not publish task {task_id} state: {e}")
+
+    def fail(self, task_id, error):
+        """
+        Publishes the failure of a task which could not report it itself (because one of its subtasks
+        failed), and unregisters it
+        """
+        self.publish(task_id, FAILURE, {"error": error})
+        self.__unregister(task_id)
+
+    def start_progress(self, task_id, members):
+        """
+        Starts tracking the progress of the given task as the mean progress of its members (subtasks)
+        """
+        key = self.key_prefix + task_id + ":progress"
+        with self.redis.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping={member: 0 for member in members})
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+
+    def aggregate_progress(self, task_id, member, current):
+        """
+        Records the progress of a member of the given task, returning the task progress
+        """
+        key = self.key_prefix + task_id + ":progress"
+        with self.redis.pipeline() as pipe:
+            pipe.hset(key, member, current)
+            pipe.hvals(key)
+            (_, progresses) = pipe.execute()
+        return sum(float(p) for p in progresses) / len(progresses)
+
+    def events(self, task_id, status, keepalive=15, timeout=300):
+        """
+        Yields the state events ({state, result}) of the given task, starting with its current status, until
+        it is finished or timeout seconds elapsed. None is yielded every keepalive seconds without event.
+        status is a function returning the current status of the task, read again when no event is received
+        in case some were missed.
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # subscribe first, so that no event is missed between the status read and the subscription
+        pubsub.subscribe(self.key_prefix + task_id + ":events")
+        try:
+            event = status()
+            yield event
+            deadline = time.monotonic() + timeout
+            while event["state"] not in READY_STATES and time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=keepalive)
+                if message:
+                    event = json.loads(message["data"])
+                    yield event
+                    continue
+                current = status()
+                yield current if current != event else None
+                event = current
+        finally:
+            pubsub.close()
+
+    def __register(self, task_id, name, args):
+        # tasks replacing another one keep its id, and its entry
+        if self.redis.exists(self.key_prefix + task_id):
+            return
+        args = list(args)
+        with self.redis.pipeline() as pipe:
+            pipe.hset(
+                self.key_prefix + task_id,
+                mapping={
+                    "name": name,
+                    "args": json.dumps(args),
+                    "dedup": self.__dedup_key(name, args),
+                },
+            )
+            pipe.expire(self.key_prefix + task_id, self.ttl)
+            pipe.zadd(self.key_prefix + "all", {task_id: time.time()}, nx=True)
+            pipe.execute()
+
+    def __remove(self, task_id):
+        dedup = self.redis.hget(self.key_prefix + task_id, "dedup")
+        if dedup:
+            self.release(keys=[dedup], args=[task_id])
+        with self.redis.pipeline() as pipe:
+            pipe.delete(
+                self.key_prefix + task_id, self.key_prefix + task_id + ":progress"
+            )
+            pipe.zrem(self.key_prefix + "all", task_id)
+            pipe.execute()
+
+    def __on_publish(self, sender=None, headers=None, body=None, **kwargs):
+        # task message protocol 2: task info in headers, (args, kwargs, embed) as body
+        try:
+            self.__register(headers["id"], sender, body[0])
+        except redis.RedisError as e:
+            self.logger.warning(f"Could not register task {headers['id']}: {e}")
+
+    def __on_prerun(self, task_id=None, **kwargs):
+        try:
+            # tasks run eagerly are not published, hence not registered
+            if self.redis.exists(self.key_prefix + task_id):
+                self.redis.hset(self.key_prefix + task_id, "time_start", time.time())
+        except redis.RedisError as e:
+            self.logger.warning(f"Could not mark task {task_id} as started: {e}")
+
+    def __on_postrun(self, task_id=None, state=None, retval=None, **kwargs):
+        if state == IGNORED:
+            # replaced by another task with the same id, which is not finished yet
+            return
+        # the result backend already has the final state when this is received
+        self.publish(task_id, state, task_result(retval))
+        self.__unregister(task_id)
+
+    def __on_revoked(self, request=None, **kwargs):
+        self.__unregister(request.id)
+
+    def __unregister(self, task_id):
+        try:
+            self.__remove(task_id)
+        except redis.RedisError as e:
+            self.logger.warning(f"Could not unregister task {task_id}: {e}")
@@ -1,10 +1,19 @@
 import json
+from datetime import timedelta
 from pathlib import Path
 
 from batimap.app import BatimapEncoder
 from batimap.citydto import CityDTO
-from batimap.extensions import batimap, celery, db, odcadastre
+from batimap.extensions import (
+    batimap,
+    celery,
+    data_version,
+    db,
+    odcadastre,
+    task_registry,
+)
 from batimap.tasks.utils import task_progress
+from celery import chord
 from flask import current_app
 
 
@@ -12,67 +21,95 @@ class JosmNotReadyException(Exception):
     pass
 
 
+FLUSH_ALL_TILES_PATH = Path("tiles/flush_all_tiles")
+
+
 @celery.task(bind=True)
-def task_initdb(self, items):
+def task_initdb(self, items, force=False):
     """
     Fetch OSM and Cadastre data for given departments/cities.
+    Steps already done on whole departments are skipped while their checkpoint is fresh, unless force is set.
+    When run by a worker, departments are processed concurrently by task_initdb_department subtasks, then
+    task_initdb_finalize (or task_initdb_failed if one of them failed) replaces this task. Otherwise (from the
+    CLI), they are processed in this task.
     """
-    flush_all_tiles_path = Path("tiles/flush_all_tiles")
-
     items_are_cities = len([1 for x in items if len(x) > 3]) > 0
     if items_are_cities:
-        departments = list(
-            set([db.get_city_for_insee(insee).department for insee in items])
-        )
-        departments = sorted([d for d in departments if d is not None])
+        items_per_department = {}
+        for insee in items:
+            department = db.get_city_for_insee(insee).department
+            if department is not None:
+                items_per_department.setdefault(department, []).append(insee)
+        departments = sorted(items_per_department.keys())
         current_app.logger.debug(
             f"Will run initdb on departments {departments} from cities {items}"
         )
     else:
         departments = items
+        items_per_department = {d: [d] for d in departments}
         current_app.logger.debug(f"Will run initdb on departments {departments}")
 
     # if few items must be processed we'll clear only these specific tiles,
     # otherwise we flush all France tiles and regenerate all of them
     flush_all_tiles = len(departments) >= 5 or len(items) >= 100
 
-    if flush_all_tiles and flush_all_tiles_path.exists():
-        flush_all_tiles_path.unlink()
+    if flush_all_tiles and FLUSH_ALL_TILES_PATH.exists():
+        FLUSH_ALL_TILES_PATH.unlink()
 
-    # fill table with cities from cadastre website
-    p = 20
+    if not self.request.id or not departments:
+        initdb_departments(
+            departments,
+            items,
+            items_are_cities,
+            lambda current: task_progress(self, current),
+            force,
+        )
+        return task_initdb_finalize(items, departments, flush_all_tiles)
 
-    current_app.logger.debug(
-        f"Will compute cadastre stats on departments {departments}"
-    )
-    for (idx, d) in enumerate(departments):
-        odcadastre.compute_count(d)
-        task_progress(self, 0 * p + (idx + 1) / len(departments) * p)
-    current_app.logger.debug(f"Will update raster state on departments {departments}")
-    for d in batimap.update_departments_raster_state(departments):
-        task_progress(self, 1 * p + d / len(departments) * p)
-    current_app.logger.debug(f"Will update OSM state on departments {departments}")
-    for d in batimap.fetch_departments_osm_state(departments):
-        task_progress(self, 2 * p + d / len(departments) * p)
-    current_app.logger.debug(f"Will import cities stats on departments {departments}")
-    for d in batimap.import_city_stats_from_osmplanet(items):
-        task_progress(self, 3 * p + d / len(items) * p)
-    current_app.logger.debug(
-        f"Will compute unknown cities stats on departments {departments}"
+    task_registry.start_progress(self.request.id, departments)
+    return self.replace(
+        chord(
+            [
+                task_initdb_department.s(
+                    self.request.id, d, items_per_department[d], items_are_cities, force
+                )
+                for d in departments
+            ],
+            task_initdb_finalize.si(items, departments, flush_all_tiles).on_error(
+                task_initdb_failed.si(self.request.id)
+            ),
+        )
     )
-    unknowns = (
-        [c for c in items if db.get_city_for_insee(c).import_date == "unknown"]
-        if items_are_cities
-        else [c.insee for c in db.get_unknown_cities(departments)]
+
+
+@celery.task(bind=True)
+def task_initdb_department(
+    self, parent_id, department, items, items_are_cities, force=False
+):
+    """
+    Fetch OSM and Cadastre data for given items of a single department, reporting progress to parent_id.
+    """
+    initdb_departments(
+        [department],
+        items,
+        items_are_cities,
+        lambda current: task_progress(
+            self,
+            task_registry.aggregate_progress(parent_id, department, current),
+            task_id=parent_id,
+        ),
+        force,
     )
-    for (d, total) in batimap.compute_date_for_undated_cities(unknowns):
-        task_progress(self, 4 * p + d / total * p)
 
+
+@celery.task(bind=True)
+def task_initdb_finalize(self, items, departments, flush_all_tiles):
     current_app.logger.debug(f"Finalizing initdb on departments {departments}")
     db.session.commit()
+    data_version.bump(departments)
 
     if flush_all_tiles:
-        flush_all_tiles_path.touch()
+        FLUSH_ALL_TILES_PATH.touch()
     else:
         for insee in items:
             batimap.clear_tiles(insee)
@@ -80,6 +117,136 @@ def task_initdb(self, items):
     task_progress(self, 100)
 
 
+@celery.task(bind=True)
+def task_initdb_failed(self, parent_id):
+    """
+    Errback of task_initdb_finalize: when a department subtask fails, finalize never runs, hence the initdb task
+    would never be unregistered and identical initdb requests would keep getting it.
+    """
+    current_app.logger.error(f"Initdb {parent_id} failed on some departments")
+    task_registry.fail(parent_id, "Initdb failed on some departments")
+
+
+class InitdbCheckpoints(object):
+    """
+    Tells which departments an initdb step must run on, and records their completion. Once a step runs on a
+    department, the following ones run too since their input changed.
+    """
+
+    def __init__(self, departments, enabled, force):
+        self.departments = departments
+        # partial runs (on some cities) do not complete departments steps
+        self.enabled = enabled
+        self.force = force
+        self.max_age = timedelta(
+            seconds=current_app.config.get("INITDB_CHECKPOINT_TTL", 24 * 3600)
+        )
+        self.ran = set()
+        self.stamps = {}
+        self.checkpoints = {
+            (c.department, c.phase): c for c in db.get_initdb_checkpoints(departments)
+        }
+
+    def input_stamp(self, department, phase):
+        """
+        Freshness stamp of the input data of the given step on a department, computed once per run: the
+        version (ETag or Last-Modified) of its etalab cadastre file, or the last OSM change applied by imposm
+        to its cities. Other steps inputs have no stamp, their checkpoints only expire with time.
+        """
+        if (department, phase) not in self.stamps:
+            self.stamps[(department, phase)] = (
+                odcadastre.department_stamp(department)
+                if phase == "cadastre"
+                else db.get_initdb_input_stamp(department, phase)
+            )
+        return self.stamps[(department, phase)]
+
+    def is_fresh(self, department, phase):
+        checkpoint = self.checkpoints.get((department, phase))
+        return checkpoint is not None and checkpoint.is_fresh(
+            self.input_stamp(department, phase), self.max_age
+        )
+
+    def todo(self, phase):
+        if not self.enabled or self.force:
+            return self.departments
+        todo = [
+            d for d in self.departments if d in self.ran or not self.is_fresh(d, phase)
+        ]
+        skipped = [d for d in self.departments if d not in todo]
+        if skipped:
+            current_app.logger.info(
+                f"Étape {phase} déjà faite pour les départements {skipped}"
+            )
+        return todo
+
+    def done(self, department, phase):
+        self.ran.add(department)
+        if self.enabled:
+            db.save_initdb_checkpoint(
+                department, phase, self.input_stamp(department, phase)
+            )
+
+
+def initdb_status(departments):
+    """
+    Returns, for each given department, the initdb steps checkpoints (completion date, whether it is fresh)
+    """
+    checkpoints = InitdbCheckpoints(departments, enabled=True, force=False)
+    status = {department: {} for department in departments}
+    for ((department, phase), checkpoint) in checkpoints.checkpoints.items():
+        status[department][phase] = {
+            "completed_at": checkpoint.completed_at.isoformat(),
+            "fresh": checkpoints.is_fresh(department, phase),
+        }
+    return status
+
+
+def initdb_departments(departments, items, items_are_cities, progress, force=False):
+    """
+    Runs each initdb step on all given departments, items being either these departments or some of their
+    cities. progress is called with the overall progress percentage.
+    """
+    checkpoints = InitdbCheckpoints(departments, not items_are_cities, force)
+    # fill table with cities from cadastre website
+    p = 20
+
+    todo = checkpoints.todo("cadastre")
+    current_app.logger.debug(f"Will compute cadastre stats on departments {todo}")
+    for (idx, d) in enumerate(odcadastre.compute_counts(todo)):
+        checkpoints.done(d, "cadastre")
+        progress(0 * p + (idx + 1) / len(todo) * p)
+    todo = checkpoints.todo("raster")
+    current_app.logger.debug(f"Will update raster state on departments {todo}")
+    for d in batimap.update_departments_raster_state(todo):
+        checkpoints.done(todo[d - 1], "raster")
+        progress(1 * p + d / len(todo) * p)
+    todo = checkpoints.todo("osm")
+    current_app.logger.debug(f"Will update OSM state on departments {todo}")
+    for d in batimap.fetch_departments_osm_state(todo):
+        checkpoints.done(todo[d - 1], "osm")
+        progress(2 * p + d / len(todo) * p)
+    todo = checkpoints.todo("buildings")
+    current_app.logger.debug(f"Will import cities stats on departments {todo}")
+    stats_items = items if items_are_cities else todo
+    for d in batimap.import_city_stats_from_osmplanet(stats_items):
+        checkpoints.done(stats_items[d - 1], "buildings")
+        progress(3 * p + d / len(stats_items) * p)
+    todo = checkpoints.todo("unknowns")
+    current_app.logger.debug(f"Will compute unknown cities stats on departments {todo}")
+    unknowns = (
+        [c for c in items if db.get_city_for_insee(c).import_date == "unknown"]
+        if items_are_cities
+        else [c.insee for c in db.get_unknown_cities(todo)]
+    )
+    for (d, total) in batimap.compute_date_for_undated_cities(unknowns):
+        progress(4 * p + d / total * p)
+    db.session.commit()
+    for d in todo:
+        checkpoints.done(d, "unknowns")
+    progress(5 * p)
+
+
 @celery.task(bind=True)
 def task_josm_data_fast(self, insee):
     """
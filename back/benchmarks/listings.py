@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Compares the BeautifulSoup listing parsing previously used by batimap with the streaming parsers of
+batimap.listings, on the saved listing fixtures scaled up to the size of real department listings.
+
+Usage: PYTHONPATH=. python benchmarks/listings.py [--rows 5000] [--repeat 5]
+"""
+import argparse
+import gzip
+import io
+import re
+import time
+import tracemalloc
+from pathlib import Path
+
+from batimap import listings
+from bs4 import BeautifulSoup, SoupStrainer
+
+FIXTURES = Path(__file__).parent.parent / "tests" / "fixtures"
+
+
+def scale_fixture(name, row_pattern, rows):
+    """
+    Repeats the rows matched by row_pattern in the fixture until the listing holds at least `rows` rows
+    """
+    content = (FIXTURES / name).read_text()
+    matches = list(re.finditer(row_pattern, content, re.S))
+    (start, end) = (matches[0].start(), matches[-1].end())
+    body = content[start:end]
+    copies = rows // len(matches) + 1
+    return (content[:start] + body * copies + content[end:]).encode()
+
+
+def soup_cadastre(content):
+    parcelles = SoupStrainer("tbody", attrs={"class": "parcelles"})
+    fr = BeautifulSoup(gzip.decompress(content), "lxml", parse_only=parcelles)
+    rows = []
+    for next_city in fr.find_all("tbody"):
+        y = next_city.find(title="Ajouter au panier")
+        if not y:
+            continue
+        (_, code, _, format_type, _, _, _) = y.get("onclick").split("'")
+        rows.append((code, format_type, next_city.strong.string[:-9]))
+    return rows
+
+
+def stream_cadastre(content):
+    return list(
+        listings.parse_cadastre_listing(
+            listings.iter_chunks(io.BytesIO(content)), gzipped=True
+        )
+    )
+
+
+def soup_osm(content):
+    bs = BeautifulSoup(content, "lxml")
+    rows = []
+    for e in bs.select("tr"):
+        osm_data = e.select("td > a")
+        if len(osm_data):
+            rows.append(
+                (osm_data[0].text, e.select("td:nth-of-type(3)")[0].text.strip())
+            )
+    return rows
+
+
+def stream_osm(content):
+    return list(listings.parse_osm_listing(listings.iter_chunks(io.BytesIO(content))))
+
+
+def measure(function, content, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = len(function(content))
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(content)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (count, min(durations), peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = (
+        (
+            "cadastre.gouv.fr",
+            gzip.compress(
+                scale_fixture(
+                    "cadastre_listing.html", r"<tbody.*?</tbody>\n", args.rows
+                )
+            ),
+            soup_cadastre,
+            stream_cadastre,
+        ),
+        (
+            "cadastre.openstreetmap.fr",
+            scale_fixture("osm_listing.html", r"<tr><td.*?</tr>\n", args.rows),
+            soup_osm,
+            stream_osm,
+        ),
+    )
+    for (name, content, soup, stream) in cases:
+        print(f"{name} ({len(content) / 1024:.0f} KiB)")
+        results = {}
+        for (label, function) in (("beautifulsoup", soup), ("streaming", stream)):
+            (count, duration, peak) = measure(function, content, args.repeat)
+            results[label] = (duration, peak)
+            print(
+                f"  {label:<14} {count:>7} rows {duration * 1000:>9.1f} ms {peak / 1024:>9.0f} KiB peak"
+            )
+        (soup_duration, soup_peak) = results["beautifulsoup"]
+        (stream_duration, stream_peak) = results["streaming"]
+        print(
+            f"  speedup x{soup_duration / stream_duration:.1f}, memory x{soup_peak / stream_peak:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
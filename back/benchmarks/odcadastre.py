@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Compares the previous in-memory decoding of etalab cadastre files (download, gzip.decompress, ijson.items) with
+the streaming ODCadastre.count_buildings, on a synthetic department file.
+
+Each mode runs in its own process so that its peak RSS can be reported.
+
+Usage: PYTHONPATH=. python benchmarks/odcadastre.py [--buildings 1000000] [--fixture /tmp/batiments.json.gz]
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+
+
+def generate_fixture(path, buildings):
+    """
+    Writes an etalab-like gzipped GeoJSON file of the given number of buildings, spread over 500 cities
+    """
+    with gzip.open(path, "wt", compresslevel=1) as f:
+        f.write('{"type":"FeatureCollection","features":[')
+        for i in range(buildings):
+            feature = {
+                "type": "Feature",
+                "id": f"{i:012}",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [5.0 + i * 1e-7, 45.0],
+                            [5.0001 + i * 1e-7, 45.0],
+                            [5.0001 + i * 1e-7, 45.0001],
+                            [5.0 + i * 1e-7, 45.0001],
+                            [5.0 + i * 1e-7, 45.0],
+                        ]
+                    ],
+                },
+                "properties": {
+                    "type": "01",
+                    "nom": None,
+                    "commune": f"26{i % 500:03}",
+                    "created": "2011-06-06",
+                    "updated": "2021-01-05",
+                },
+            }
+            f.write(("," if i else "") + json.dumps(feature))
+        f.write("]}")
+
+
+def count_in_memory(path):
+    import ijson
+
+    with open(path, "rb") as f:
+        content = f.read()
+    data = gzip.decompress(content)
+    return Counter(list(ijson.items(data, "features.item.properties.commune")))
+
+
+def count_streaming(path):
+    from batimap.odcadastre import ODCadastre
+
+    with open(path, "rb") as f:
+        return ODCadastre.count_buildings(f)
+
+
+def run(mode, path):
+    start = time.perf_counter()
+    counts = {"in-memory": count_in_memory, "streaming": count_streaming}[mode](path)
+    duration = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {"buildings": sum(counts.values()), "duration": duration, "peak": peak}
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--buildings", type=int, default=1000000)
+    parser.add_argument("--fixture", default="/tmp/batimap-benchmark-batiments.json.gz")
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.fixture)
+        return
+
+    if not os.path.exists(args.fixture):
+        print(f"Generating {args.fixture} with {args.buildings} buildings...")
+        generate_fixture(args.fixture, args.buildings)
+    with gzip.open(args.fixture, "rb") as f:
+        size = sum(len(chunk) for chunk in iter(lambda: f.read(1024 * 1024), b""))
+    print(
+        f"{args.fixture}: {os.path.getsize(args.fixture) / 2**20:.0f} MiB gzipped, {size / 2**20:.0f} MiB of JSON"
+    )
+
+    for mode in ("in-memory", "streaming"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--fixture", args.fixture, "--mode", mode],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output)
+        print(
+            f"  {mode:<10} {result['buildings']:>9} buildings {result['duration']:>7.1f} s "
+            f"{size / 2**20 / result['duration']:>6.1f} MiB/s {result['peak'] / 1024:>7.0f} MiB peak RSS"
+        )
+
+
+if __name__ == "__main__":
+    main()
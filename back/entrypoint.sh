@@ -18,6 +18,12 @@ if [ $# = 0 ]; then
     # create a custom index to check building geometry, it boosts these filters by x5 factor
     PGPASSWORD="$POSTGRES_PASSWORD" psql -qtA -U $POSTGRES_USER -h $POSTGRES_HOST -p $POSTGRES_PORT -d $POSTGRES_DB -c 'CREATE INDEX IF NOT EXISTS building_geometrytype ON osm_buildings (st_geometrytype(geometry))'
     PGPASSWORD="$POSTGRES_PASSWORD" psql -qtA -U $POSTGRES_USER -h $POSTGRES_HOST -p $POSTGRES_PORT -d $POSTGRES_DB -c 'CREATE INDEX IF NOT EXISTS admin_insee ON osm_admin USING gist (insee gist_trgm_ops)'
+    PGPASSWORD="$POSTGRES_PASSWORD" psql -qtA -U $POSTGRES_USER -h $POSTGRES_HOST -p $POSTGRES_PORT -d $POSTGRES_DB -c 'CREATE INDEX IF NOT EXISTS admin_insee_equal ON osm_admin (insee)'
+
+    # install summaries maintained by triggers, once before workers start (imposm drops osm_admin ones)
+    flask simplifiedbuildings --if-missing || exit 1
+    flask citypriority --if-missing || exit 1
+    flask importstats --if-missing || exit 1
 
     # initialize database if no record can be found
     if [ $result != 0 ] || [ "$count" -lt 10 ]; then
@@ -34,10 +40,12 @@ if [ $# = 0 ]; then
 
     GUNICORN_TIMEOUT_VALUE=${GUNICORN_TIMEOUT_VALUE:=60}
     GUNICORN_WORKERS=${GUNICORN_WORKERS:=4}
+    # threads serve task progress streams without blocking workers
+    GUNICORN_THREADS=${GUNICORN_THREADS:=8}
 
     # start the back
     echo "Batimap is ready for use!"
-    gunicorn --bind ':5000' --timeout $GUNICORN_TIMEOUT_VALUE --workers $GUNICORN_WORKERS batimap.wsgi:app
+    gunicorn --bind ':5000' --timeout $GUNICORN_TIMEOUT_VALUE --workers $GUNICORN_WORKERS --threads $GUNICORN_THREADS batimap.wsgi:app
 else
     exec "$@"
 fi
@@ -1,10 +1,15 @@
 import datetime
+import io
+import json
 import os
+from types import SimpleNamespace
 
 import pytest
+import requests
+from batimap import downloadcache
 from batimap.app import create_app
 from batimap.db import Base, Boundary, Cadastre, City
-from batimap.extensions import db
+from batimap.extensions import data_version, db
 
 
 @pytest.fixture
@@ -27,7 +32,14 @@ def app():
 
 
 @pytest.fixture
-def client(app):
+def response_cache(app):
+    with app.app_context():
+        # responses cached by previous tests must not be served
+        data_version.bump()
+
+
+@pytest.fixture
+def client(app, response_cache):
     return app.test_client()
 
 
@@ -48,7 +60,16 @@ def celery_config():
 
 
 @pytest.fixture
-def db_mock_cities(app):
+def db_summaries(app):
+    # installed by `flask simplifiedbuildings`, `flask citypriority` and `flask importstats` on deployment
+    with app.app_context():
+        db.install_city_simplified_buildings()
+        db.install_city_priority()
+        db.install_import_stats()
+
+
+@pytest.fixture
+def db_mock_cities(app, db_summaries):
     with app.app_context():
         objects = [
             City(insee="01004", department="01", import_date="2009"),
@@ -62,7 +83,7 @@ def db_mock_cities(app):
 
 
 @pytest.fixture
-def db_mock_all_date(app):
+def db_mock_all_date(app, db_summaries):
     with app.app_context():
         dates = list(range(2009, 2021)) + [
             "raster",
@@ -104,7 +125,7 @@ def db_mock_all_date(app):
 
 
 @pytest.fixture
-def db_mock_boundaries(app):
+def db_mock_boundaries(app, db_summaries):
     with app.app_context():
         objects = [
             Boundary(
@@ -158,3 +179,53 @@ def db_mock_boundaries(app):
         ]
         db.session.add_all(objects)
         db.session.commit()
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=b"", headers={}):
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = io.BytesIO(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    @property
+    def text(self):
+        return self.raw.getvalue().decode()
+
+    def json(self):
+        return json.loads(self.raw.getvalue())
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    """
+    Serves files (url -> (content, etag)) to the download cache, recording requests (url, headers) in calls.
+    URLs in errors (url -> status code) fail with their status code instead.
+    """
+    files = {}
+    calls = []
+    errors = {}
+
+    def get(url, headers={}, stream=False, timeout=None):
+        calls.append((url, headers))
+        if url in errors:
+            return FakeResponse(errors[url])
+        if url not in files:
+            return FakeResponse(404)
+        (content, etag) = files[url]
+        # served files are never modified since any given date
+        if headers.get("If-None-Match") == etag or "If-Modified-Since" in headers:
+            return FakeResponse(304)
+        return FakeResponse(200, content, {"ETag": etag})
+
+    monkeypatch.setattr(downloadcache.requests, "get", get)
+    return SimpleNamespace(files=files, calls=calls, errors=errors)
@@ -0,0 +1,39 @@
+from collections import Counter
+
+import pytest
+from batimap.db import Cadastre, City
+from batimap.extensions import batimap
+
+
+@pytest.mark.parametrize(
+    ("sources", "od_buildings", "has_simplified", "expected_date", "expected_dates"),
+    (
+        ({}, None, False, "never", {}),
+        ({"raster": 120}, None, False, "raster", {"raster": 120}),
+        (
+            {"cadastre-dgi-fr source : Cadastre. Mise à jour : 2012": 80, "": 40},
+            None,
+            False,
+            "2012",
+            {"2012": 80, "unknown": 40},
+        ),
+        ({"2014": 60, "Cadastre 2014": 60}, None, True, "unfinished", {"2014": 120}),
+        ({"survey": 70, "Cadastre 2011": 30}, None, False, "unknown", None),
+        ({"Cadastre 2011": 10}, 200, False, "never", {"2011": 10}),
+        ({"Cadastre 2011": 10}, 10, False, "2011", {"2011": 10}),
+    ),
+)
+def test_date_for_buildings(
+    app, sources, od_buildings, has_simplified, expected_date, expected_dates
+):
+    with app.app_context():
+        city = City(insee="99001")
+        if od_buildings:
+            city.cadastre = Cadastre("99001", "99", od_buildings)
+
+        (date, dates) = batimap._Batimap__date_for_buildings(
+            city, Counter(sources), has_simplified
+        )
+        assert date == expected_date
+        if expected_dates is not None:
+            assert dates == expected_dates
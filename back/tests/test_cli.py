@@ -1,7 +1,7 @@
 from pathlib import Path
 
 import pytest
-from batimap.cli.app import initdb_command
+from batimap.cli.app import initdb_command, initdb_status_command
 from batimap.extensions import db
 
 
@@ -27,3 +27,13 @@ def test_initdb(db_mock_boundaries, app, runner, input, expected_count):
 
 def test_initdb_city(db_mock_cities, db_mock_boundaries, app, runner):
     test_initdb(db_mock_boundaries, app, runner, ["01004"], 5)
+
+
+def test_initdb_checkpoints(db_mock_boundaries, app, runner):
+    assert runner.invoke(initdb_status_command, ["01"]).output == (
+        "01: done=- pending=cadastre,raster,osm,buildings,unknowns\n"
+    )
+    runner.invoke(initdb_command, ["01"])
+
+    (done, pending) = runner.invoke(initdb_status_command, ["01"]).output.split()[1:]
+    assert "cadastre" in done and "buildings" in done
@@ -1,5 +1,7 @@
-from batimap.db import Cadastre, City
-from batimap.extensions import db
+from datetime import datetime
+
+from batimap.db import Building, Cadastre, City
+from batimap.extensions import batimap, db
 
 
 def test_cadastre_city_relationship(app):
@@ -15,3 +17,69 @@ def test_cadastre_city_relationship(app):
         assert cadastre is not None
 
         assert city.cadastre == cadastre
+
+
+def test_building_stats_maintained(db_mock_cities, db_mock_boundaries, app):
+    with app.app_context():
+        ignored = (
+            batimap.IGNORED_SIMPLIFIED_BUILDING_VALUES,
+            batimap.IGNORED_SIMPLIFIED_TAGS,
+        )
+        db.install_building_stats(*ignored)
+        db.rebuild_building_stats()
+        assert db.has_building_stats()
+
+        buildings = [
+            Building(
+                osm_id=1,
+                source="cadastre 2012",
+                building="yes",
+                geometry="srid=4326; POLYGON((0.1 0.1,0.2 0.1,0.2 0.2,0.1 0.2,0.1 0.1))",
+            ),
+            Building(
+                osm_id=2,
+                source="cadastre 2012",
+                building="yes",
+                geometry="srid=4326; POLYGON((1.1 1.1,1.2 1.1,1.2 1.2,1.1 1.2,1.1 1.1))",
+            ),
+        ]
+        db.session.add_all(buildings)
+        db.session.commit()
+
+        stats = db.get_precomputed_building_stats_per_city_for_insee("01")
+        assert sorted([(x[0], x[2], x[3]) for x in stats]) == [
+            ("01004", "cadastre 2012", 1),
+            ("01005", "cadastre 2012", 1),
+        ]
+        assert db.check_building_stats("01", *ignored) == []
+
+        db.session.delete(buildings[0])
+        db.session.commit()
+        stats = db.get_precomputed_building_stats_per_city_for_insee("01")
+        assert [(x[0], x[3]) for x in stats] == [("01005", 1)]
+        assert db.check_building_stats("01", *ignored) == []
+
+
+def test_overpass_summary_invalidated(db_mock_cities, db_mock_boundaries, app):
+    with app.app_context():
+        db.install_building_stats(
+            batimap.IGNORED_SIMPLIFIED_BUILDING_VALUES, batimap.IGNORED_SIMPLIFIED_TAGS
+        )
+        summary = {"osm_buildings": 1, "dates": {"2012": 1}, "simplified": []}
+        for insee in ["01004", "01005"]:
+            db.save_overpass_summary(insee, datetime.utcnow(), summary, {"w1": "2012"})
+        db.session.commit()
+        assert db.get_overpass_summary("01004") == summary
+        assert db.get_overpass_elements("01004") == {"w1": "2012"}
+
+        db.session.add(
+            Building(
+                osm_id=3,
+                source="cadastre 2012",
+                building="yes",
+                geometry="srid=4326; POLYGON((0.1 0.1,0.2 0.1,0.2 0.2,0.1 0.2,0.1 0.1))",
+            )
+        )
+        db.session.commit()
+        assert db.get_overpass_summary("01004") is None
+        assert db.get_overpass_summary("01005") == summary
@@ -0,0 +1,88 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+from batimap.downloadcache import DownloadCache
+from flask import Flask
+
+URL = "https://example.org/file.json.gz"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    app = Flask(__name__)
+    app.config.update(DOWNLOAD_CACHE_DIR=tmp_path, DOWNLOAD_CACHE_MAX_SIZE=10)
+
+    cache = DownloadCache()
+    cache.init_app(app)
+    with app.app_context():
+        yield cache
+
+
+def read(cache, url, since=None):
+    with cache.open(url, since=since) as download:
+        return download.fileobj.read() if download else None
+
+
+def test_download_revalidated(cache, fake_server):
+    fake_server.files[URL] = (b"content", '"v1"')
+    assert read(cache, URL) == b"content"
+    assert read(cache, URL) == b"content"
+    assert fake_server.calls == [(URL, {}), (URL, {"If-None-Match": '"v1"'})]
+
+    fake_server.files[URL] = (b"new content", '"v2"')
+    assert read(cache, URL) == b"new content"
+
+
+def test_download_not_modified_since(cache, fake_server):
+    fake_server.files[URL] = (b"content", '"v1"')
+    assert read(cache, URL, since=datetime.now()) is None
+    assert "If-Modified-Since" in fake_server.calls[0][1]
+    assert read(cache, URL) == b"content"
+
+
+def test_download_evicted(cache, fake_server):
+    fake_server.files[URL] = (b"0123456789", '"v1"')
+    fake_server.files[URL + "2"] = (b"0123456789", '"v1"')
+
+    assert read(cache, URL) == b"0123456789"
+    assert read(cache, URL + "2") == b"0123456789"
+    assert len(os.listdir(cache.directory / "blobs")) == 1
+    assert len(os.listdir(cache.directory / "urls")) == 1
+
+    # first download was evicted, it must be downloaded again
+    assert read(cache, URL) == b"0123456789"
+    assert fake_server.calls[-1] == (URL, {})
+
+
+def test_download_stale_on_server_error(cache, fake_server):
+    fake_server.files[URL] = (b"content", '"v1"')
+    assert read(cache, URL) == b"content"
+
+    fake_server.errors[URL] = 503
+    assert read(cache, URL) == b"content"
+
+
+def test_download_stored_while_read(cache, fake_server):
+    fake_server.files[URL] = (b"content", '"v1"')
+    with cache.open(URL) as download:
+        assert download.fileobj.read(3) == b"con"
+
+    # the rest of the body was stored anyway
+    fake_server.errors[URL] = 503
+    assert read(cache, URL) == b"content"
+
+
+def test_download_evicted_while_opened(cache, fake_server, monkeypatch):
+    fake_server.files[URL] = (b"content", '"v1"')
+    assert read(cache, URL) == b"content"
+    meta = json.loads(next((cache.directory / "urls").iterdir()).read_text())
+
+    # another process evicts the body once its meta was read
+    os.unlink(cache.directory / "blobs" / meta["key"])
+    monkeypatch.setattr(
+        DownloadCache, "_DownloadCache__read_meta", lambda self, path: meta
+    )
+    assert read(cache, URL) == b"content"
+    assert fake_server.calls[-1] == (URL, {})
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import pytest
+from batimap.extensions import download_cache, listing_cache
+
+FIXTURES = Path(__file__).parent / "fixtures"
+URL = "https://cadastre.openstreetmap.fr/data/026/"
+
+
+@pytest.fixture
+def listing_server(app, fake_server, monkeypatch, tmp_path):
+    fake_server.files[URL] = ((FIXTURES / "osm_listing.html").read_bytes(), '"v1"')
+    monkeypatch.setattr(download_cache, "directory", tmp_path)
+    with app.app_context():
+        listing_cache.invalidate("026")
+        yield fake_server
+        listing_cache.invalidate("026")
+
+
+def test_listing_served_from_cache(app, listing_server):
+    rows = listing_cache.osm_listing("026")
+    assert listing_cache.osm_listing("026") == rows
+    assert len(listing_server.calls) == 1
+    assert "CL098-COBONNE-houses-simplifie.osm" in [r.name for r in rows]
+
+
+def test_listing_revalidated_once_expired(app, listing_server, monkeypatch):
+    monkeypatch.setattr(listing_cache, "ttl", 0)
+    rows = listing_cache.osm_listing("026")
+    assert listing_cache.osm_listing("026") == rows
+    assert listing_server.calls == [(URL, {}), (URL, {"If-None-Match": '"v1"'})]
+
+
+def test_listing_invalidated(app, listing_server):
+    listing_cache.osm_listing("026")
+    listing_cache.invalidate("026")
+    listing_server.files[URL] = (b"<html></html>", '"v2"')
+    assert listing_cache.osm_listing("026") == []
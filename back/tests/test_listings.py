@@ -0,0 +1,61 @@
+import gzip
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from batimap import listings
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def chunks(content, size):
+    return [content[i : i + size] for i in range(0, len(content), size)]  # noqa: E203
+
+
+@pytest.mark.parametrize(
+    ("gzipped", "chunk_size"), ((False, 7), (True, 7), (True, 4096))
+)
+def test_parse_cadastre_listing(gzipped, chunk_size):
+    content = (FIXTURES / "cadastre_listing.html").read_bytes()
+    if gzipped:
+        content = gzip.compress(content)
+
+    rows = list(
+        listings.parse_cadastre_listing(
+            chunks(content, chunk_size), gzipped=gzipped, encoding="utf-8"
+        )
+    )
+
+    assert rows == [
+        listings.ListingRow("CL098", "VECT", "COBONNE", None),
+        listings.ListingRow("HX124", "IMAG", "ÉTOILE-SUR-RHÔNE", None),
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", (7, 4096))
+def test_parse_osm_listing(chunk_size):
+    content = (FIXTURES / "osm_listing.html").read_bytes()
+
+    rows = list(listings.parse_osm_listing(chunks(content, chunk_size)))
+
+    assert rows[0] == listings.ListingRow(
+        "", "Parent Directory", "Parent Directory", None
+    )
+    assert rows[2] == listings.ListingRow(
+        "CL098-COBONNE",
+        "houses-simplifie.osm",
+        "CL098-COBONNE-houses-simplifie.osm",
+        datetime(2021, 5, 1, 12, 0),
+    )
+    assert rows[4].date == datetime(2020, 2, 3, 17, 45)
+    assert [r.code for r in rows if r.name.endswith("simplifie.osm")] == [
+        "CL098-COBONNE",
+        "CL098-COBONNE-extrait",
+        "HX124-ETOILE-SUR-RHONE",
+    ]
+
+
+def test_content_charset():
+    assert listings.content_charset("text/html; charset=ISO-8859-1") == "iso-8859-1"
+    assert listings.content_charset("text/html") is None
+    assert listings.content_charset(None) is None
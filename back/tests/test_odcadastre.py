@@ -1,8 +1,12 @@
+import gzip
+import io
+import json
 from datetime import datetime
 
 import pytest
 from batimap.db import Boundary, Cadastre, City
 from batimap.extensions import db, odcadastre
+from batimap.odcadastre import ODCadastre
 
 
 @pytest.mark.parametrize(
@@ -43,3 +47,38 @@ def test_department_has_buildings(app):
         assert cadastre.department == boundary.insee
         assert cadastre.od_buildings >= 160000
         assert cadastre.last_fetch > now
+
+
+def test_count_buildings():
+    features = [
+        {"type": "Feature", "properties": {"commune": insee, "type": "01"}}
+        for insee in ["55050"] * 3 + ["55051"]
+    ]
+    data = gzip.compress(
+        json.dumps({"type": "FeatureCollection", "features": features}).encode()
+    )
+
+    assert ODCadastre.count_buildings(io.BytesIO(data)) == {"55050": 3, "55051": 1}
+
+
+def test_departments_have_buildings(app):
+    with app.app_context():
+        boundary = Boundary(osm_id=9999, name="test-dept-05", admin_level=6, insee="05")
+        db.session.add(db.session.merge(boundary))
+
+        assert list(odcadastre.compute_counts(["05", "unknown"])) == ["unknown", "05"]
+        cadastre = db.get_cadastre_for_insee("05")
+        assert cadastre.od_buildings >= 160000
+
+        # department file did not change since, it must not be fetched again
+        last_fetch = cadastre.last_fetch
+        assert list(odcadastre.compute_counts(["05"])) == ["05"]
+        assert db.get_cadastre_for_insee("05").last_fetch == last_fetch
+
+
+def test_department_stamp(app):
+    with app.app_context():
+        stamp = odcadastre.department_stamp("05")
+        assert stamp is not None
+        assert odcadastre.department_stamp("05") == stamp
+        assert odcadastre.department_stamp("unknown") is None
@@ -0,0 +1,213 @@
+import io
+import json
+import re
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import requests
+from batimap import overpass as overpass_module
+from batimap.extensions import overpass
+from batimap.overpass import BuildingElement
+from overpass.errors import ServerLoadError, ServerRuntimeError
+from tests.conftest import FakeResponse
+
+FAILING = overpass.instances_endpoints[0]
+
+
+@pytest.fixture
+def fake_overpass(app, monkeypatch):
+    """
+    Every endpoint answers an empty result, except the first one which is overloaded
+    """
+    calls = []
+
+    def post(endpoint, data, **kwargs):
+        calls.append(endpoint)
+        return FakeResponse(504 if endpoint == FAILING else 200, b'{"elements": []}')
+
+    def get(url, timeout):
+        return FakeResponse(200, b"Rate limit: 2\n2 slots available now.\n")
+
+    monkeypatch.setattr(overpass_module.requests, "post", post)
+    monkeypatch.setattr(overpass_module.requests, "get", get)
+    with app.app_context():
+        overpass.redis.delete(
+            *[overpass.key_prefix + e for e in overpass.instances_endpoints]
+        )
+        yield calls
+
+
+def test_failing_endpoint_set_aside(app, fake_overpass):
+    for _ in range(overpass.BREAKER_THRESHOLD):
+        # best score, whatever its error rate
+        overpass.redis.hset(overpass.key_prefix + FAILING, "latency", 0)
+        assert overpass.request_with_retries("[out:json];") == {"elements": []}
+
+    assert fake_overpass.count(FAILING) == overpass.BREAKER_THRESHOLD
+    stats = {s["endpoint"]: s for s in overpass.stats()}
+    assert stats[FAILING]["circuit"] == "open"
+    assert stats[FAILING]["last_error"] == "ServerLoadError"
+
+    # despite its latency, failing endpoint is not used anymore
+    overpass.request_with_retries("[out:json];")
+    assert fake_overpass.count(FAILING) == overpass.BREAKER_THRESHOLD
+
+
+def test_slowest_endpoint_avoided(app, fake_overpass):
+    for (idx, endpoint) in enumerate(overpass.instances_endpoints):
+        overpass.redis.hset(overpass.key_prefix + endpoint, "latency", 10 - idx)
+
+    overpass.request_with_retries("[out:json];")
+    assert fake_overpass == [overpass.instances_endpoints[-1]]
+
+
+def test_retries_backoff_without_status(app, fake_overpass, monkeypatch):
+    sleeps = []
+
+    def get(url, timeout):
+        raise requests.exceptions.ConnectionError()
+
+    monkeypatch.setattr(overpass_module.requests, "get", get)
+    monkeypatch.setattr(
+        overpass_module.requests, "post", lambda *a, **kw: FakeResponse(504)
+    )
+    monkeypatch.setattr(overpass_module.time, "sleep", sleeps.append)
+    with pytest.raises(ServerLoadError):
+        overpass.request_with_retries("[out:json];", retries=5)
+
+    # no wait before the first attempt, then a bounded backoff
+    assert len(sleeps) == 4
+    assert sleeps == sorted(sleeps)
+    assert all(0 < s <= overpass.MAX_RETRY_BACKOFF for s in sleeps)
+
+
+def test_cities_buildings_batches_split(app, fake_overpass, monkeypatch):
+    def post(endpoint, data, **kwargs):
+        insees = re.findall(r'insee="(\d+)"', data["data"])
+        if len(insees) > 2:
+            raise requests.exceptions.Timeout()
+        elements = []
+        for insee in insees:
+            elements.append({"type": "city", "id": 1, "tags": {"insee": insee}})
+            elements.append(
+                {
+                    "type": "building",
+                    "id": int(insee),
+                    "tags": {"osm_type": "way", "timestamp": "2012", "building": "yes"},
+                }
+            )
+        return FakeResponse(200, json.dumps({"elements": elements}).encode())
+
+    monkeypatch.setattr(overpass_module.requests, "post", post)
+    cities = [(f"0100{i}", [-i]) for i in range(5)]
+    assert list(overpass.get_cities_buildings(cities, batch_size=5)) == [
+        (
+            insee,
+            [BuildingElement("way", int(insee), "2012", {"building": "yes"})],
+            None,
+        )
+        for (insee, _) in cities
+    ]
+
+
+def test_cities_buildings_failing_city_skipped(app, fake_overpass, monkeypatch):
+    def post(endpoint, data, **kwargs):
+        insees = re.findall(r'insee="(\d+)"', data["data"])
+        if "01003" in insees:
+            return FakeResponse(500)
+        elements = [{"type": "city", "id": 1, "tags": {"insee": i}} for i in insees]
+        return FakeResponse(200, json.dumps({"elements": elements}).encode())
+
+    monkeypatch.setattr(overpass_module.requests, "post", post)
+    cities = [(f"0100{i}", [-i]) for i in range(5)]
+    assert [
+        (insee, elements)
+        for (insee, elements, _) in overpass.get_cities_buildings(cities, batch_size=5)
+    ] == [("01000", []), ("01001", []), ("01002", []), ("01003", None), ("01004", [])]
+
+
+def test_city_buildings_retried_on_runtime_error(app, fake_overpass, monkeypatch):
+    building = {
+        "type": "building",
+        "id": 1,
+        "tags": {"osm_type": "way", "timestamp": "2012", "building": "yes"},
+    }
+
+    def post(endpoint, data, **kwargs):
+        fake_overpass.append(endpoint)
+        body = {"elements": [building]}
+        if len(fake_overpass) == 1:
+            # reported once part of the result was sent
+            body["remark"] = "runtime error: Query timed out"
+        return FakeResponse(200, json.dumps(body).encode())
+
+    monkeypatch.setattr(overpass_module.requests, "post", post)
+    assert list(overpass.get_city_buildings(SimpleNamespace(insee="01004"))) == [
+        BuildingElement("way", 1, "2012", {"building": "yes"})
+    ]
+    assert len(fake_overpass) == 2
+
+    # the endpoint failing while its result was read is not considered healthy
+    stats = {s["endpoint"]: s for s in overpass.stats()}
+    assert stats[fake_overpass[0]]["errors"] == 1
+    assert stats[fake_overpass[0]]["requests"] == 1
+    assert stats[fake_overpass[0]]["latency"] is None
+
+
+def test_elements_streamed():
+    response = {
+        "osm3s": {"timestamp_osm_base": "2021-11-10T12:00:00Z"},
+        "elements": [
+            {
+                "type": "building",
+                "id": 1,
+                "tags": {
+                    "osm_type": "node",
+                    "timestamp": "2012-01-01T00:00:00Z",
+                    "building": "yes",
+                    "historic": "",
+                },
+            },
+        ],
+    }
+    meta = {}
+    elements = overpass._Overpass__iter_json_elements(
+        io.BytesIO(json.dumps(response).encode()), meta
+    )
+    assert list(elements) == [
+        BuildingElement("node", 1, "2012-01-01T00:00:00Z", {"building": "yes"})
+    ]
+    assert meta == {"timestamp_osm_base": datetime(2021, 11, 10, 12)}
+
+    response["remark"] = "runtime error: Query timed out"
+    with pytest.raises(ServerRuntimeError):
+        list(
+            overpass._Overpass__iter_json_elements(
+                io.BytesIO(json.dumps(response).encode())
+            )
+        )
+
+
+def test_city_buildings_since(app, fake_overpass, monkeypatch):
+    requests_data = []
+
+    def post(endpoint, data, **kwargs):
+        requests_data.append(data["data"])
+        elements = [
+            {"type": "count", "id": 0, "tags": {"total": "42"}},
+            {
+                "type": "building",
+                "id": 1,
+                "tags": {"osm_type": "way", "timestamp": "2021", "building": "yes"},
+            },
+        ]
+        return FakeResponse(200, json.dumps({"elements": elements}).encode())
+
+    monkeypatch.setattr(overpass_module.requests, "post", post)
+    meta = {}
+    city = SimpleNamespace(insee="01004")
+    elements = overpass.get_city_buildings_since(city, datetime(2021, 11, 10), meta)
+    assert list(elements) == [BuildingElement("way", 1, "2021", {"building": "yes"})]
+    assert meta == {"buildings": 42}
+    assert "way['building'](area.a)(newer:\"2021-11-10T00:00:00Z\")" in requests_data[0]
@@ -1,4 +1,12 @@
+import gzip
+import json
+from datetime import datetime
+
 import pytest
+from batimap.api.insee import zoom_tolerance
+from batimap.db import City
+from batimap.extensions import data_version, db
+from sqlalchemy import text
 
 
 def test_status_empty(client):
@@ -24,6 +32,8 @@ def test_status(db_mock_cities, client):
         ([], None),
         ([[0, 0, 1, 1]], ["01004", "01005"]),
         ([[0, 0, 1, 1], [0.4, 0.4, 0.6, 0.6], [0, 0, 0.3, 0.3]], ["01004", "01005"]),
+        # tiles are given from their north west to their south east corner
+        ([[0.4, 0.6, 0.6, 0.4], [2.4, 2.6, 2.6, 2.4]], ["01004", "01006"]),
     ),
 )
 def test_bbox(db_mock_boundaries, db_mock_cities, client, bboxes, expected):
@@ -34,6 +44,49 @@ def test_bbox(db_mock_boundaries, db_mock_cities, client, bboxes, expected):
         assert result == expected
 
 
+def test_city(db_mock_all_date, client):
+    resp = client.get("/cities/08100")
+    assert resp.status_code == 200
+    assert resp.json == {
+        "insee": "08100",
+        "name": None,
+        "date": "2009",
+        "details": None,
+        "osm_buildings": 100,
+        "od_buildings": 100,
+        "josm_ready": True,
+    }
+
+    resp = client.get("/cities/08000", query_string={"fields": "insee,josm_ready"})
+    assert resp.json == {"insee": "08000", "josm_ready": False}
+
+    assert client.get("/cities/08000?fields=geometry").status_code == 400
+    assert client.get("/cities/99999").status_code == 404
+
+
+def test_city_josm_ready_cached_for_the_day(db_mock_all_date, client):
+    now = datetime.now()
+    start_of_day = datetime.combine(now.date(), datetime.min.time())
+    with client.application.app_context():
+        city = db.get_city_for_insee("08100")
+        # still fresh now, but outdated as of the start of the day
+        city.date_cadastre = (
+            start_of_day - City.CADASTRE_FRESHNESS + (now - start_of_day) / 2
+        )
+        db.session.commit()
+        data_version.bump(["08"])
+
+    resp = client.get("/cities/08100", query_string={"fields": "josm_ready"})
+    assert resp.json == {"josm_ready": False}
+
+
+def test_bbox_fields(db_mock_boundaries, db_mock_cities, client):
+    resp = client.post(
+        "/bbox/cities", json={"bboxes": [[0, 0, 1, 1]], "fields": ["insee"]}
+    )
+    assert resp.json == [{"insee": "01004"}, {"insee": "01005"}]
+
+
 @pytest.mark.parametrize(
     ("insee", "expected_status"),
     (
@@ -107,3 +160,169 @@ def test_obsolete_ignore_city(db_mock_all_date, client):
     city = resp.json["city"]
     assert city["date"] == "unknown"
     assert city["insee"] == "08114"
+
+
+def test_obsolete_reserved(db_mock_all_date, client):
+    cities = [client.get("/cities/obsolete").json["city"] for _ in range(3)]
+    # fresh cadastre first, then the other never imported city since the first one is reserved
+    assert [(c["insee"], c["date"]) for c in cities[:2]] == [
+        ("08115", "never"),
+        ("08015", "never"),
+    ]
+    assert cities[2]["date"] == "unfinished"
+
+
+def test_obsolete_without_triggers(db_mock_all_date, client):
+    with client.application.app_context():
+        # lost when imposm deploys a new import
+        db.session.execute(text("DROP TRIGGER batimap_city_priority ON osm_admin"))
+        db.session.commit()
+        assert not db.has_city_priority()
+
+    resp = client.get("/cities/obsolete", query_string={"ignored": "never"})
+    assert resp.status_code == 200
+    assert resp.json["city"]["date"] == "unfinished"
+    assert resp.json["position"] in ([0.05, 0.05], [0.1, 0.1])
+
+
+def test_legend(db_mock_boundaries, db_mock_cities, client):
+    # large viewports are counted from tiles summaries
+    resp = client.get("/legend/-10/10/10/-10")
+    assert resp.status_code == 200
+    assert sorted((x["name"], x["count"]) for x in resp.json) == [
+        ("2009", 2),
+        ("2012", 1),
+        ("2013", 1),
+        ("raster", 1),
+    ]
+
+
+def test_department_stats_maintained(db_mock_cities, client):
+    assert client.get("/departments/01/details").json["dates"] == {
+        "2009": 2,
+        "2013": 1,
+    }
+
+    with client.application.app_context():
+        db.get_city_for_insee("01005").import_date = "2009"
+        db.session.commit()
+        data_version.bump(["01"])
+
+    assert client.get("/departments/01/details").json["dates"] == {"2009": 3}
+    assert client.get("/status").json[0] == {"count": 3, "date": "2009"}
+
+
+def test_department_stats_without_triggers(db_mock_cities, client):
+    with client.application.app_context():
+        # lost when imposm deploys a new import
+        db.session.execute(text("DROP TRIGGER batimap_import_stats ON osm_admin"))
+        db.get_city_for_insee("01005").import_date = "2009"
+        db.session.commit()
+        data_version.bump(["01"])
+        assert not db.has_import_stats()
+
+    assert client.get("/departments/01/details").json["dates"] == {"2009": 3}
+    assert client.get("/status").json[0] == {"count": 3, "date": "2009"}
+
+
+def test_department_simplified_maintained(db_mock_cities, client):
+    with client.application.app_context():
+        db.get_city_for_insee("01005").import_details = {
+            "dates": {"2013": 2},
+            "simplified": [42, 7],
+        }
+        db.get_city_for_insee("01004").import_details = {"simplified": [3]}
+        db.get_city_for_insee("02022").import_details = {"simplified": [1]}
+        db.session.commit()
+        data_version.bump(["01"])
+
+    assert client.get("/departments/01/details").json["simplified"] == [3, 7, 42]
+
+    with client.application.app_context():
+        db.get_city_for_insee("01005").import_details = None
+        db.session.commit()
+        data_version.bump(["01"])
+
+    assert client.get("/departments/01/details").json["simplified"] == [3]
+
+
+def test_not_modified(db_mock_cities, client):
+    resp = client.get("/departments/01/details")
+    etag = resp.headers["ETag"]
+    assert client.get("/departments/01/details").json == resp.json
+
+    resp = client.get("/departments/01/details", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    # other departments changes do not invalidate it
+    with client.application.app_context():
+        data_version.bump(["02"])
+    resp = client.get("/departments/01/details", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    with client.application.app_context():
+        data_version.bump(["01"])
+    resp = client.get("/departments/01/details", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+
+def test_cached_response_headers(client):
+    @data_version.cached_response()
+    def view():
+        return "a,b", 200, {"Content-Type": "text/csv", "Cache-Control": "no-cache"}
+
+    client.application.add_url_rule("/test/cached", "test_cached", view)
+    for _ in range(2):
+        resp = client.get("/test/cached")
+        assert resp.data == b"a,b"
+        assert resp.mimetype == "text/csv"
+        assert resp.headers["Cache-Control"] == "no-cache"
+
+
+def test_initdb_bumps_version(db_mock_cities, client):
+    with client.application.app_context():
+        before = data_version.version("01")
+    assert client.post("/initdb", json={"cities": ["01004"]}).status_code == 202
+    with client.application.app_context():
+        assert data_version.version("01") != before
+
+
+def test_insee_simplified(db_mock_boundaries, db_mock_cities, client):
+    resp = client.get("/insee/01004")
+    assert resp.json["features"]["properties"] == {
+        "name": "None - 01004",
+        "date": "2009",
+    }
+    assert resp.json["features"]["geometry"]["type"] == "Polygon"
+
+    resp = client.get(
+        "/insee/01004", query_string={"zoom": 8}, headers={"Accept-Encoding": "gzip"}
+    )
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    feature = json.loads(gzip.decompress(resp.data))["features"]
+    assert feature["geometry"]["coordinates"] == [
+        [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+    ]
+
+    # tolerances are rounded to the nearest zoom level, hence share its cached response
+    etag = client.get("/insee/01004", query_string={"zoom": 8}).headers["ETag"]
+    resp = client.get(
+        "/insee/01004", query_string={"tolerance": zoom_tolerance(8) * 1.2}
+    )
+    assert resp.headers["ETag"] == etag
+
+    assert client.get("/insee/01004?tolerance=-1").status_code == 400
+    assert client.get("/insee/01004?tolerance=inf").status_code == 400
+    assert client.get("/insee/99999").status_code == 404
+
+
+def test_update_deduplicated(db_mock_cities, client):
+    task_id = client.get("/cities/01005/update").json["task_id"]
+    assert client.get("/cities/01005/update").json["task_id"] == task_id
+
+    tasks = client.get("/cities/01005/tasks").json
+    assert [(t["task_id"], t["name"], t["args"]) for t in tasks] == [
+        (task_id, "task_update_insee", ["01005"])
+    ]
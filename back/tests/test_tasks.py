@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from batimap.extensions import task_registry
+from batimap.tasks import common
+from batimap.tasks.utils import task_progress
+
+
+def test_task_progress_throttled(app):
+    states = []
+    task = SimpleNamespace(
+        request=SimpleNamespace(id="task-id"),
+        update_state=lambda task_id, state, meta: states.append(meta),
+    )
+    with app.app_context():
+        for city in range(1000):
+            task_progress(task, city / 10)
+        task_progress(task, 100)
+        task_progress(task, 100)
+
+    assert len(states) == 101
+    assert states[-1] == '{"current": 100, "total": 100}'
+
+
+def test_initdb_departments_chord(app, monkeypatch):
+    progresses = []
+
+    def initdb_departments(departments, items, items_are_cities, progress, force):
+        progress(50)
+        progress(100)
+
+    monkeypatch.setattr(common, "initdb_departments", initdb_departments)
+    monkeypatch.setattr(common.batimap, "clear_tiles", lambda insee: None)
+    monkeypatch.setattr(
+        common,
+        "task_progress",
+        lambda task, current, task_id=None: progresses.append((task_id, current)),
+    )
+    with app.app_context():
+        result = common.task_initdb.apply(args=(["01", "02"],))
+    assert result.successful()
+
+    # departments progress is aggregated on the initdb task, then finalize completes it
+    assert [p for (task_id, p) in progresses if task_id == result.id] == [
+        25,
+        50,
+        75,
+        100,
+    ]
+    assert progresses[-1] == (None, 100)
+
+
+def test_initdb_failed_unregistered(app, monkeypatch):
+    monkeypatch.setattr(common.task_initdb, "apply_async", lambda *a, **kw: None)
+    with app.app_context():
+        (task_id, created) = task_registry.submit(common.task_initdb, ["01", "02"])
+        assert created
+        common.task_initdb_failed.apply(args=(task_id,))
+
+        assert task_registry.tasks() == []
+        (retry_id, created) = task_registry.submit(common.task_initdb, ["01", "02"])
+        assert created
+        assert retry_id != task_id
@@ -2,6 +2,7 @@
 # This program is watching for Imposm database updates (eg OSM data changes)
 # When update occurs, this script will refresh stats on data's cities
 import configparser
+import json
 import logging
 import os
 import threading
@@ -40,6 +41,7 @@ BACK_URL = config["DEFAULT"]["BACK_URL"]
 BACK_CITIES_IN_BBOX_URL = BACK_URL + "/bbox/cities"
 BACK_INITDB_URL = BACK_URL + "/initdb"
 BACK_TASKS_URL = BACK_URL + "/tasks/{task_id}"
+BACK_TASKS_STREAM_URL = BACK_URL + "/tasks/{task_id}/stream"
 
 
 class Watcher:
@@ -86,31 +88,45 @@ class Handler(FileSystemEventHandler):
     @staticmethod
     def wait_task_completion(r):
         if r.status_code == 202:
-            task_url = BACK_TASKS_URL.format(**r.json())
-            LOG.info(f"You can follow the progress of initdb on {task_url}")
-            Handler.get_task_status(task_url)
+            task_id = r.json()["task_id"]
+            LOG.info(
+                f"You can follow the progress of initdb on {BACK_TASKS_URL.format(task_id=task_id)}"
+            )
+            thread = threading.Thread(target=Handler.follow_task, args=(task_id,))
+            thread.daemon = True
+            thread.start()
         else:
             LOG.warning(
                 f"Error {r.status_code} {r.reason} while invoking initdb: {r.text}"
             )
 
     @staticmethod
-    def get_task_status(url):
-        r = requests.get(url=url)
-        content = r.json()
-        state = content["state"]
-        result = content["result"]
-
-        if r.status_code != 200 or state in ["FAILURE", "SUCCESS"]:
-            LOG.info(
-                f"initdb terminated {state}: {result if result else '<empty response>'}"
-            )
-        else:
-            if state == "PROGRESS":
-                LOG.debug(f"initdb progress: {result['current']}/{result['total']}")
-            timer = threading.Timer(30, Handler.get_task_status, args=(url,))
-            timer.daemon = True
-            timer.start()
+    def follow_task(task_id):
+        """Log the task progress events until it terminates, reconnecting whenever the stream is closed."""
+        url = BACK_TASKS_STREAM_URL.format(task_id=task_id)
+        while True:
+            try:
+                # the stream sends keepalives every 15 seconds
+                with requests.get(url=url, stream=True, timeout=60) as r:
+                    r.raise_for_status()
+                    for line in r.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith("data:"):
+                            continue
+                        content = json.loads(line[len("data:") :])  # noqa: E203
+                        state = content["state"]
+                        result = content["result"]
+                        if state in ["FAILURE", "SUCCESS", "REVOKED"]:
+                            LOG.info(
+                                f"initdb terminated {state}: {result if result else '<empty response>'}"
+                            )
+                            return
+                        if state == "PROGRESS":
+                            LOG.debug(
+                                f"initdb progress: {result['current']}/{result['total']}"
+                            )
+            except requests.RequestException as e:
+                LOG.warning(f"initdb progress stream interrupted: {e}")
+                time.sleep(30)
 
     @staticmethod
     def chunks(array, n):
@@ -146,9 +162,11 @@ class Handler(FileSystemEventHandler):
         cities = []
 
         LOG.debug(f"{BACK_CITIES_IN_BBOX_URL} - {bboxes}")
-        # we cannot request too much at once because it timeouts..
-        for chunk in Handler.chunks(bboxes, 100):
-            r = requests.post(url=BACK_CITIES_IN_BBOX_URL, json={"bboxes": chunk})
+        # bboxes are looked up with a single query, but keep requests reasonably sized
+        for chunk in Handler.chunks(bboxes, 1000):
+            r = requests.post(
+                url=BACK_CITIES_IN_BBOX_URL, json={"bboxes": chunk, "fields": ["insee"]}
+            )
             cities += [c["insee"] for c in r.json()]
             LOG.debug(f"{r.text}")
 